@@ -1,15 +1,23 @@
-import os
-
 from flask import Flask
+from setting import DB_PATH
 from .api import api_bp  # Import the blueprint
 
 
-def create_app():
+def create_app(preload: bool = False):
+    """
+    Create the Flask application.
+
+    Parameters:
+    - preload (bool): Load the latest version of every model and the similar
+        diamonds index, and run a warm-up prediction, before returning. Used by
+        serve.py to load them once in the parent process, shared with the forked
+        workers.
+    """
     # create and configure the app
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_mapping(
         SECRET_KEY="dev",
-        DATABASE=os.path.join(app.instance_path, "app_db.sqlite"),
+        DATABASE=str(DB_PATH),
     )
 
     app.register_blueprint(api_bp)
@@ -23,4 +31,9 @@ def create_app():
 
     db.init_app(app)
 
+    if preload:
+        from .utils import preload_models
+
+        preload_models()
+
     return app
@@ -1,51 +1,119 @@
-import sqlite3
 import json
+import time
+import numpy as np
 import pandas as pd
-from flask import Blueprint, request
+from flask import Blueprint, Response, request, g
 from flask import jsonify
-from app.utils import load_model, get_model_pickle_path, check_data_correctness
-from setting import DEFAULT_DATASET, DB_PATH
-from models.utils import (
-    load_df,
+from app.metrics import render_samples
+from app.utils import (
+    resolve_model,
+    resolve_model_name,
+    check_data_correctness,
+    model_cache,
+    history_writer,
+    similar_diamonds_index,
+    micro_batcher,
+    model_watcher,
+    prediction_cache,
+    api_metrics,
+)
+from app.prediction_cache import diamond_key
+from app.history_store import query_history, query_hourly, DEFAULT_PAGE_SIZE
+from app.db import get_db
+from app.validation import validate_frame
+from models.timing import start_recording, stop_recording, stage
+from models.utils import FEATURE_COLUMNS, NUMERICAL_COLUMNS
+from app.similarity_index import METRICS
+from setting import (
+    MICRO_BATCHING_ENABLED,
+    PREDICTION_CACHE_ENABLED,
+    API_HISTORY_RECORD_STAGES,
+    SIMILARITY_DEFAULT_MODE,
+    SIMILARITY_DEFAULT_METRIC,
 )
 
 
 api_bp = Blueprint("api", __name__)
 
+# Endpoints that are neither stored in the api history nor measured
+UNTRACKED_ENDPOINTS = {"api.get_metrics", "api.get_history", "api.get_history_hourly"}
+
+
+@api_bp.before_request
+def start_request_timing():
+    """Start measuring the duration of the request and of its stages."""
+    g.request_started = time.perf_counter()
+    g.stages, g.stages_token = start_recording()
+
+
+@api_bp.teardown_request
+def stop_request_timing(exception=None):
+    """Stop recording the stages of the request."""
+    token = g.pop("stages_token", None)
+    if token is not None:
+        stop_recording(token)
+
 
 @api_bp.after_request
 def after_request_for_api_hystory_storage(response):
     """
     Logs API request details to the SQLite database after each request.
 
-    This function is executed after each API request. It connects to an SQLite
-    database specified by the DB_PATH variable, and inserts the details of the
-    API request and response into the api_history table. This includes the API
-    endpoint (path), the request payload, and the response data.
+    This function is executed after each API request. It queues the details of
+    the API request and response to the background writer, that stores them in
+    the api_history table of the SQLite database specified by the DB_PATH
+    variable. This includes the API endpoint (path), the request payload, and
+    the response data.
 
     Parameters:
     - response: The response object that is about to be sent to the client.
 
+    The duration of the request and of its stages is added to the metrics of
+    the endpoint and of the model used, and, if API_HISTORY_RECORD_STAGES is
+    set, stored with the record.
+
     Returns:
     - The unmodified response object, ensuring that the logging operation does
       not interfere with the response sent back to the client.
     """
-    # Connect to the SQLite database
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    # Insert the new model's details
-    cursor.execute(
-        """
-            INSERT INTO api_history (api, request, response)
-            VALUES (?, ?, ?)
-        """,
-        (request.path, json.dumps(request.json), json.dumps(response.json)),
-    )
+    if request.endpoint in UNTRACKED_ENDPOINTS:
+        return response
 
-    # Commit and close
-    conn.commit()
-    conn.close()
+    # Endpoints with large payloads can store a summary of the request and of
+    # the response instead of the full data
+    if "api_history_request" in g:
+        request_data = g.api_history_request
+    else:
+        request_data = request.get_json(silent=True)
+    if "api_history_response" in g:
+        response_text = json.dumps(g.api_history_response)
+    elif response.is_json:
+        response_text = response.get_data(as_text=True).strip()
+    else:
+        response_text = json.dumps(None)
+    stages = g.get("stages", {})
+    model_name, model_version = g.get("metrics_model", (None, None))
+    duration = time.perf_counter() - g.get("request_started", time.perf_counter())
+    with stage("history"):
+        history_writer.submit(
+            request.path,
+            request_data,
+            response_text,
+            dict(stages) if API_HISTORY_RECORD_STAGES else None,
+            model_name=model_name,
+            model_version=model_version,
+            status=response.status_code,
+            duration=duration,
+        )
+
+    api_metrics.observe_request(
+        request.path,
+        model_name,
+        model_version,
+        response.status_code,
+        duration,
+        stages,
+    )
     return response
 
 
@@ -75,27 +143,165 @@ def predict_diamond_price():
         "model_version": "model_version_here"
     }
 
+    If "model_name" is not given the promoted model is used, see the --promote
+    option of train_new_model.py.
+
+    With PREDICTION_CACHE_ENABLED the prices of the diamonds already predicted by
+    the same model version are returned from the prediction cache, without
+    validating and predicting them again.
+
     Returns:
         JSON response containing the predicted price or an error message.
     """
     input_data = request.json.get("data")
-    model_name = request.json.get("model_name")
-    model_version = request.json.get("model_version")
+    model_name, model_version = resolve_model_name(
+        request.json.get("model_name"), request.json.get("model_version")
+    )
 
-    valid_input, message = check_data_correctness(input_data)
+    keys = None
+    resolved = None
+    if PREDICTION_CACHE_ENABLED and isinstance(input_data, list) and input_data:
+        with stage("prediction_cache"):
+            keys = [diamond_key(diamond) for diamond in input_data]
+        # Only diamonds that have been validated are cached, so the request is
+        # answered from the cache only if all its diamonds are found
+        if all(key is not None for key in keys):
+            resolved = resolve_model(model_name, model_version)
+        if resolved is not None:
+            version = resolved[0]
+            with stage("prediction_cache"):
+                if not model_version:
+                    prediction_cache.set_latest(model_name, version)
+                signature = model_cache.signature(model_name, version)
+                prices = prediction_cache.get_many(model_name, version, signature, keys)
+            if prices is not None:
+                g.metrics_model = (model_name, version)
+                with stage("serialization"):
+                    return jsonify({"result": prices}), 200
+
+    with stage("validation"):
+        valid_input, message = check_data_correctness(input_data)
     if not valid_input:
         return jsonify({"error": message}), 400
+    if not input_data:
+        return jsonify({"error": "'data' must contain a diamond"}), 400
+
+    if resolved is None:
+        resolved = resolve_model(model_name, model_version)
+    if resolved is None:
+        return jsonify({"error": "Model not found. Read the documentation to train a new model or check model name and version"}), 404
+    version, model = resolved
+    g.metrics_model = (model_name, version)
+
+    if MICRO_BATCHING_ENABLED:
+        input_data = pd.DataFrame(input_data, columns=FEATURE_COLUMNS)
+        prediction = micro_batcher.predict((model_name, version), model, input_data)
+    elif len(input_data) == 1:
+        # A single diamond is predicted without building a DataFrame
+        prediction = model.predict_row(input_data[0])
+    else:
+        input_data = pd.DataFrame(input_data, columns=FEATURE_COLUMNS)
+        prediction = model.execution_pipeline(input_data)
+    if keys is not None:
+        with stage("prediction_cache"):
+            if not model_version:
+                prediction_cache.set_latest(model_name, version)
+            signature = model_cache.signature(model_name, version)
+            # Models whose file is missing are not cached, nor are their prices
+            if signature is not None:
+                prediction_cache.put_many(model_name, version, signature, keys, prediction)
+    with stage("serialization"):
+        return jsonify({"result": prediction.tolist()}), 200
 
 
-    path = get_model_pickle_path(model_name, model_version)
-    if path is None:
+@api_bp.route("/predict_price_batch", methods=['POST'])
+def predict_diamond_price_batch():
+    """
+    Predict the price of a batch of diamonds given in columnar form.
+
+    This endpoint is meant to score many diamonds at once: the characteristics
+    are given as one list per feature, all the valid diamonds are predicted with
+    a single call to the model and the prices are returned as a list in the same
+    order. Only a summary of the request and of the response is stored in the
+    api history.
+
+    The input JSON should have the following format:
+    {
+        "data": {
+            "carat": [values],
+            "cut": [texts],
+            "color": [texts],
+            "clarity": [texts],
+            "depth": [values],
+            "table": [values],
+            "x": [values],
+            "y": [values],
+            "z": [values]
+        },
+        "model_name": "model_name_here",
+        "model_version": "model_version_here",
+        "report_errors": true/false
+    }
+
+    If "model_name" is not given the promoted model is used, see the --promote
+    option of train_new_model.py.
+
+    If "report_errors" is true the invalid diamonds get a null price and are
+    listed in the "errors" field of the response together with the reason;
+    otherwise (default) the whole batch is rejected at the first invalid diamond.
+
+    Returns:
+        JSON response {"result": {"price": [values]}, "errors": [{"row": index, "error": text}]}
+        or an error message.
+    """
+    input_data = request.json.get("data")
+    model_name, model_version = resolve_model_name(
+        request.json.get("model_name"), request.json.get("model_version")
+    )
+    report_errors = bool(request.json.get("report_errors", False))
+
+    if not isinstance(input_data, dict) or not all(
+        isinstance(input_data.get(column), list) for column in FEATURE_COLUMNS
+    ):
+        return jsonify({"error": "Missing required columns"}), 400
+    num_rows = len(input_data["carat"])
+    if any(len(input_data[column]) != num_rows for column in FEATURE_COLUMNS):
+        return jsonify({"error": "All the columns must have the same length"}), 400
+    g.api_history_request = {
+        "model_name": model_name,
+        "model_version": model_version,
+        "num_rows": num_rows,
+    }
+
+    resolved = resolve_model(model_name, model_version)
+    if resolved is None:
         return jsonify({"error": "Model not found. Read the documentation to train a new model or check model name and version"}), 404
-    model = load_model(path)
+    version, model = resolved
+    g.metrics_model = (model_name, version)
 
+    with stage("validation"):
+        input_data = pd.DataFrame({column: input_data[column] for column in FEATURE_COLUMNS})
+        valid, row_errors = validate_frame(input_data)
+    if not report_errors and not valid.all():
+        row = int(np.argmin(valid))
+        return jsonify({"error": f"Row {row}: {row_errors[row]}"}), 400
+    errors = [
+        {"row": int(row), "error": row_errors[row]} for row in np.flatnonzero(~valid)
+    ]
 
-    input_data = pd.DataFrame(input_data)
-    prediction = model.execution_pipeline(input_data)
-    return jsonify({"result": prediction.tolist()}), 200
+    prices = [None] * num_rows
+    if valid.any():
+        valid_rows = np.flatnonzero(valid)
+        input_data = input_data.iloc[valid_rows].astype(
+            {column: float for column in NUMERICAL_COLUMNS}
+        ).reset_index(drop=True)
+        prediction = model.execution_pipeline(input_data)
+        for row, price in zip(valid_rows.tolist(), prediction.tolist()):
+            prices[row] = price
+
+    g.api_history_response = {"num_rows": num_rows, "num_errors": len(errors)}
+    with stage("serialization"):
+        return jsonify({"result": {"price": prices}, "errors": errors}), 200
 
 
 @api_bp.route("/similar_diamonds", methods=['POST'])
@@ -107,6 +313,14 @@ def find_similar_diamonds():
     and the number of similar diamonds to find. It returns a list of similar diamonds
     based on the specified characteristics.
 
+    With the "carat" mode the diamonds with the same cut, color and clarity are
+    ranked by carat difference. With the "features" mode the diamonds are ranked
+    by the distance over the standardized carat, depth, table, x, y and z,
+    computed with a nearest neighbour tree: "metric" selects the distance,
+    "use_grades" adds the ordinal codes of cut, color and clarity to the
+    characteristics and "same_grades" keeps only the diamonds with the same cut,
+    color and clarity.
+
     The input JSON should have the following format:
     {
         "data": {
@@ -120,40 +334,214 @@ def find_similar_diamonds():
             "y": "value",
             "z": "value"
         },
-        "num_similar_diamonds": integer_value
+        "num_similar_diamonds": integer_value,
+        "mode": "carat" | "features" (optional),
+        "metric": "euclidean" | "manhattan" | "chebyshev" (optional),
+        "use_grades": boolean (optional, default false),
+        "same_grades": boolean (optional, default false)
     }
 
     Returns:
-        JSON response containing a list of similar diamonds or an error message.
+        JSON response containing a list of similar diamonds, each one followed by
+        its carat difference or distance, or an error message.
     """
 
     input_data = request.json.get("data")
     num_similar_diamonds = request.json.get("num_similar_diamonds")
 
-    data = load_df(DEFAULT_DATASET)
-
-    valid_input, message = check_data_correctness(input_data)
+    with stage("validation"):
+        valid_input, message = check_data_correctness(input_data)
     if not valid_input:
         return jsonify({"error": message}), 400
+    if not input_data:
+        return jsonify({"error": "'data' must contain a diamond"}), 400
+    if (
+        not isinstance(num_similar_diamonds, int)
+        or isinstance(num_similar_diamonds, bool)
+        or num_similar_diamonds < 0
+    ):
+        return jsonify({"error": "'num_similar_diamonds' must be a non negative integer"}), 400
+    mode = request.json.get("mode", SIMILARITY_DEFAULT_MODE)
+    metric = request.json.get("metric", SIMILARITY_DEFAULT_METRIC)
+    if mode not in ("carat", "features"):
+        return jsonify({"error": "'mode' must be 'carat' or 'features'"}), 400
+    if metric not in METRICS:
+        return jsonify({"error": f"'metric' must be one of {', '.join(METRICS)}"}), 400
 
-    input_data = pd.DataFrame(input_data)
-    data_same_characteristics = data.loc[
-        (data["cut"] == input_data["cut"].values[0])
-        & (data["color"] == input_data["color"].values[0])
-        & (data["clarity"] == input_data["clarity"].values[0])
-    ].copy()  # Make a copy to avoid SettingWithCopyWarning
-
-    data_same_characteristics["carat difference"] = (
-        data_same_characteristics["carat"] - input_data["carat"].values[0]
-    ).abs()
-    data_same_characteristics.sort_values("carat difference", inplace=True)
-    if len(data_same_characteristics) <= num_similar_diamonds:
-        return jsonify({"result": data_same_characteristics.values.tolist()})
-    else:
-        return jsonify(
+    diamond = input_data[0]
+    with stage("similarity_search"):
+        if mode == "carat":
+            similar_diamonds = similar_diamonds_index.query(
+                diamond["cut"],
+                diamond["color"],
+                diamond["clarity"],
+                float(diamond["carat"]),
+                num_similar_diamonds,
+            )
+        else:
+            similar_diamonds = similar_diamonds_index.query_features(
+                diamond,
+                num_similar_diamonds,
+                metric=metric,
+                use_grades=bool(request.json.get("use_grades", False)),
+                same_grades=bool(request.json.get("same_grades", False)),
+            )
+    with stage("serialization"):
+        return jsonify({"result": similar_diamonds})
+
+
+@api_bp.route("/stats", methods=['GET'])
+def get_stats():
+    """
+    Return the statistics of the in-process caches of the application.
+
+    Returns:
+        JSON response containing, for the model cache, the number of hits and
+        misses, the hit ratio, the number of evictions and the cached models;
+        for the api history writer, the number of queued, stored and discarded
+        records; for the micro-batching, the number of batches and the average
+        latency for every batch size; for the prediction cache, the number of
+        hits and misses, the hit ratio and the cached prices; for the model watcher, the served version
+        of every model and the number of reloaded and retired versions.
+    """
+    return (
+        jsonify(
             {
-                "result": data_same_characteristics.iloc[
-                    :num_similar_diamonds
-                ].values.tolist()
+                "model_cache": model_cache.stats(),
+                "api_history": history_writer.stats(),
+                "micro_batching": micro_batcher.stats(),
+                "prediction_cache": prediction_cache.stats(),
+                "model_watcher": model_watcher.stats(),
             }
-        )
+        ),
+        200,
+    )
+
+
+@api_bp.route("/metrics", methods=['GET'])
+def get_metrics():
+    """
+    Return the metrics of the application in the Prometheus text format.
+
+    The metrics are the histograms of the duration of the requests and of their
+    stages (validation, model_lookup, model_load, preprocessing, predict,
+    postprocessing, batch_wait, prediction_cache, similarity_search,
+    serialization, history), by endpoint and model, and the counters of the
+    model cache, of the prediction cache and of the api history writer. The
+    requests to this endpoint are not measured.
+
+    Returns:
+        Text response with the metrics of the process serving the request.
+    """
+    cache_stats = model_cache.stats()
+    history_stats = history_writer.stats()
+    prediction_stats = prediction_cache.stats()
+    lines = api_metrics.render()
+    lines += render_samples(
+        "diamonds_model_cache_requests_total",
+        "counter",
+        "Requests of a model to the model cache.",
+        [({"result": "hit"}, cache_stats["hits"]), ({"result": "miss"}, cache_stats["misses"])],
+    )
+    lines += render_samples(
+        "diamonds_model_cache_evictions_total",
+        "counter",
+        "Models evicted from the model cache.",
+        [({}, cache_stats["evictions"])],
+    )
+    lines += render_samples(
+        "diamonds_prediction_cache_requests_total",
+        "counter",
+        "Requests looked up in the prediction cache.",
+        [
+            ({"result": "hit"}, prediction_stats["hits"]),
+            ({"result": "miss"}, prediction_stats["misses"]),
+        ],
+    )
+    lines += render_samples(
+        "diamonds_prediction_cache_entries",
+        "gauge",
+        "Prices stored in the prediction cache.",
+        [({}, prediction_stats["size"])],
+    )
+    lines += render_samples(
+        "diamonds_api_history_records_total",
+        "counter",
+        "Records of the api history by outcome.",
+        [
+            ({"outcome": outcome}, history_stats[outcome])
+            for outcome in ("written", "dropped", "failed")
+        ],
+    )
+    lines += render_samples(
+        "diamonds_api_history_queued",
+        "gauge",
+        "Records of the api history waiting to be stored.",
+        [({}, history_stats["queued"])],
+    )
+    return Response(
+        "\n".join(lines) + "\n", content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@api_bp.route("/history", methods=['GET'])
+def get_history():
+    """
+    Return a page of the api history, newest records first.
+
+    Query parameters (all optional):
+    - api: Only the records of this endpoint, for example /predict_price.
+    - since, until: Only the records created in [since, until), as
+      "YYYY-MM-DD HH:MM:SS" UTC timestamps or prefixes (for example 2024-07-01).
+    - before_id: Only the records older than this id, the "next_before_id" of
+      the previous page.
+    - limit: The number of records of the page, 100 by default, at most 1000.
+
+    Returns:
+        JSON response containing the records of the page, with the request, the
+        response and the stages decoded, and the "next_before_id" of the next
+        page, null for the last page. The requests to this endpoint are not
+        stored in the history.
+    """
+    try:
+        before_id = request.args.get("before_id", type=int)
+        limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "'before_id' and 'limit' must be integers"}), 400
+    page = query_history(
+        get_db(),
+        api=request.args.get("api"),
+        since=request.args.get("since"),
+        until=request.args.get("until"),
+        before_id=before_id,
+        limit=limit,
+    )
+    return jsonify({"result": page["records"], "next_before_id": page["next_before_id"]}), 200
+
+
+@api_bp.route("/history/hourly", methods=['GET'])
+def get_history_hourly():
+    """
+    Return the hourly aggregates of the api history records removed by the retention.
+
+    Query parameters (all optional): api, model_name, and since and until to
+    select the hours in [since, until).
+
+    Returns:
+        JSON response containing, for every hour, endpoint and model version,
+        the number of requests and errors and the mean and maximum duration.
+    """
+    return (
+        jsonify(
+            {
+                "result": query_hourly(
+                    get_db(),
+                    api=request.args.get("api"),
+                    model_name=request.args.get("model_name"),
+                    since=request.args.get("since"),
+                    until=request.args.get("until"),
+                )
+            }
+        ),
+        200,
+    )
@@ -1,8 +1,20 @@
+import json
 import sqlite3
 
 import click
 from flask import current_app, g
 from app.utils import delete_all_models_pickle_file
+from app.history_store import (
+    query_history,
+    rollup_and_prune,
+    enable_incremental_vacuum,
+    DEFAULT_PAGE_SIZE,
+)
+from setting import (
+    API_HISTORY_RETENTION_DAYS,
+    API_HISTORY_RETENTION_CHUNK_ROWS,
+    API_HISTORY_VACUUM_CHUNK_PAGES,
+)
 
 
 def get_db():
@@ -27,6 +39,95 @@ def init_db():
 
     with current_app.open_resource("schema.sql") as f:
         db.executescript(f.read().decode("utf8"))
+    # The tables are empty, so changing the vacuum mode is cheap
+    enable_incremental_vacuum(db)
+
+
+def upgrade_db():
+    """
+    Apply to an already initialized database the schema changes introduced after
+    its creation. Every statement is idempotent, so the upgrade can run at each
+    start of the application.
+    """
+    db = get_db()
+    initialized = db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'models_history'"
+    ).fetchone()
+    if initialized is None:
+        return
+
+    unique_index = {
+        row[1]: row[2] for row in db.execute("PRAGMA index_list(models_history)")
+    }.get("idx_models_history_name_version")
+    if not unique_index:
+        db.execute("DROP INDEX IF EXISTS idx_models_history_name_version")
+        try:
+            db.execute(
+                """
+                CREATE UNIQUE INDEX idx_models_history_name_version
+                ON models_history (model_name, model_version)
+                """
+            )
+        except sqlite3.IntegrityError:
+            # Versions saved twice by concurrent trainings before the upgrade
+            print(
+                "Duplicated model versions in models_history, the unique index "
+                "of the versions has not been created"
+            )
+            db.execute(
+                """
+                CREATE INDEX idx_models_history_name_version
+                ON models_history (model_name, model_version)
+                """
+            )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS promoted_model (
+          id INTEGER PRIMARY KEY CHECK (id = 1),
+          model_name TEXT NOT NULL,
+          model_version INTEGER NOT NULL,
+          metrics TEXT NOT NULL,
+          promoted TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+    api_history_columns = [row[1] for row in db.execute("PRAGMA table_info(api_history)")]
+    if api_history_columns:
+        for column, column_type in (
+            ("stages", "TEXT"),
+            ("model_name", "TEXT"),
+            ("model_version", "INTEGER"),
+            ("status", "INTEGER"),
+            ("duration", "REAL"),
+        ):
+            if column not in api_history_columns:
+                db.execute(f"ALTER TABLE api_history ADD COLUMN {column} {column_type}")
+        db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_api_history_created ON api_history (created)"
+        )
+        db.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_api_history_api_created
+            ON api_history (api, created)
+            """
+        )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS api_history_hourly (
+          hour TEXT NOT NULL,
+          api TEXT NOT NULL,
+          model_name TEXT NOT NULL DEFAULT '',
+          model_version INTEGER NOT NULL DEFAULT 0,
+          requests INTEGER NOT NULL,
+          errors INTEGER NOT NULL,
+          timed_requests INTEGER NOT NULL,
+          total_duration REAL NOT NULL,
+          max_duration REAL NOT NULL,
+          PRIMARY KEY (hour, api, model_name, model_version)
+        )
+        """
+    )
+    db.commit()
 
 
 @click.command("init-db")
@@ -34,9 +135,65 @@ def init_db_command():
     """Clear the existing data and create new tables."""
     init_db()
     delete_all_models_pickle_file()
+    # The running servers reload the models whose file has changed, see ModelCache
     click.echo("Initialized the database.")
 
 
+@click.group("history")
+def history_command():
+    """Query and clean the api history."""
+
+
+@history_command.command("list")
+@click.option("--api", default=None, help="Only the records of this endpoint.")
+@click.option("--since", default=None, help="Only the records created from this UTC time.")
+@click.option("--until", default=None, help="Only the records created before this UTC time.")
+@click.option("--before-id", type=int, default=None, help="Only the records older than this id.")
+@click.option("--limit", type=int, default=DEFAULT_PAGE_SIZE, help="Number of records.")
+def history_list_command(api, since, until, before_id, limit):
+    """Print a page of the api history as JSON lines, newest first."""
+    page = query_history(
+        get_db(), api=api, since=since, until=until, before_id=before_id, limit=limit
+    )
+    for record in page["records"]:
+        click.echo(json.dumps(record))
+    if page["next_before_id"] is not None:
+        click.echo(f"Next page: --before-id {page['next_before_id']}", err=True)
+
+
+@history_command.command("prune")
+@click.option(
+    "--days",
+    type=float,
+    default=API_HISTORY_RETENTION_DAYS,
+    help="Roll up and delete the records older than this number of days.",
+)
+@click.option("--chunk-rows", type=int, default=API_HISTORY_RETENTION_CHUNK_ROWS)
+@click.option("--vacuum-pages", type=int, default=API_HISTORY_VACUUM_CHUNK_PAGES)
+@click.option(
+    "--enable-incremental-vacuum",
+    "switch_vacuum_mode",
+    is_flag=True,
+    help="Switch the database to incremental vacuum first, rewriting the whole file once.",
+)
+def history_prune_command(days, chunk_rows, vacuum_pages, switch_vacuum_mode):
+    """Roll up into hourly aggregates and delete the old api history records."""
+    if days is None:
+        raise click.UsageError("Give --days or set API_HISTORY_RETENTION_DAYS in setting.py")
+    conn = sqlite3.connect(current_app.config["DATABASE"], timeout=30, isolation_level=None)
+    try:
+        if switch_vacuum_mode and enable_incremental_vacuum(conn):
+            click.echo("Enabled incremental vacuum.")
+        result = rollup_and_prune(conn, days, chunk_rows, vacuum_pages)
+    finally:
+        conn.close()
+    click.echo(f"Pruned {result['pruned']} records, freed {result['vacuumed']} pages.")
+
+
 def init_app(app):
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(history_command)
+
+    with app.app_context():
+        upgrade_db()
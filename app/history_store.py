@@ -0,0 +1,303 @@
+"""In this file are implemented the encoding, the queries and the retention of the
+api_history table.
+
+Payloads: the request and the response of a record are stored as JSON text, or,
+when longer than a threshold, as zlib compressed JSON in a BLOB. Both forms can
+be found in the same table and are told apart by their type.
+
+Queries: the records are read page by page with keyset pagination on the id,
+newest first, optionally filtered by endpoint and creation time, that are
+indexed.
+
+Retention: the records older than the retention period are rolled up into the
+api_history_hourly table, one row per hour, endpoint and model with the number
+of requests and errors and the total and maximum duration (of the records that
+have one, the ones stored before the duration was recorded don't), and deleted.
+The records are processed in chunks of ids, each one in its own write transaction,
+so the writers of the history wait at most for one chunk; two processes running
+the retention at the same time don't count a record twice. When the database
+uses incremental auto vacuum, the freed pages are then returned to the file
+system in chunks as well.
+"""
+
+import json
+import sqlite3
+import zlib
+
+# Page size of the history queries when not given, and maximum
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# SQLite value of PRAGMA auto_vacuum for the incremental mode
+INCREMENTAL_AUTO_VACUUM = 2
+
+
+def encode_payload(text: str, min_compress_bytes):
+    """
+    Return the value stored for a request or response JSON text.
+
+    Parameters:
+    - text (str): The JSON text.
+    - min_compress_bytes (int): Texts of at least this size are compressed, if
+        None the texts are never compressed.
+
+    Returns:
+    - str or bytes: The text, or its zlib compression if smaller.
+    """
+    if min_compress_bytes is None or text is None:
+        return text
+    data = text.encode()
+    if len(data) < min_compress_bytes:
+        return text
+    compressed = zlib.compress(data)
+    return compressed if len(compressed) < len(data) else text
+
+
+def decode_payload(value):
+    """Return the JSON text of a value stored by encode_payload."""
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode()
+    return value
+
+
+def _loads(value):
+    text = decode_payload(value)
+    if text is None:
+        return None
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def query_history(
+    conn: sqlite3.Connection,
+    api: str = None,
+    since: str = None,
+    until: str = None,
+    before_id: int = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+) -> dict:
+    """
+    Read a page of the api history, newest records first.
+
+    Parameters:
+    - conn (sqlite3.Connection): Connection to the database.
+    - api (str, optional): Only the records of this endpoint.
+    - since (str, optional), until (str, optional): Only the records created in
+        [since, until), as "YYYY-MM-DD HH:MM:SS" UTC timestamps or prefixes.
+    - before_id (int, optional): Only the records with a lower id, the
+        "next_before_id" of the previous page.
+    - limit (int): The number of records of the page, at most MAX_PAGE_SIZE.
+
+    Returns:
+    - dict: The "records" of the page, with decoded request, response and
+      stages, and the "next_before_id" to give to get the next page, None for
+      the last page.
+    """
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    conditions = []
+    parameters = []
+    for condition, value in (
+        ("api = ?", api),
+        ("created >= ?", since),
+        ("created < ?", until),
+        ("id < ?", before_id),
+    ):
+        if value is not None:
+            conditions.append(condition)
+            parameters.append(value)
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    rows = conn.execute(
+        f"""
+        SELECT id, created, api, request, response, stages, model_name,
+            model_version, status, duration
+        FROM api_history
+        {where}
+        ORDER BY id DESC
+        LIMIT ?
+        """,
+        parameters + [limit + 1],
+    ).fetchall()
+
+    records = [
+        {
+            "id": row[0],
+            "created": str(row[1]),
+            "api": row[2],
+            "request": _loads(row[3]),
+            "response": _loads(row[4]),
+            "stages": _loads(row[5]),
+            "model_name": row[6],
+            "model_version": row[7],
+            "status": row[8],
+            "duration": row[9],
+        }
+        for row in rows[:limit]
+    ]
+    next_before_id = records[-1]["id"] if len(rows) > limit else None
+    return {"records": records, "next_before_id": next_before_id}
+
+
+def query_hourly(
+    conn: sqlite3.Connection,
+    api: str = None,
+    model_name: str = None,
+    since: str = None,
+    until: str = None,
+) -> list:
+    """
+    Read the hourly rollups of the api history, oldest hour first.
+
+    Parameters:
+    - conn (sqlite3.Connection): Connection to the database.
+    - api (str, optional), model_name (str, optional): Only the rollups of this
+        endpoint and model.
+    - since (str, optional), until (str, optional): Only the hours in [since, until).
+
+    Returns:
+    - list: One dict for every hour, endpoint and model version.
+    """
+    conditions = []
+    parameters = []
+    for condition, value in (
+        ("api = ?", api),
+        ("model_name = ?", model_name),
+        ("hour >= ?", since),
+        ("hour < ?", until),
+    ):
+        if value is not None:
+            conditions.append(condition)
+            parameters.append(value)
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    rows = conn.execute(
+        f"""
+        SELECT hour, api, model_name, model_version, requests, errors,
+            timed_requests, total_duration, max_duration
+        FROM api_history_hourly
+        {where}
+        ORDER BY hour, api, model_name, model_version
+        """,
+        parameters,
+    ).fetchall()
+    return [
+        {
+            "hour": row[0],
+            "api": row[1],
+            "model_name": row[2] or None,
+            "model_version": row[3] or None,
+            "requests": row[4],
+            "errors": row[5],
+            "mean_duration": row[7] / row[6] if row[6] else None,
+            "max_duration": row[8] if row[6] else None,
+        }
+        for row in rows
+    ]
+
+
+def rollup_and_prune(
+    conn: sqlite3.Connection, retention_days: float, chunk_rows: int, vacuum_pages: int
+) -> dict:
+    """
+    Roll up into api_history_hourly and delete the records older than the
+    retention period, then free the unused pages of the database file.
+
+    Parameters:
+    - conn (sqlite3.Connection): Connection to the database, in autocommit mode
+        or without an open transaction.
+    - retention_days (float): The records older than this number of days are
+        rolled up and deleted.
+    - chunk_rows (int): The number of records processed by every transaction.
+    - vacuum_pages (int): The number of free pages returned to the file system
+        by every incremental vacuum step.
+
+    Returns:
+    - dict: The number of "pruned" records and of "vacuumed" pages.
+    """
+    cutoff = conn.execute(
+        "SELECT datetime('now', ?)", (f"-{float(retention_days)} days",)
+    ).fetchone()[0]
+    pruned = 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # The chunk is selected inside the write transaction, so that another
+            # process pruning at the same time can't select the same records
+            last_id = conn.execute(
+                """
+                SELECT MAX(id) FROM (
+                    SELECT id FROM api_history WHERE created < ? ORDER BY id LIMIT ?
+                )
+                """,
+                (cutoff, chunk_rows),
+            ).fetchone()[0]
+            if last_id is None:
+                conn.execute("COMMIT")
+                break
+            conn.execute(
+                """
+                INSERT INTO api_history_hourly (
+                    hour, api, model_name, model_version, requests, errors,
+                    timed_requests, total_duration, max_duration
+                )
+                SELECT strftime('%Y-%m-%d %H:00:00', created), api,
+                    COALESCE(model_name, ''), COALESCE(model_version, 0), COUNT(*),
+                    SUM(COALESCE(status, 200) >= 400), COUNT(duration),
+                    COALESCE(SUM(duration), 0), COALESCE(MAX(duration), 0)
+                FROM api_history
+                WHERE id <= ? AND created < ?
+                GROUP BY 1, 2, 3, 4
+                ON CONFLICT (hour, api, model_name, model_version) DO UPDATE SET
+                    requests = requests + excluded.requests,
+                    errors = errors + excluded.errors,
+                    timed_requests = timed_requests + excluded.timed_requests,
+                    total_duration = total_duration + excluded.total_duration,
+                    max_duration = MAX(max_duration, excluded.max_duration)
+                """,
+                (last_id, cutoff),
+            )
+            deleted = conn.execute(
+                "DELETE FROM api_history WHERE id <= ? AND created < ?", (last_id, cutoff)
+            ).rowcount
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        pruned += deleted
+    return {"pruned": pruned, "vacuumed": incremental_vacuum(conn, vacuum_pages)}
+
+
+def incremental_vacuum(conn: sqlite3.Connection, vacuum_pages: int) -> int:
+    """
+    Return the free pages of the database to the file system, `vacuum_pages` at a
+    time. Does nothing if the database doesn't use incremental auto vacuum, see
+    enable_incremental_vacuum.
+
+    Returns:
+    - int: The number of freed pages.
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != INCREMENTAL_AUTO_VACUUM:
+        return 0
+    vacuumed = 0
+    while True:
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free_pages == 0:
+            return vacuumed
+        step = min(free_pages, vacuum_pages)
+        conn.execute(f"PRAGMA incremental_vacuum({int(step)})").fetchall()
+        vacuumed += step
+
+
+def enable_incremental_vacuum(conn: sqlite3.Connection) -> bool:
+    """
+    Switch the database to incremental auto vacuum. The databases created before
+    need a full VACUUM to change mode, that rewrites the whole file.
+
+    Returns:
+    - bool: True if the mode has been changed, False if it was already enabled.
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == INCREMENTAL_AUTO_VACUUM:
+        return False
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    return True
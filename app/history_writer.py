@@ -0,0 +1,279 @@
+"""In this file is implemented the asynchronous writer of the api_history table.
+
+Storing the history in the request path means an insert and a commit (so a disk
+sync) for every request, and every worker waiting for the SQLite write lock.
+The writer moves this work to a background thread: requests only put their
+record in a bounded in-memory queue, the thread collects the queued records and
+stores them with a single executemany transaction.
+
+When the queue is full (the database can't keep up with the traffic) the
+records are handled following the overflow policy:
+- "drop": the new record is discarded.
+- "block": the request waits for a free slot up to `block_timeout` seconds, then
+  the record is discarded.
+- "sample": once the queue is half full only one record every `sample_rate` is
+  queued, the others are discarded; when the queue is full the record is
+  discarded.
+"""
+
+import atexit
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from app.history_store import encode_payload, rollup_and_prune
+
+OVERFLOW_POLICIES = ("drop", "block", "sample")
+
+
+class ApiHistoryWriter:
+    """Background writer that stores the api_history records in batches."""
+
+    def __init__(
+        self,
+        db_path: str,
+        max_queue_size: int,
+        batch_size: int,
+        flush_interval: float,
+        overflow_policy: str = "drop",
+        sample_rate: int = 10,
+        block_timeout: float = 1.0,
+        compress_min_bytes: int = None,
+        retention_days: float = None,
+        retention_interval: float = 3600.0,
+        retention_chunk_rows: int = 5000,
+        vacuum_chunk_pages: int = 1000,
+    ):
+        """
+        Parameters:
+        - db_path (str): Path of the SQLite database containing api_history.
+        - max_queue_size (int): Maximum number of records waiting to be stored.
+        - batch_size (int): Maximum number of records stored in one transaction.
+        - flush_interval (float): Maximum number of seconds a record waits in the
+            queue before being stored.
+        - overflow_policy (str): What to do when the queue is full, one of
+            "drop", "block" or "sample".
+        - sample_rate (int): With the "sample" policy, one record every
+            sample_rate is kept when the queue is half full.
+        - block_timeout (float): With the "block" policy, maximum number of
+            seconds a request waits for a free slot.
+        - compress_min_bytes (int, optional): Requests and responses of at least
+            this size are stored compressed, if None they are never compressed.
+        - retention_days (float, optional): The writer thread rolls up and
+            deletes the records older than this number of days, every
+            retention_interval seconds. If None the records are kept.
+        - retention_chunk_rows (int), vacuum_chunk_pages (int): The records
+            deleted and the pages vacuumed by every step of the retention.
+        """
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"Overflow policy must be one of {OVERFLOW_POLICIES}, got {overflow_policy}"
+            )
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        self.sample_rate = sample_rate
+        self.block_timeout = block_timeout
+        self.compress_min_bytes = compress_min_bytes
+        self.retention_days = retention_days
+        self.retention_interval = retention_interval
+        self.retention_chunk_rows = retention_chunk_rows
+        self.vacuum_chunk_pages = vacuum_chunk_pages
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        self._stop = threading.Event()
+        self._sample_counter = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self.pruned = 0
+        atexit.register(self.close)
+
+    def _ensure_started(self) -> None:
+        # Threads don't survive a fork: the writer thread is started lazily by
+        # the first record submitted in each process
+        if self._thread is not None and self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread_pid == os.getpid():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="api-history-writer", daemon=True
+            )
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def submit(
+        self,
+        api: str,
+        request_data,
+        response_text: str,
+        stages: dict = None,
+        model_name: str = None,
+        model_version: int = None,
+        status: int = None,
+        duration: float = None,
+    ) -> bool:
+        """
+        Queue a record to be stored in the api_history table.
+
+        Parameters:
+        - api (str): The API endpoint (path).
+        - request_data: The JSON payload of the request, serialized by the writer thread.
+        - response_text (str): The JSON text of the response.
+        - stages (dict, optional): The seconds spent in every stage of the request.
+        - model_name (str, optional), model_version (int, optional): The model
+            used by the request.
+        - status (int, optional): The HTTP status of the response.
+        - duration (float, optional): The seconds spent serving the request.
+
+        Returns:
+        - bool: True if the record has been queued, False if it has been discarded
+          following the overflow policy.
+        """
+        self._ensure_started()
+        record = (
+            api, request_data, response_text, stages, model_name, model_version, status, duration
+        )
+
+        if self.overflow_policy == "sample" and self._queue.qsize() >= self._queue.maxsize // 2:
+            with self._lock:
+                self._sample_counter += 1
+                keep = self._sample_counter % self.sample_rate == 0
+            if not keep:
+                self._count_dropped()
+                return False
+
+        try:
+            if self.overflow_policy == "block":
+                self._queue.put(record, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(record)
+        except queue.Full:
+            self._count_dropped()
+            return False
+        return True
+
+    def _count_dropped(self) -> None:
+        with self._lock:
+            self.dropped += 1
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        # With the write-ahead log readers don't block the writer and a commit
+        # doesn't need to sync the database file
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _next_batch(self, timeout: float) -> list:
+        try:
+            batch = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, conn: sqlite3.Connection, batch: list) -> None:
+        rows = [
+            (
+                api,
+                encode_payload(json.dumps(request_data), self.compress_min_bytes),
+                encode_payload(response_text, self.compress_min_bytes),
+                None if stages is None else json.dumps(stages),
+                # model_name, model_version, status and duration
+                *columns,
+            )
+            for api, request_data, response_text, stages, *columns in batch
+        ]
+        try:
+            with conn:
+                conn.executemany(
+                    """
+                    INSERT INTO api_history (
+                        api, request, response, stages, model_name, model_version,
+                        status, duration
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    rows,
+                )
+        except sqlite3.Error as e:
+            print("Failed to store %d api_history records. Reason: %s" % (len(rows), e))
+            with self._lock:
+                self.failed += len(rows)
+        else:
+            with self._lock:
+                self.written += len(rows)
+                self.batches += 1
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def _apply_retention(self, conn: sqlite3.Connection) -> None:
+        try:
+            result = rollup_and_prune(
+                conn, self.retention_days, self.retention_chunk_rows, self.vacuum_chunk_pages
+            )
+        except sqlite3.Error as e:
+            print("Failed to apply the api_history retention. Reason: %s" % e)
+            return
+        with self._lock:
+            self.pruned += result["pruned"]
+
+    def _run(self) -> None:
+        conn = self._connect()
+        next_retention = time.monotonic()
+        try:
+            while not self._stop.is_set():
+                batch = self._next_batch(timeout=self.flush_interval)
+                if batch:
+                    self._write(conn, batch)
+                if self.retention_days is not None and time.monotonic() >= next_retention:
+                    self._apply_retention(conn)
+                    next_retention = time.monotonic() + self.retention_interval
+            # Store the records still in the queue before exiting
+            batch = self._next_batch(timeout=0)
+            while batch:
+                self._write(conn, batch)
+                batch = self._next_batch(timeout=0)
+        finally:
+            conn.close()
+
+    def flush(self) -> None:
+        """Wait until all the queued records have been stored."""
+        if self._thread is not None and self._thread_pid == os.getpid():
+            self._queue.join()
+
+    def close(self) -> None:
+        """Store the queued records and stop the writer thread."""
+        if self._thread is None or self._thread_pid != os.getpid():
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def stats(self) -> dict:
+        """Return the number of queued, stored and discarded records."""
+        with self._lock:
+            return {
+                "queued": self._queue.qsize(),
+                "max_queue_size": self._queue.maxsize,
+                "written": self.written,
+                "batches": self.batches,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "pruned": self.pruned,
+                "overflow_policy": self.overflow_policy,
+            }
@@ -0,0 +1,134 @@
+"""In this file are implemented the latency metrics of the API.
+
+Every request updates, for its endpoint and model, a histogram of the total
+duration and one histogram for each stage timed with `models.timing.stage`
+(validation, model lookup and load, preprocessing, prediction, serialization,
+...). The histograms are exposed in the Prometheus text format by the /metrics
+route. The metrics are kept in memory by each process.
+"""
+
+import threading
+from bisect import bisect_left
+
+# Upper bounds, in seconds, of the buckets of the histograms
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Prometheus histogram with a set of labels."""
+
+    def __init__(self, name: str, documentation: str, label_names: tuple, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # For every combination of labels: the count of every bucket (the last
+        # one is +Inf), the sum and the count of the observations
+        self._series = {}
+
+    def observe(self, value: float, *label_values) -> None:
+        """Add an observation to the series of the given label values."""
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list:
+        """Return the lines of the histogram in the Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted(
+                (key, (list(value[0]), value[1], value[2]))
+                for key, value in self._series.items()
+            )
+        for label_values, (bucket_counts, total, count) in series:
+            labels = dict(zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(dict(labels, le=_format_value(bound)))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+def render_samples(name: str, metric_type: str, documentation: str, samples: list) -> list:
+    """
+    Return the lines of a counter or gauge in the Prometheus text format.
+
+    Parameters:
+    - name (str): The name of the metric.
+    - metric_type (str): "counter" or "gauge".
+    - documentation (str): The description of the metric.
+    - samples (list): The (labels dict, value) pairs of the metric.
+    """
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return lines
+
+
+class ApiMetrics:
+    """Latency histograms of the API requests and of their stages."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.request_duration = Histogram(
+            "diamonds_api_request_duration_seconds",
+            "Duration of the API requests.",
+            ("endpoint", "model", "version", "status"),
+            buckets,
+        )
+        self.stage_duration = Histogram(
+            "diamonds_api_stage_duration_seconds",
+            "Duration of the stages of the API requests.",
+            ("endpoint", "model", "version", "stage"),
+            buckets,
+        )
+
+    def observe_request(
+        self, endpoint: str, model: str, version, status: int, duration: float, stages: dict
+    ) -> None:
+        """
+        Record a request.
+
+        Parameters:
+        - endpoint (str): The path of the API.
+        - model (str), version: The model used by the request, empty if none.
+        - status (int): The status code of the response.
+        - duration (float): The seconds spent serving the request.
+        - stages (dict): The seconds spent in every stage of the request.
+        """
+        model = model or ""
+        version = "" if version is None else str(version)
+        self.request_duration.observe(duration, endpoint, model, version, str(status))
+        for stage, seconds in stages.items():
+            self.stage_duration.observe(seconds, endpoint, model, version, stage)
+
+    def render(self) -> list:
+        """Return the lines of the histograms in the Prometheus text format."""
+        return self.request_duration.render() + self.stage_duration.render()
@@ -0,0 +1,153 @@
+"""In this file is implemented the micro-batching of concurrent predictions.
+
+Every call to the model has a fixed overhead, that for small requests is most of
+the prediction time. When micro-batching is enabled, the concurrent requests for
+the same model are collected for up to `max_wait_ms` milliseconds or until
+`max_batch_rows` diamonds are pending, then they are predicted with a single
+call of `execution_pipeline` on the combined DataFrame and every request gets
+back its own rows.
+
+There is no scheduler thread: the first request of a batch (the leader) waits
+for the batch to be closed and runs the prediction, the following requests
+(the followers) wait for the leader to publish the results.
+"""
+
+import threading
+import time
+import pandas as pd
+from models.timing import stage
+
+# Upper bounds of the batch size buckets of the statistics
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+class _Batch:
+    """The requests collected for the same model."""
+
+    def __init__(self):
+        self.frames = []
+        self.num_rows = 0
+        self.closed = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class MicroBatcher:
+    """Collects concurrent predictions for the same model into a single call."""
+
+    def __init__(self, max_batch_rows: int, max_wait_ms: float):
+        """
+        Parameters:
+        - max_batch_rows (int): Number of pending diamonds that closes a batch.
+            Requests with more diamonds than this are predicted alone.
+        - max_wait_ms (float): Maximum number of milliseconds the first request
+            of a batch waits for other requests.
+        """
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait_ms / 1000
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._stats = {
+            bucket: {"batches": 0, "requests": 0, "rows": 0, "wait": 0.0, "execution": 0.0}
+            for bucket in BATCH_SIZE_BUCKETS + (float("inf"),)
+        }
+
+    def predict(self, key, model, x: pd.DataFrame):
+        """
+        Predict the given diamonds together with the concurrent requests for the same model.
+
+        Parameters:
+        - key: Identifier of the model, for example (model_name, model_version).
+        - model: The model used for the prediction.
+        - x (pd.DataFrame): The diamonds to predict.
+
+        Returns:
+        - The postprocessed predictions of the given diamonds, in the same order.
+        """
+        if len(x) >= self.max_batch_rows:
+            return model.execution_pipeline(x)
+
+        enqueued = time.perf_counter()
+        with self._lock:
+            batch = self._pending.get(key)
+            leader = batch is None
+            if leader:
+                batch = _Batch()
+                self._pending[key] = batch
+            index = len(batch.frames)
+            batch.frames.append(x)
+            batch.num_rows += len(x)
+            if batch.num_rows >= self.max_batch_rows:
+                del self._pending[key]
+                batch.closed.set()
+
+        if leader:
+            self._run(key, model, batch, enqueued)
+        else:
+            with stage("batch_wait"):
+                batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[index]
+
+    def _run(self, key, model, batch: _Batch, enqueued: float) -> None:
+        with stage("batch_wait"):
+            batch.closed.wait(timeout=self.max_wait)
+        with self._lock:
+            if self._pending.get(key) is batch:
+                del self._pending[key]
+        started = time.perf_counter()
+        try:
+            combined = pd.concat(batch.frames, ignore_index=True)
+            predictions = model.execution_pipeline(combined)
+            results = []
+            start = 0
+            for frame in batch.frames:
+                results.append(predictions[start : start + len(frame)])
+                start += len(frame)
+            batch.results = results
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+            self._record(batch, wait=started - enqueued, execution=time.perf_counter() - started)
+
+    def _record(self, batch: _Batch, wait: float, execution: float) -> None:
+        bucket = next(
+            (bucket for bucket in BATCH_SIZE_BUCKETS if batch.num_rows <= bucket),
+            float("inf"),
+        )
+        with self._lock:
+            stats = self._stats[bucket]
+            stats["batches"] += 1
+            stats["requests"] += len(batch.frames)
+            stats["rows"] += batch.num_rows
+            stats["wait"] += wait
+            stats["execution"] += execution
+
+    def stats(self) -> dict:
+        """
+        Return, for every batch size bucket, the number of batches, requests and
+        diamonds and the average time spent waiting for the batch to close and
+        predicting it.
+        """
+        with self._lock:
+            stats = {}
+            for bucket, bucket_stats in self._stats.items():
+                if not bucket_stats["batches"]:
+                    continue
+                batches = bucket_stats["batches"]
+                label = f"<={bucket}" if bucket != float("inf") else f">{BATCH_SIZE_BUCKETS[-1]}"
+                stats[label] = {
+                    "batches": batches,
+                    "requests": bucket_stats["requests"],
+                    "rows": bucket_stats["rows"],
+                    "avg_wait_ms": bucket_stats["wait"] / batches * 1000,
+                    "avg_execution_ms": bucket_stats["execution"] / batches * 1000,
+                }
+            return {
+                "max_batch_rows": self.max_batch_rows,
+                "max_wait_ms": self.max_wait * 1000,
+                "batch_sizes": stats,
+            }
@@ -0,0 +1,184 @@
+"""In this file is implemented the in-process cache of the loaded models.
+
+Loading a model means reading and deserializing the whole pickle file, that for
+the xgboost ensemble is by far the most expensive step of a prediction request.
+The cache keeps the already loaded models in memory, keyed by
+(model_name, model_version), and evicts the least recently used ones when the
+configured number of models or amount of memory is exceeded.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+
+class ModelCache:
+    """Bounded LRU cache of loaded models.
+
+    The memory used by a model is estimated with the size of its files on disk,
+    which is a good proxy of the size of the deserialized object and costs a
+    stat call per file.
+
+    Every entry remembers the path and the modification time of the file it was
+    loaded from: if the model registered for the same (model_name, model_version)
+    points to a different file, or the file has been rewritten (for example after
+    the database has been reinitialized and the versions restarted from 1), the
+    entry is discarded and the model is loaded again.
+
+    Pinned models (the versions served by the model watcher) are never evicted.
+    """
+
+    def __init__(self, max_items: int, max_bytes: int):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._current_bytes = 0
+        self._pinned = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _file_signature(path: str):
+        """Return the (mtime, size) of the file, or of all the files of the
+        artifact directory, or None if it doesn't exist."""
+        try:
+            stat = os.stat(path)
+            if not os.path.isdir(path):
+                return stat.st_mtime_ns, stat.st_size
+            mtime, size = stat.st_mtime_ns, 0
+            for entry in os.scandir(path):
+                entry_stat = entry.stat()
+                mtime = max(mtime, entry_stat.st_mtime_ns)
+                size += entry_stat.st_size
+            return mtime, size
+        except OSError:
+            return None
+
+    def get(self, model_name: str, model_version: int, path: str, loader):
+        """
+        Return the model for (model_name, model_version), loading it if needed.
+
+        Parameters:
+        - model_name (str): The name of the model.
+        - model_version (int): The resolved version of the model.
+        - path (str): The path of the file the model is stored in.
+        - loader (callable): Function that receives the path and returns the
+            loaded model, or None if the model can't be loaded.
+
+        Returns:
+        - The loaded model, or None if the loader fails.
+        """
+        key = (model_name, model_version)
+        signature = self._file_signature(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == path and entry[2] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+
+        # The load happens outside the lock so that requests for other models
+        # are not blocked by a slow deserialization
+        model = loader(path)
+        if model is None or signature is None:
+            return model
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (model, path, signature)
+            self._current_bytes += signature[1]
+            self._evict()
+        return model
+
+    def signature(self, model_name: str, model_version: int):
+        """Return the (path, file signature) of a cached model, that changes when
+        the version is saved again (for example after init-db), or None if the
+        model is not cached."""
+        entry = self._entries.get((model_name, model_version))
+        if entry is None:
+            return None
+        return entry[1], entry[2]
+
+    def _remove(self, key) -> None:
+        _, _, signature = self._entries.pop(key)
+        self._current_bytes -= signature[1]
+
+    def _evict(self) -> None:
+        # The most recently inserted model is always kept, even if it alone
+        # exceeds the memory budget
+        newest_key = next(reversed(self._entries), None)
+        for key in list(self._entries):
+            if not (
+                len(self._entries) > self.max_items
+                or self._current_bytes > self.max_bytes
+            ):
+                break
+            if key == newest_key or key in self._pinned:
+                continue
+            self._remove(key)
+            self.evictions += 1
+
+    def pin(self, model_name: str, model_version: int) -> None:
+        """Exclude a model from the eviction."""
+        with self._lock:
+            self._pinned.add((model_name, model_version))
+
+    def unpin(self, model_name: str, model_version: int) -> None:
+        """Make a pinned model evictable again."""
+        with self._lock:
+            self._pinned.discard((model_name, model_version))
+
+    def versions(self, model_name: str) -> list:
+        """Return the cached versions of a model."""
+        with self._lock:
+            return [key[1] for key in self._entries if key[0] == model_name]
+
+    def invalidate(self, model_name: str = None, model_version: int = None) -> None:
+        """
+        Remove models from the cache.
+
+        Parameters:
+        - model_name (str, optional): Remove only the versions of this model.
+            If not given the whole cache is cleared.
+        - model_version (int, optional): Remove only this version of the model.
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if model_name is not None and key[0] != model_name:
+                    continue
+                if model_version is not None and key[1] != model_version:
+                    continue
+                self._remove(key)
+
+    def clear(self) -> None:
+        """Remove all the models and the pins, and reset the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self._pinned.clear()
+            self._current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self) -> dict:
+        """Return the hit/miss statistics and the current occupation of the cache."""
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / requests if requests else 0.0,
+                "evictions": self.evictions,
+                "models": [list(key) for key in self._entries],
+                "pinned": [list(key) for key in self._entries if key in self._pinned],
+                "size": len(self._entries),
+                "max_size": self.max_items,
+                "bytes": self._current_bytes,
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,169 @@
+"""In this file is implemented the in-memory registry of the trained models.
+
+The registry keeps a copy of the models_history table as
+model_name -> model_version -> model_pickle_path, so that resolving the model of
+a request doesn't need a database round trip. The copy is refreshed only when
+the database content changes, detected by polling `PRAGMA data_version` on a
+long lived connection: the value changes every time another connection commits
+a transaction, so checking it costs a single pragma and no table read.
+
+The registry also keeps the promoted model of the promoted_model table, used by
+the requests that don't give a model name.
+
+A model that is not found forces a check of the database version, since it may
+have just been registered; the models still not found are remembered until the
+database changes, so repeated requests for an unknown model don't check it
+again before the poll interval.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+# Maximum number of unknown models remembered between two database changes
+MAX_MISSING_MODELS = 1024
+
+
+class ModelRegistry:
+    """In-memory copy of the registered models, refreshed on database changes."""
+
+    def __init__(self, db_path: str, poll_interval: float):
+        """
+        Parameters:
+        - db_path (str): Path of the SQLite database containing models_history.
+        - poll_interval (float): Minimum number of seconds between two checks of
+            the database version when the requested model is found in memory.
+        """
+        self.db_path = db_path
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+        self._data_version = None
+        self._last_poll = float("-inf")
+        # (model_name -> model_version -> path, model_name -> latest version,
+        # (model_name, model_version) of the promoted model or None)
+        self._state = ({}, {}, None)
+        # (model_name, model_version) not found in the current state
+        self._missing = set()
+
+    def _connection(self) -> sqlite3.Connection:
+        # A connection can't be shared with a forked process: reopen it if
+        # the registry is used by a different process than the one it was
+        # created in
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn_pid = os.getpid()
+            self._data_version = None
+        return self._conn
+
+    def refresh(self, force: bool = False) -> None:
+        """
+        Reload the registered models if the database has changed.
+
+        Parameters:
+        - force (bool): Check the database version even if the last check is
+            more recent than the poll interval.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_poll < self.poll_interval:
+            return
+        with self._lock:
+            self._last_poll = now
+            conn = None
+            try:
+                conn = self._connection()
+                data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+                if data_version == self._data_version:
+                    return
+                rows = conn.execute(
+                    """
+                    SELECT model_name, model_version, model_pickle_path
+                    FROM models_history
+                    """
+                ).fetchall()
+            except sqlite3.Error:
+                # The database has not been initialized yet
+                rows = []
+                data_version = None
+            promoted = None
+            if conn is not None:
+                try:
+                    promoted = conn.execute(
+                        "SELECT model_name, model_version FROM promoted_model"
+                    ).fetchone()
+                except sqlite3.Error:
+                    # The database has not been upgraded yet
+                    pass
+
+            versions = {}
+            for model_name, model_version, model_pickle_path in rows:
+                versions.setdefault(model_name, {})[model_version] = model_pickle_path
+            latest = {
+                name: max(model_versions) for name, model_versions in versions.items()
+            }
+            # The new state is swapped in a single assignment, readers never
+            # see a partially built registry
+            self._state = (versions, latest, tuple(promoted) if promoted else None)
+            self._missing = set()
+            self._data_version = data_version
+
+    @staticmethod
+    def _lookup(state: tuple, model_name: str, model_version: int):
+        versions, latest, _ = state
+        model_versions = versions.get(model_name)
+        if model_versions is None:
+            return None
+        if model_version is None:
+            model_version = latest[model_name]
+        path = model_versions.get(model_version)
+        if path is None:
+            return None
+        return model_version, path
+
+    def resolve(self, model_name: str, model_version=None):
+        """
+        Resolve the version and the pickle path of a registered model.
+
+        Parameters:
+        - model_name (str): The name of the model.
+        - model_version (int, optional): The version of the model. If not given the
+            latest version is returned.
+
+        Returns:
+        - (int, str): The version and the pickle path of the model, or None if the
+          model is not registered.
+        """
+        if model_version:
+            try:
+                model_version = int(model_version)
+            except (TypeError, ValueError):
+                return None
+        else:
+            model_version = None
+
+        self.refresh()
+        record = self._lookup(self._state, model_name, model_version)
+        if record is not None or (model_name, model_version) in self._missing:
+            return record
+        # The model may have been registered after the last check
+        self.refresh(force=True)
+        state = self._state
+        record = self._lookup(state, model_name, model_version)
+        if record is None:
+            with self._lock:
+                # Not remembered if the registry has been reloaded meanwhile
+                if self._state is state and len(self._missing) < MAX_MISSING_MODELS:
+                    self._missing.add((model_name, model_version))
+        return record
+
+    def latest_versions(self) -> dict:
+        """Return the latest registered version of every model."""
+        self.refresh()
+        return dict(self._state[1])
+
+    def promoted(self):
+        """Return the (model_name, model_version) of the promoted model, or None."""
+        self.refresh()
+        return self._state[2]
@@ -0,0 +1,189 @@
+"""In this file is implemented the background reload of the new model versions.
+
+Without the watcher, the first request for the latest version of a model after
+a new training pays the loading of the model. The watcher keeps, for every
+model, the version served to the requests without an explicit version: a
+background thread periodically checks the registry, loads and warms up the new
+versions off the request path and only then points the served version to them.
+The served versions are replaced with a single assignment, so a request sees
+either the old or the new version, and the requests in flight keep the model
+they have already resolved.
+
+The versions replaced by a newer one are retired from the model cache following
+the retire policy:
+- "keep_last": only the `keep_versions` most recent cached versions of the
+  model are kept, the older ones are removed as soon as the new one is served.
+- "lru": the old versions stay in the cache until evicted by its limits.
+The served versions are pinned in the model cache, so they are never evicted.
+"""
+
+import os
+import threading
+
+RETIRE_POLICIES = ("keep_last", "lru")
+
+
+class ModelWatcher:
+    """Background loader of the latest version of every registered model."""
+
+    def __init__(
+        self,
+        registry,
+        cache,
+        loader,
+        warmup,
+        interval: float,
+        retire_policy: str = "keep_last",
+        keep_versions: int = 2,
+        on_serve=None,
+    ):
+        """
+        Parameters:
+        - registry (ModelRegistry): The registry of the trained models.
+        - cache (ModelCache): The cache the models are loaded in.
+        - loader (callable): Function that receives the path of a model and
+            returns the loaded model, or None if it can't be loaded.
+        - warmup (callable): Function that receives a loaded model and runs a
+            prediction with it.
+        - interval (float): Seconds between two checks for new versions.
+        - retire_policy (str): What happens to the replaced versions, one of
+            "keep_last" or "lru".
+        - keep_versions (int): With the "keep_last" policy, the number of cached
+            versions kept for every model, the served one included.
+        - on_serve (callable, optional): Function called with the model name and
+            the version after a new version is served.
+        """
+        if retire_policy not in RETIRE_POLICIES:
+            raise ValueError(
+                f"Retire policy must be one of {RETIRE_POLICIES}, got {retire_policy}"
+            )
+        self.registry = registry
+        self.cache = cache
+        self.loader = loader
+        self.warmup = warmup
+        self.interval = interval
+        self.retire_policy = retire_policy
+        self.keep_versions = max(1, keep_versions)
+        self.on_serve = on_serve
+        # model_name -> served version, replaced and never modified in place
+        self._served = {}
+        self._lock = threading.Lock()
+        self._check_lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        self._stop = threading.Event()
+        self.checks = 0
+        self.reloads = 0
+        self.retired = 0
+        self.failures = 0
+
+    def ensure_started(self) -> None:
+        """Start the watcher thread in the current process, if not running."""
+        # Threads don't survive a fork: the thread is started by the first
+        # request served by each process
+        if self._thread is not None and self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread_pid == os.getpid():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="model-watcher", daemon=True
+            )
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the watcher thread of the current process."""
+        self._stop.set()
+        if self._thread is not None and self._thread_pid == os.getpid():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def served_version(self, model_name: str):
+        """Return the version served for the model, or None if none has been loaded yet."""
+        return self._served.get(model_name)
+
+    def check(self) -> dict:
+        """
+        Load, warm up and serve the latest registered version of every model.
+
+        Called periodically by the watcher thread, and directly to load the models
+        before serving.
+
+        Returns:
+        - dict: The served version of every model.
+        """
+        with self._check_lock:
+            self.registry.refresh(force=True)
+            for model_name, version in self.registry.latest_versions().items():
+                if self._served.get(model_name) == version:
+                    # Pinned again if the cache has been cleared
+                    self.cache.pin(model_name, version)
+                    continue
+                try:
+                    self._load(model_name, version)
+                except Exception as e:
+                    print(
+                        "Failed to load version %s of %s. Reason: %s" % (version, model_name, e)
+                    )
+                    with self._lock:
+                        self.failures += 1
+            with self._lock:
+                self.checks += 1
+            return dict(self._served)
+
+    def _load(self, model_name: str, version: int) -> None:
+        record = self.registry.resolve(model_name, version)
+        if record is None:
+            return
+        _, path = record
+        model = self.cache.get(model_name, version, path, self.loader)
+        if model is None:
+            with self._lock:
+                self.failures += 1
+            return
+        self.warmup(model)
+
+        self.cache.pin(model_name, version)
+        previous = self._served.get(model_name)
+        # Swap the served versions with a single assignment
+        self._served = {**self._served, model_name: version}
+        if self.on_serve is not None:
+            self.on_serve(model_name, version)
+        if previous is not None:
+            self.cache.unpin(model_name, previous)
+            with self._lock:
+                self.reloads += 1
+            self._retire(model_name, version)
+
+    def _retire(self, model_name: str, version: int) -> None:
+        if self.retire_policy != "keep_last":
+            return
+        # The served version is always kept, followed by the most recent ones
+        cached = sorted(
+            (v for v in self.cache.versions(model_name) if v != version), reverse=True
+        )
+        for old_version in cached[self.keep_versions - 1:]:
+            self.cache.invalidate(model_name, old_version)
+            with self._lock:
+                self.retired += 1
+
+    def stats(self) -> dict:
+        """Return the served versions and the counters of the watcher."""
+        with self._lock:
+            return {
+                "running": self._thread is not None
+                and self._thread_pid == os.getpid()
+                and self._thread.is_alive(),
+                "served": dict(self._served),
+                "checks": self.checks,
+                "reloads": self.reloads,
+                "retired": self.retired,
+                "failures": self.failures,
+                "retire_policy": self.retire_policy,
+            }
@@ -0,0 +1,194 @@
+"""In this file is implemented the cache of the predicted prices.
+
+Many /predict_price requests repeat the same diamonds. The cache keeps the price
+predicted for every diamond, keyed by the resolved (model_name, model_version),
+the signature of the model file (so that the prices of a model replaced by a new
+one with the same version, for example after init-db, are not returned) and a
+hash of the canonical form of the diamond: the numerical characteristics
+as floats and the grades as strings, in the order of FEATURE_COLUMNS, so that
+for example a carat of 1 and of 1.0 give the same key.
+
+The entries expire `ttl` seconds after being stored and the least recently used
+ones are evicted when the number of entries or the estimated memory exceeds the
+limits. When a new version of a model becomes the latest, the prices of the
+other versions of the model are discarded.
+"""
+
+import hashlib
+import sys
+import threading
+import time
+from collections import OrderedDict
+from models.utils import FEATURE_COLUMNS, NUMERICAL_COLUMNS
+
+_NUMERICAL = frozenset(NUMERICAL_COLUMNS)
+# Estimated memory of the OrderedDict node and of the key and value tuples of an
+# entry, in addition to the hash and the price
+ENTRY_OVERHEAD = (
+    sys.getsizeof((0, 0, 0, 0)) + sys.getsizeof((0, 0)) + sys.getsizeof(0.0) * 2 + 100
+)
+
+
+def diamond_key(diamond):
+    """
+    Return the hash of the canonical form of a diamond.
+
+    Parameters:
+    - diamond (dict): The characteristics of the diamond.
+
+    Returns:
+    - bytes: The hash, or None if the diamond has not the expected columns and
+      types (numbers for the numerical characteristics, strings for the grades),
+      in which case it is not cached.
+    """
+    if not isinstance(diamond, dict):
+        return None
+    values = []
+    for column in FEATURE_COLUMNS:
+        value = diamond.get(column)
+        if column in _NUMERICAL:
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                return None
+            values.append(float(value))
+        else:
+            if not isinstance(value, str):
+                return None
+            values.append(value)
+    return hashlib.blake2b(repr(tuple(values)).encode(), digest_size=16).digest()
+
+
+class PredictionCache:
+    """LRU cache of the predicted prices with a time to live."""
+
+    def __init__(self, max_items: int, max_bytes: int, ttl: float):
+        """
+        Parameters:
+        - max_items (int): Maximum number of cached prices.
+        - max_bytes (int): Maximum estimated memory of the cached prices.
+        - ttl (float): Seconds a price is kept after being stored.
+        """
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get_many(self, model_name: str, model_version: int, model_signature, keys: list):
+        """
+        Return the cached prices of the diamonds. The hits and the misses are
+        counted by call: a call is a hit only if all the diamonds are cached.
+
+        Parameters:
+        - model_name (str), model_version (int): The resolved model.
+        - model_signature: The signature of the model file, see
+            ModelCache.signature.
+        - keys (list): The hashes of the diamonds, see diamond_key.
+
+        Returns:
+        - list: The prices, or None if any of the diamonds is not cached.
+        """
+        now = time.monotonic()
+        prices = []
+        with self._lock:
+            for key in keys:
+                entry_key = (model_name, model_version, model_signature, key)
+                entry = self._entries.get(entry_key)
+                if entry is not None and entry[1] <= now:
+                    self._remove(entry_key)
+                    self.expirations += 1
+                    entry = None
+                if entry is None:
+                    self.misses += 1
+                    return None
+                self._entries.move_to_end(entry_key)
+                prices.append(entry[0])
+            self.hits += 1
+        return prices
+
+    def put_many(
+        self, model_name: str, model_version: int, model_signature, keys: list, prices
+    ) -> None:
+        """
+        Store the predicted prices of the diamonds.
+
+        Parameters:
+        - model_name (str), model_version (int): The resolved model.
+        - model_signature: The signature of the model file.
+        - keys (list): The hashes of the diamonds, None for the ones not to cache.
+        - prices: The predicted prices, in the order of keys.
+        """
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for key, price in zip(keys, prices):
+                if key is None:
+                    continue
+                entry_key = (model_name, model_version, model_signature, key)
+                if entry_key in self._entries:
+                    self._remove(entry_key)
+                self._entries[entry_key] = (float(price), expires)
+                self._current_bytes += len(key) + ENTRY_OVERHEAD
+            while self._entries and (
+                len(self._entries) > self.max_items or self._current_bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, entry_key) -> None:
+        del self._entries[entry_key]
+        self._current_bytes -= len(entry_key[3]) + ENTRY_OVERHEAD
+
+    def set_latest(self, model_name: str, model_version: int) -> None:
+        """
+        Record the latest version of a model, discarding the prices of the other
+        versions when it changes.
+        """
+        if self._latest.get(model_name) == model_version:
+            return
+        with self._lock:
+            if self._latest.get(model_name) == model_version:
+                return
+            previous = self._latest.get(model_name)
+            self._latest[model_name] = model_version
+            if previous is None:
+                return
+            for entry_key in list(self._entries):
+                if entry_key[0] == model_name and entry_key[1] != model_version:
+                    self._remove(entry_key)
+                    self.invalidations += 1
+
+    def clear(self) -> None:
+        """Remove all the prices and reset the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self._latest = {}
+            self._current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.expirations = 0
+            self.evictions = 0
+            self.invalidations = 0
+
+    def stats(self) -> dict:
+        """Return the hit/miss statistics and the current occupation of the cache."""
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / requests if requests else 0.0,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "size": len(self._entries),
+                "max_size": self.max_items,
+                "bytes": self._current_bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+            }
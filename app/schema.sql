@@ -1,6 +1,8 @@
 
 DROP TABLE IF EXISTS models_history;
 DROP TABLE IF EXISTS api_history;
+DROP TABLE IF EXISTS api_history_hourly;
+DROP TABLE IF EXISTS promoted_model;
 
 CREATE TABLE models_history (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -13,10 +15,49 @@ CREATE TABLE models_history (
   training_dataset TEXT NOT NULL
 );
 
+-- Unique, so that two trainings saving the same model can't get the same version
+CREATE UNIQUE INDEX idx_models_history_name_version
+ON models_history (model_name, model_version);
+
+-- The model used by the requests that don't give a model name, at most one row
+CREATE TABLE promoted_model (
+  id INTEGER PRIMARY KEY CHECK (id = 1),
+  model_name TEXT NOT NULL,
+  model_version INTEGER NOT NULL,
+  metrics TEXT NOT NULL,
+  promoted TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- request and response are JSON text, or zlib compressed JSON stored as BLOB
 CREATE TABLE api_history (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   api TEXT NOT NULL,
   request TEXT NOT NULL,
-  response TEXT NOT NULL
+  response TEXT NOT NULL,
+  stages TEXT,
+  model_name TEXT,
+  model_version INTEGER,
+  status INTEGER,
+  duration REAL
+);
+
+CREATE INDEX idx_api_history_created
+ON api_history (created);
+
+CREATE INDEX idx_api_history_api_created
+ON api_history (api, created);
+
+-- Hourly aggregates of the api_history records removed by the retention
+CREATE TABLE api_history_hourly (
+  hour TEXT NOT NULL,
+  api TEXT NOT NULL,
+  model_name TEXT NOT NULL DEFAULT '',
+  model_version INTEGER NOT NULL DEFAULT 0,
+  requests INTEGER NOT NULL,
+  errors INTEGER NOT NULL,
+  timed_requests INTEGER NOT NULL,
+  total_duration REAL NOT NULL,
+  max_duration REAL NOT NULL,
+  PRIMARY KEY (hour, api, model_name, model_version)
 );
@@ -0,0 +1,257 @@
+"""In this file is implemented the index used to find similar diamonds.
+
+The dataset is read once and split by (cut, color, clarity). Every group keeps
+its carats sorted in a NumPy array, together with its rows in the same order,
+so the diamonds with the most similar weight are found with a binary search for
+the requested carat followed by a walk of k steps towards the nearest side.
+
+The nearest diamonds over all the numerical characteristics (carat, depth,
+table, x, y, z, optionally followed by the ordinal codes of cut, color and
+clarity) are found with a KD-tree or ball-tree of scikit-learn. The features are
+standardized with the mean and the standard deviation of the dataset, so that
+every characteristic weighs the same in the distance. A tree is built for every
+metric and set of features at their first query, and for every cut, color and
+clarity group when the search is restricted to the same grades.
+
+The index is rebuilt when the dataset file changes.
+"""
+
+import os
+import threading
+import numpy as np
+import pandas as pd
+from models.utils import (
+    load_df,
+    NUMERICAL_COLUMNS,
+    CUT_CATEGORIES,
+    COLOR_CATEGORIES,
+    CLARITY_CATEGORIES,
+)
+
+GROUP_COLUMNS = ["cut", "color", "clarity"]
+GRADE_CATEGORIES = {
+    "cut": CUT_CATEGORIES,
+    "color": COLOR_CATEGORIES,
+    "clarity": CLARITY_CATEGORIES,
+}
+GRADE_CODES = {
+    column: {category: code for code, category in enumerate(categories)}
+    for column, categories in GRADE_CATEGORIES.items()
+}
+METRICS = ("euclidean", "manhattan", "chebyshev")
+TREE_TYPES = ("kd_tree", "ball_tree")
+
+
+class SimilarDiamondsIndex:
+    """Carat-sorted index of the dataset grouped by cut, color and clarity, and
+    nearest neighbour trees over the standardized characteristics."""
+
+    def __init__(self, dataset_path: str, tree_type: str = "kd_tree", leaf_size: int = 40):
+        """
+        Parameters:
+        - dataset_path (str): The dataset the similar diamonds are searched in.
+        - tree_type (str): The nearest neighbour tree, "kd_tree" or "ball_tree".
+        - leaf_size (int): The number of points in the leaves of the trees.
+        """
+        if tree_type not in TREE_TYPES:
+            raise ValueError(f"Tree type must be one of {TREE_TYPES}, got {tree_type}")
+        self.dataset_path = dataset_path
+        self.tree_type = tree_type
+        self.leaf_size = leaf_size
+        self._lock = threading.Lock()
+        self._signature = None
+        self._groups = {}
+        self._features = None
+        self._trees = {}
+        self.columns = []
+
+    def clear(self) -> None:
+        """Discard the index, it is built again at the next query."""
+        with self._lock:
+            self._signature = None
+            self._groups = {}
+            self._features = None
+            self._trees = {}
+
+    def _file_signature(self):
+        stat = os.stat(self.dataset_path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _ensure_current(self) -> None:
+        signature = self._file_signature()
+        if signature == self._signature:
+            return
+        with self._lock:
+            if signature == self._signature:
+                return
+            # The rows are returned to the client, so they are read with the
+            # exact values of the CSV instead of the float32 ones of the cache
+            self._build(load_df(self.dataset_path, use_cache=False))
+            self._signature = signature
+
+    def _build(self, data) -> None:
+        groups = {}
+        group_positions = {}
+        for key, positions in data.groupby(GROUP_COLUMNS, sort=False).indices.items():
+            group = data.iloc[positions]
+            carats = group["carat"].to_numpy(dtype=np.float64)
+            order = np.argsort(carats, kind="stable")
+            groups[key] = (carats[order], group.to_numpy(dtype=object)[order])
+            group_positions[key] = positions
+
+        # Numerical characteristics followed by the ordinal codes of the grades,
+        # standardized column by column
+        features = np.column_stack(
+            [data[column].to_numpy(dtype=np.float64) for column in NUMERICAL_COLUMNS]
+            + [
+                _grade_codes(data[column].to_numpy(dtype=object), categories)
+                for column, categories in GRADE_CATEGORIES.items()
+            ]
+        )
+        mean = np.nanmean(features, axis=0)
+        scale = np.nanstd(features, axis=0)
+        scale[~(scale > 0)] = 1.0
+        self._features = (
+            np.nan_to_num((features - mean) / scale),
+            mean,
+            scale,
+            data.to_numpy(dtype=object),
+            group_positions,
+        )
+        self._groups = groups
+        self._trees = {}
+        self.columns = list(data.columns)
+
+    def query(self, cut: str, color: str, clarity: str, carat: float, k: int) -> list:
+        """
+        Find the k diamonds with the same cut, color and clarity and the most
+        similar carat.
+
+        Parameters:
+        - cut (str), color (str), clarity (str): The characteristics to match.
+        - carat (float): The weight of the diamond.
+        - k (int): The number of diamonds to return.
+
+        Returns:
+        - list: The rows of the dataset sorted by carat difference, each one
+          followed by the absolute carat difference.
+        """
+        self._ensure_current()
+        group = self._groups.get((cut, color, clarity))
+        if group is None or k <= 0:
+            return []
+        carats, rows = group
+
+        # Two pointers starting at the insertion point of the requested carat,
+        # at every step the nearest of the two candidates is taken
+        right = int(np.searchsorted(carats, carat))
+        left = right - 1
+        selected = []
+        differences = []
+        while len(selected) < k and (left >= 0 or right < len(carats)):
+            if right >= len(carats) or (
+                left >= 0 and carat - carats[left] <= carats[right] - carat
+            ):
+                selected.append(left)
+                differences.append(abs(carats[left] - carat))
+                left -= 1
+            else:
+                selected.append(right)
+                differences.append(abs(carats[right] - carat))
+                right += 1
+
+        result = rows[selected].tolist()
+        for row, difference in zip(result, differences):
+            row.append(float(difference))
+        return result
+
+    def _tree(self, metric: str, use_grades: bool, group_key=None):
+        """Return the tree for the metric, the features and the group, and the
+        positions in the dataset of its points; build it at the first call."""
+        tree_key = (metric, use_grades, group_key)
+        tree = self._trees.get(tree_key)
+        if tree is not None:
+            return tree
+        with self._lock:
+            tree = self._trees.get(tree_key)
+            if tree is not None:
+                return tree
+            # scikit-learn is imported only by the searches that need it
+            from sklearn.neighbors import BallTree, KDTree
+
+            features, _, _, _, group_positions = self._features
+            if group_key is None:
+                positions = np.arange(len(features))
+            else:
+                positions = group_positions.get(group_key)
+                if positions is None:
+                    return None
+            num_columns = features.shape[1] if use_grades else len(NUMERICAL_COLUMNS)
+            tree_class = KDTree if self.tree_type == "kd_tree" else BallTree
+            tree = (
+                tree_class(
+                    features[positions, :num_columns], leaf_size=self.leaf_size, metric=metric
+                ),
+                positions,
+            )
+            self._trees[tree_key] = tree
+            return tree
+
+    def query_features(
+        self,
+        diamond: dict,
+        k: int,
+        metric: str = "euclidean",
+        use_grades: bool = False,
+        same_grades: bool = False,
+    ) -> list:
+        """
+        Find the k diamonds nearest to the given one over the standardized
+        numerical characteristics.
+
+        Parameters:
+        - diamond (dict): The characteristics of the diamond.
+        - k (int): The number of diamonds to return.
+        - metric (str): The distance, one of "euclidean", "manhattan" or "chebyshev".
+        - use_grades (bool): Add the ordinal codes of cut, color and clarity to
+            the characteristics compared.
+        - same_grades (bool): Search only the diamonds with the same cut, color
+            and clarity.
+
+        Returns:
+        - list: The rows of the dataset sorted by distance, each one followed by
+          the distance.
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Metric must be one of {METRICS}, got {metric}")
+        self._ensure_current()
+        group_key = (
+            (diamond["cut"], diamond["color"], diamond["clarity"]) if same_grades else None
+        )
+        tree = self._tree(metric, use_grades, group_key)
+        if tree is None or k <= 0:
+            return []
+        tree, positions = tree
+        _, mean, scale, rows, _ = self._features
+
+        point = np.array(
+            [float(diamond[column]) for column in NUMERICAL_COLUMNS]
+            + [GRADE_CODES[column].get(diamond[column], np.nan) for column in GRADE_CODES]
+        )
+        point = np.nan_to_num((point - mean) / scale)
+        num_columns = len(point) if use_grades else len(NUMERICAL_COLUMNS)
+        distances, indices = tree.query(
+            point[:num_columns].reshape(1, -1), k=min(k, len(positions))
+        )
+
+        result = rows[positions[indices[0]]].tolist()
+        for row, distance in zip(result, distances[0]):
+            row.append(float(distance))
+        return result
+
+
+def _grade_codes(values, categories: list):
+    """Position of every grade in its categories, NaN for the unknown ones."""
+    codes = pd.Categorical(values, categories=categories).codes.astype(np.float64)
+    codes[codes < 0] = np.nan
+    return codes
@@ -1,11 +1,114 @@
 import os
 import shutil
 import sqlite3
-import cloudpickle
-from setting import DB_PATH, SAVE_PATH_MODELS
+import numpy as np
+import pandas as pd
+from app.model_cache import ModelCache
+from app.model_registry import ModelRegistry
+from app.model_watcher import ModelWatcher
+from app.prediction_cache import PredictionCache
+from app.history_writer import ApiHistoryWriter
+from app.similarity_index import SimilarDiamondsIndex
+from app.validation import validate_diamond, validate_frame, MISSING_COLUMNS_ERROR
+from app.micro_batcher import MicroBatcher
+from app.metrics import ApiMetrics
+from models.base_model import BaseSupervisedModel
+from models.timing import stage
+from models.utils import FEATURE_COLUMNS
+from setting import (
+    DB_PATH,
+    DEFAULT_DATASET,
+    SIMILARITY_DEFAULT_METRIC,
+    SIMILARITY_TREE_TYPE,
+    SIMILARITY_LEAF_SIZE,
+    SAVE_PATH_MODELS,
+    MODEL_CACHE_MAX_ITEMS,
+    MODEL_CACHE_MAX_BYTES,
+    MODEL_REGISTRY_POLL_INTERVAL,
+    MODEL_HOT_RELOAD_ENABLED,
+    MODEL_HOT_RELOAD_INTERVAL,
+    MODEL_RETIRE_POLICY,
+    MODEL_RETIRE_KEEP_VERSIONS,
+    PREDICTION_CACHE_MAX_ITEMS,
+    PREDICTION_CACHE_MAX_BYTES,
+    PREDICTION_CACHE_TTL,
+    API_HISTORY_QUEUE_SIZE,
+    API_HISTORY_BATCH_SIZE,
+    API_HISTORY_FLUSH_INTERVAL,
+    API_HISTORY_OVERFLOW_POLICY,
+    API_HISTORY_SAMPLE_RATE,
+    API_HISTORY_BLOCK_TIMEOUT,
+    API_HISTORY_COMPRESS_MIN_BYTES,
+    API_HISTORY_RETENTION_DAYS,
+    API_HISTORY_RETENTION_INTERVAL,
+    API_HISTORY_RETENTION_CHUNK_ROWS,
+    API_HISTORY_VACUUM_CHUNK_PAGES,
+    MICRO_BATCH_MAX_ROWS,
+    MICRO_BATCH_MAX_WAIT_MS,
+)
 
+model_cache = ModelCache(max_items=MODEL_CACHE_MAX_ITEMS, max_bytes=MODEL_CACHE_MAX_BYTES)
+model_registry = ModelRegistry(DB_PATH, poll_interval=MODEL_REGISTRY_POLL_INTERVAL)
+prediction_cache = PredictionCache(
+    max_items=PREDICTION_CACHE_MAX_ITEMS,
+    max_bytes=PREDICTION_CACHE_MAX_BYTES,
+    ttl=PREDICTION_CACHE_TTL,
+)
+history_writer = ApiHistoryWriter(
+    DB_PATH,
+    max_queue_size=API_HISTORY_QUEUE_SIZE,
+    batch_size=API_HISTORY_BATCH_SIZE,
+    flush_interval=API_HISTORY_FLUSH_INTERVAL,
+    overflow_policy=API_HISTORY_OVERFLOW_POLICY,
+    sample_rate=API_HISTORY_SAMPLE_RATE,
+    block_timeout=API_HISTORY_BLOCK_TIMEOUT,
+    compress_min_bytes=API_HISTORY_COMPRESS_MIN_BYTES,
+    retention_days=API_HISTORY_RETENTION_DAYS,
+    retention_interval=API_HISTORY_RETENTION_INTERVAL,
+    retention_chunk_rows=API_HISTORY_RETENTION_CHUNK_ROWS,
+    vacuum_chunk_pages=API_HISTORY_VACUUM_CHUNK_PAGES,
+)
+similar_diamonds_index = SimilarDiamondsIndex(
+    DEFAULT_DATASET, tree_type=SIMILARITY_TREE_TYPE, leaf_size=SIMILARITY_LEAF_SIZE
+)
+micro_batcher = MicroBatcher(
+    max_batch_rows=MICRO_BATCH_MAX_ROWS, max_wait_ms=MICRO_BATCH_MAX_WAIT_MS
+)
+api_metrics = ApiMetrics()
 
-def get_model_pickle_path(model_name, model_version=None):
+# Up to this number of diamonds the requests are validated row by row
+ROW_VALIDATION_MAX_ROWS = 16
+
+# Diamond predicted by the warm-up of the preloaded models
+WARMUP_DIAMOND = {
+    "carat": 0.7,
+    "cut": "Ideal",
+    "color": "G",
+    "clarity": "VS2",
+    "depth": 61.5,
+    "table": 56.0,
+    "x": 5.7,
+    "y": 5.72,
+    "z": 3.51,
+}
+
+
+def get_model_record(model_name, model_version=None):
+    """
+    Retrieve the version and the pickle path of a registered model from the database.
+
+    The API resolves the models through the in-memory `model_registry`, this
+    function queries the database directly.
+
+    Parameters:
+    - model_name (str): The name of the model.
+    - model_version (int, optional): The version of the model. If not given the
+        latest version is returned.
+
+    Returns:
+    - (int, str): The version and the pickle path of the model, or None if the
+      model is not registered.
+    """
     # Connect to the SQLite database
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
@@ -13,7 +116,7 @@ def get_model_pickle_path(model_name, model_version=None):
         # Retrieve the pickle_path for the given model_name and model_version
         cursor.execute(
             """
-            SELECT model_pickle_path
+            SELECT model_version, model_pickle_path
             FROM models_history 
             WHERE model_name = ? AND model_version = ?
             """,
@@ -23,7 +126,7 @@ def get_model_pickle_path(model_name, model_version=None):
         # Retrieve the pickle_path for the given model_name with the maximum version
         cursor.execute(
             """
-            SELECT model_pickle_path
+            SELECT model_version, model_pickle_path
             FROM models_history 
             WHERE model_name = ? AND model_version = (
                 SELECT MAX(model_version) 
@@ -33,22 +136,156 @@ def get_model_pickle_path(model_name, model_version=None):
             """,
             (model_name, model_name),
         )
-    pickle_path = cursor.fetchone()
+    record = cursor.fetchone()
     conn.close()
-    if not pickle_path:
+    if not record:
+        return None
+    return record[0], record[1]
+
+
+def get_model_pickle_path(model_name, model_version=None):
+    record = get_model_record(model_name, model_version)
+    if record is None:
         return None
-    return pickle_path[0]
+    return record[1]
 
 
 def load_model(model_path: str):
-    """Load the model from the given path."""
+    """Load the model from the given path: an artifact directory or a pickle file."""
     try:
-        with open(model_path, "rb") as file:
-            model = cloudpickle.load(file)
+        with stage("model_load"):
+            return BaseSupervisedModel.load_saved_model(model_path)
     except FileNotFoundError:
         return None
-    
-    return model
+
+
+def warm_up_model(model) -> None:
+    """Predict a diamond through both the single diamond and the DataFrame paths,
+    to initialize the lazily computed state of the model and of its libraries."""
+    model.predict_row(WARMUP_DIAMOND)
+    model.execution_pipeline(pd.DataFrame([WARMUP_DIAMOND], columns=FEATURE_COLUMNS))
+
+
+model_watcher = ModelWatcher(
+    model_registry,
+    model_cache,
+    loader=load_model,
+    warmup=warm_up_model,
+    interval=MODEL_HOT_RELOAD_INTERVAL,
+    retire_policy=MODEL_RETIRE_POLICY,
+    keep_versions=MODEL_RETIRE_KEEP_VERSIONS,
+    on_serve=prediction_cache.set_latest,
+)
+
+
+def resolve_model_name(model_name, model_version=None):
+    """
+    Return the model of a request: the given one, or the promoted model (see
+    `train_new_model.py --promote`) if no model name is given.
+
+    Returns:
+    - (str, int): The name and the version of the model, the name is None if no
+      model is given and none has been promoted.
+    """
+    if model_name:
+        return model_name, model_version
+    promoted = model_registry.promoted()
+    if promoted is None:
+        return None, model_version
+    return promoted
+
+
+def resolve_model(model_name, model_version=None):
+    """
+    Retrieve a model and its resolved version from the in-process cache, loading
+    it on the first request.
+
+    With MODEL_HOT_RELOAD_ENABLED, the requests without a version get the version
+    served by `model_watcher`, that loads the new versions in the background.
+
+    Parameters:
+    - model_name (str): The name of the model.
+    - model_version (int, optional): The version of the model. If not given the
+        latest version is returned.
+
+    Returns:
+    - (int, model): The version and the loaded model, or None if the model is not
+      registered or its file is missing.
+    """
+    with stage("model_lookup"):
+        record = None
+        if MODEL_HOT_RELOAD_ENABLED and not model_version:
+            model_watcher.ensure_started()
+            served_version = model_watcher.served_version(model_name)
+            if served_version is not None:
+                record = model_registry.resolve(model_name, served_version)
+        if record is None:
+            record = model_registry.resolve(model_name, model_version)
+    if record is None:
+        return None
+    version, path = record
+    model = model_cache.get(model_name, version, path, load_model)
+    if model is None:
+        return None
+    return version, model
+
+
+def get_cached_model(model_name, model_version=None):
+    """
+    Retrieve a model from the in-process cache, loading it on the first request.
+
+    Parameters:
+    - model_name (str): The name of the model.
+    - model_version (int, optional): The version of the model. If not given the
+        latest version is returned.
+
+    Returns:
+    - The loaded model, or None if the model is not registered or its file is missing.
+    """
+    resolved = resolve_model(model_name, model_version)
+    if resolved is None:
+        return None
+    return resolved[1]
+
+
+def preload_models(warmup: bool = True) -> dict:
+    """
+    Load the latest version of every registered model and build the similar
+    diamonds index and its tree for the default metric, so that the first
+    requests don't pay for them.
+
+    Parameters:
+    - warmup (bool): Predict a diamond with every loaded model, see
+        warm_up_model. With MODEL_HOT_RELOAD_ENABLED the models are loaded, and
+        warmed up, by `model_watcher`, that will serve them.
+
+    Returns:
+    - dict: The loaded version of every model.
+    """
+    if MODEL_HOT_RELOAD_ENABLED:
+        # The thread of the watcher is not started here, the workers forked
+        # after the preload start their own
+        loaded = model_watcher.check()
+    else:
+        loaded = {}
+        for model_name in model_registry.latest_versions():
+            resolved = resolve_model(model_name)
+            if resolved is None:
+                continue
+            version, model = resolved
+            if warmup:
+                warm_up_model(model)
+            loaded[model_name] = version
+
+    similar_diamonds_index.query(
+        WARMUP_DIAMOND["cut"],
+        WARMUP_DIAMOND["color"],
+        WARMUP_DIAMOND["clarity"],
+        WARMUP_DIAMOND["carat"],
+        1,
+    )
+    similar_diamonds_index.query_features(WARMUP_DIAMOND, 1, metric=SIMILARITY_DEFAULT_METRIC)
+    return loaded
 
 
 def delete_all_models_pickle_file():
@@ -64,67 +301,39 @@ def delete_all_models_pickle_file():
             print("Failed to delete %s. Reason: %s" % (file_path, e))
 
 
-def check_data_correctness(input_data_list: dict):
+def check_data_correctness(input_data_list: list):
     """
     Validates the correctness of input data based on predefined criteria.
 
-    This function checks if the input data dictionary:
+    This function checks if every diamond of the input list:
     1. Contains all required columns: 'carat', 'cut', 'color', 'clarity', 'depth', 'table', 'x', 'y', 'z'.
     2. Has string fields ('cut', 'color', 'clarity') with values that match the allowed options.
     3. Has numerical fields ('carat', 'depth', 'table', 'x', 'y', 'z') with values greater than zero.
 
+    Small lists are validated diamond by diamond with set lookups, larger ones
+    with the vectorized validator of `app.validation`.
+
     Parameters:
-    - input_data (dict): A dictionary containing the data to be validated.
+    - input_data_list (list): A list of dictionaries containing the data to be validated.
 
     Returns:
     - (bool, str): A tuple where the first element is True if the data is in the correct format, False otherwise.
                    The second element is a message indicating whether the data is correct or describing the error.
     """
-    # Define allowed values for string fields
-    ALLOWED_CUT = ["Fair", "Good", "Very Good", "Ideal", "Premium"]
-    ALLOWED_COLOR = ["D", "E", "F", "G", "H", "I", "J"]
-    ALLOWED_CLARITY = ["IF", "VVS1", "VVS2", "VS1", "VS2", "SI1", "SI2", "I1"]
-
-    for input_data in input_data_list:
-        # Check if all required columns are present
-        required_columns = [
-            "carat",
-            "cut",
-            "color",
-            "clarity",
-            "depth",
-            "table",
-            "x",
-            "y",
-            "z",
-        ]
-        if not all(column in input_data for column in required_columns):
-            return False, "Missing required columns"
-
-        # Check if string fields are of type string and have allowed values
-        if (
-            not isinstance(input_data["cut"], str)
-            or input_data["cut"] not in ALLOWED_CUT
-        ):
-            return False, "Invalid or incorrect type for 'cut'"
-        if (
-            not isinstance(input_data["color"], str)
-            or input_data["color"] not in ALLOWED_COLOR
-        ):
-            return False, "Invalid or incorrect type for 'color'"
-        if (
-            not isinstance(input_data["clarity"], str)
-            or input_data["clarity"] not in ALLOWED_CLARITY
-        ):
-            return False, "Invalid or incorrect type for 'clarity'"
-
-        # Check if numerical fields are greater than zero
-        numerical_fields = ["carat", "depth", "table", "x", "y", "z"]
-        try:
-            if any(float(input_data[field]) <= 0 for field in numerical_fields):
-                return False, "Numerical fields must be greater than zero"
-        except ValueError:
-            return False, "Numerical fields contain non-numeric values"
+    if not isinstance(input_data_list, list):
+        return False, "Data must be a list of diamonds"
+
+    if len(input_data_list) <= ROW_VALIDATION_MAX_ROWS:
+        for input_data in input_data_list:
+            message = validate_diamond(input_data)
+            if message is not None:
+                return False, message
+    else:
+        if not all(isinstance(input_data, dict) for input_data in input_data_list):
+            return False, MISSING_COLUMNS_ERROR
+        valid, errors = validate_frame(pd.DataFrame(input_data_list))
+        if not valid.all():
+            return False, errors[np.argmin(valid)]
 
     # If all checks pass
     return True, "Input data is in the correct format"
@@ -0,0 +1,105 @@
+"""In this file is implemented the validation of the diamonds received by the API.
+
+A diamond is valid if:
+1. It contains all the required columns: 'carat', 'cut', 'color', 'clarity',
+   'depth', 'table', 'x', 'y', 'z', none of them null.
+2. The string fields ('cut', 'color', 'clarity') have one of the allowed values.
+3. The numerical fields ('carat', 'depth', 'table', 'x', 'y', 'z') are numbers
+   greater than zero.
+
+Batches are validated column by column with pandas/NumPy operations and every
+row gets its own error, so the cost of the validation doesn't grow with a Python
+loop over the rows. Single diamonds are validated directly on the dictionary
+with set lookups, without building a DataFrame.
+"""
+
+import math
+import numpy as np
+import pandas as pd
+from models.utils import (
+    FEATURE_COLUMNS,
+    NUMERICAL_COLUMNS,
+    CUT_CATEGORIES,
+    COLOR_CATEGORIES,
+    CLARITY_CATEGORIES,
+)
+
+ALLOWED_VALUES = {
+    "cut": frozenset(CUT_CATEGORIES),
+    "color": frozenset(COLOR_CATEGORIES),
+    "clarity": frozenset(CLARITY_CATEGORIES),
+}
+
+MISSING_COLUMNS_ERROR = "Missing required columns"
+INVALID_CATEGORY_ERROR = "Invalid or incorrect type for '{}'"
+NOT_POSITIVE_ERROR = "Numerical fields must be greater than zero"
+NOT_NUMERIC_ERROR = "Numerical fields contain non-numeric values"
+
+
+def _is_null(value) -> bool:
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def validate_diamond(diamond: dict):
+    """
+    Validate a single diamond.
+
+    Parameters:
+    - diamond (dict): The characteristics of the diamond.
+
+    Returns:
+    - str: The description of the first error found, or None if the diamond is valid.
+    """
+    if not isinstance(diamond, dict) or any(
+        _is_null(diamond.get(column)) for column in FEATURE_COLUMNS
+    ):
+        return MISSING_COLUMNS_ERROR
+
+    for column, allowed in ALLOWED_VALUES.items():
+        value = diamond[column]
+        if not isinstance(value, str) or value not in allowed:
+            return INVALID_CATEGORY_ERROR.format(column)
+
+    for column in NUMERICAL_COLUMNS:
+        try:
+            value = float(diamond[column])
+        except (TypeError, ValueError):
+            return NOT_NUMERIC_ERROR
+        if math.isnan(value):
+            return NOT_NUMERIC_ERROR
+        if value <= 0:
+            return NOT_POSITIVE_ERROR
+    return None
+
+
+def validate_frame(data: pd.DataFrame):
+    """
+    Validate a batch of diamonds.
+
+    Parameters:
+    - data (pd.DataFrame): The characteristics of the diamonds, one row per diamond.
+
+    Returns:
+    - (np.ndarray, np.ndarray): A boolean mask that is True for the valid rows and,
+      for every row, the description of the first error found (None for the valid rows).
+    """
+    num_rows = len(data)
+    errors = np.full(num_rows, None, dtype=object)
+    if any(column not in data.columns for column in FEATURE_COLUMNS):
+        errors[:] = MISSING_COLUMNS_ERROR
+        return np.zeros(num_rows, dtype=bool), errors
+
+    # The checks are applied from the last to the first, so that every row
+    # keeps the error of the first check it fails
+    for column in reversed(NUMERICAL_COLUMNS):
+        values = pd.to_numeric(data[column], errors="coerce").to_numpy(dtype=np.float64)
+        errors[values <= 0] = NOT_POSITIVE_ERROR
+        errors[np.isnan(values)] = NOT_NUMERIC_ERROR
+
+    for column in reversed(list(ALLOWED_VALUES)):
+        valid_category = data[column].isin(ALLOWED_VALUES[column]).to_numpy()
+        errors[~valid_category] = INVALID_CATEGORY_ERROR.format(column)
+
+    errors[data[FEATURE_COLUMNS].isna().any(axis=1).to_numpy()] = MISSING_COLUMNS_ERROR
+
+    return pd.isna(errors), errors
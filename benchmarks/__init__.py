@@ -0,0 +1,5 @@
+"""Benchmarks of the API endpoints, of the data loading and of the training.
+
+Run them from the root of the repository with `python -m benchmarks run`, see
+benchmarks/__main__.py for the options.
+"""
@@ -0,0 +1,173 @@
+"""Runner of the benchmarks.
+
+Run all the benchmarks and write the results:
+    python -m benchmarks run --output results.json
+
+Compare the results with a baseline, the exit code is 1 if there are regressions:
+    python -m benchmarks compare baseline.json results.json
+    python -m benchmarks run --output results.json --baseline baseline.json
+
+The benchmarks run in a temporary working directory with their own database,
+models and dataset cache, so the ones of the application are not modified.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import shutil
+from pathlib import Path
+from benchmarks.harness import BenchmarkResults, compare, load_results, print_comparison
+from models.get_model import available_models
+
+ROOT_PATH = Path(__file__).resolve().parents[1]
+SUITES = ("data", "training", "api")
+MODEL_NAMES = tuple(available_models())
+
+
+def _use_workdir(workdir: Path) -> None:
+    # Must run before the modules of the application import setting.py
+    os.environ["DIAMONDS_DB_PATH"] = str(workdir / "app_db.sqlite")
+    os.environ["DIAMONDS_MODELS_PATH"] = str(workdir / "saved_model")
+    os.environ["DIAMONDS_DATASET_CACHE_PATH"] = str(workdir / "dataset_cache")
+    os.environ["DIAMONDS_OPTUNA_STORAGE"] = "sqlite:///" + (workdir / "optuna.sqlite3").as_posix()
+
+
+def run(args) -> int:
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="diamonds-benchmarks-"))
+    workdir.mkdir(parents=True, exist_ok=True)
+    _use_workdir(workdir)
+
+    import optuna
+    from benchmarks import suites
+
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    results = BenchmarkResults()
+    try:
+        scales = sorted(set(args.scales) | set(args.train_scales))
+        datasets = {
+            scale: suites.make_synthetic_dataset(
+                args.dataset, scale, str(workdir / f"diamonds_x{scale}.csv")
+            )
+            for scale in scales
+        }
+        if "data" in args.suites:
+            suites.bench_data(
+                results, {scale: datasets[scale] for scale in args.scales}, args.repeat
+            )
+        if "training" in args.suites:
+            suites.bench_training(
+                results,
+                {scale: datasets[scale] for scale in args.train_scales},
+                args.models,
+                args.n_trials,
+                args.train_repeat,
+            )
+        if "api" in args.suites:
+            suites.bench_api(
+                results,
+                {scale: datasets[scale] for scale in args.scales},
+                args.models,
+                args.n_trials,
+                args.repeat,
+            )
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results.write(args.output)
+    print(f"Results written to {args.output}")
+    if args.baseline:
+        comparison = compare(load_results(args.baseline), load_results(args.output), args.threshold, args.min_delta)
+        print_comparison(comparison)
+        return 1 if comparison["regressions"] else 0
+    return 0
+
+
+def compare_files(args) -> int:
+    comparison = compare(
+        load_results(args.baseline), load_results(args.current), args.threshold, args.min_delta
+    )
+    print_comparison(comparison)
+    return 1 if comparison["regressions"] else 0
+
+
+def _add_comparison_options(parser) -> None:
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Relative slowdown of the median reported as regression (0.2 = 20%%).",
+    )
+    parser.add_argument(
+        "--min-delta",
+        type=float,
+        default=0.0005,
+        help="Minimum slowdown of the median, in seconds, reported as regression.",
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Benchmarks of the API, of the data loading and of the training.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks.")
+    run_parser.add_argument(
+        "--output", type=Path, default=Path("benchmark_results.json"),
+        help="The JSON file where the results are written.",
+    )
+    run_parser.add_argument(
+        "--baseline", type=Path, default=None,
+        help="Results of a previous run to compare with.",
+    )
+    run_parser.add_argument(
+        "--suites", nargs="+", choices=SUITES, default=list(SUITES),
+        help="The benchmarks to run.",
+    )
+    run_parser.add_argument(
+        "--models", nargs="+", choices=MODEL_NAMES, default=list(MODEL_NAMES),
+        help="The models to benchmark.",
+    )
+    run_parser.add_argument(
+        "--dataset", type=Path, default=ROOT_PATH / "data" / "diamonds.csv",
+        help="The dataset the synthetic datasets are generated from.",
+    )
+    run_parser.add_argument(
+        "--scales", nargs="+", type=int, default=[1, 4],
+        help="Sizes of the synthetic datasets, as multiples of the original one.",
+    )
+    run_parser.add_argument(
+        "--train-scales", nargs="+", type=int, default=[1],
+        help="Sizes of the synthetic datasets used by the training benchmarks.",
+    )
+    run_parser.add_argument(
+        "--repeat", type=int, default=20,
+        help="Number of measured runs of the API and data benchmarks.",
+    )
+    run_parser.add_argument(
+        "--train-repeat", type=int, default=1,
+        help="Number of measured runs of the training benchmarks.",
+    )
+    run_parser.add_argument(
+        "--n-trials", type=int, default=5,
+        help="Number of trials of the hyperparameter searches.",
+    )
+    run_parser.add_argument(
+        "--workdir", type=Path, default=None,
+        help="Working directory for database, models and datasets, kept at the end. "
+        "Defaults to a temporary directory.",
+    )
+    _add_comparison_options(run_parser)
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare two results files."
+    )
+    compare_parser.add_argument("baseline", type=Path, help="The baseline results.")
+    compare_parser.add_argument("current", type=Path, help="The results to check.")
+    _add_comparison_options(compare_parser)
+
+    args = parser.parse_args()
+    sys.exit(run(args) if args.command == "run" else compare_files(args))
@@ -0,0 +1,163 @@
+"""In this file are implemented the measurement of the benchmarks, the results file
+and the comparison of two results files.
+
+The results file is a JSON document with the information about the machine and
+the code that produced it, and one entry for every benchmark with the
+statistics of its durations in seconds:
+
+{
+    "metadata": {"created": ..., "python": ..., "platform": ..., ...},
+    "results": {
+        "api/predict_price/single/warm/XgBoost": {
+            "group": "api", "params": {...}, "repeat": 50,
+            "min": ..., "median": ..., "mean": ..., "p95": ..., "max": ...
+        },
+        ...
+    }
+}
+"""
+
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+
+def measure(func, repeat: int, warmup: int = 1, setup=None) -> dict:
+    """
+    Measure the duration of a function.
+
+    Parameters:
+    - func (callable): The function to measure, called without arguments.
+    - repeat (int): The number of measured calls.
+    - warmup (int): The number of calls executed before the measured ones.
+    - setup (callable, optional): Function called, without being measured,
+        before every call of func. For example to clear a cache and measure
+        cold calls.
+
+    Returns:
+    - dict: The number of calls and the min, median, mean, 95th percentile and
+      max of the durations in seconds.
+    """
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        func()
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - started)
+    durations.sort()
+    return {
+        "repeat": repeat,
+        "min": durations[0],
+        "median": statistics.median(durations),
+        "mean": statistics.fmean(durations),
+        "p95": durations[min(len(durations) - 1, int(0.95 * len(durations)))],
+        "max": durations[-1],
+    }
+
+
+class BenchmarkResults:
+    """Collects the results of the benchmarks and writes them to a file."""
+
+    def __init__(self):
+        self.results = {}
+
+    def add(self, name: str, group: str, stats: dict, **params) -> None:
+        """Add the statistics of a benchmark and print a summary line."""
+        self.results[name] = dict(group=group, params=params, **stats)
+        print(
+            f"{name:<60} median {stats['median'] * 1000:10.3f} ms"
+            f"   p95 {stats['p95'] * 1000:10.3f} ms   ({stats['repeat']} runs)"
+        )
+
+    def run(self, name: str, group: str, func, repeat: int, warmup: int = 1, setup=None, **params) -> dict:
+        """Measure a function with `measure` and add its statistics."""
+        stats = measure(func, repeat=repeat, warmup=warmup, setup=setup)
+        self.add(name, group, stats, **params)
+        return stats
+
+    def write(self, path: str) -> None:
+        """Write the results, with the metadata of the run, to a JSON file."""
+        with open(path, "w") as f:
+            json.dump({"metadata": _metadata(), "results": self.results}, f, indent=2)
+
+
+def _metadata() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "created": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def load_results(path: str) -> dict:
+    """Load a results file written by BenchmarkResults.write."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline: dict, current: dict, threshold: float = 0.2, min_delta: float = 0.0005) -> dict:
+    """
+    Compare the median durations of two results files.
+
+    A benchmark is a regression when its median is more than `threshold` (as a
+    fraction) slower than the baseline and the difference is more than
+    `min_delta` seconds, so the noise of very fast benchmarks is ignored.
+    Improvements are detected in the same way.
+
+    Parameters:
+    - baseline (dict), current (dict): The results files, as returned by load_results.
+    - threshold (float): The relative change of the median that is reported.
+    - min_delta (float): The minimum absolute change of the median, in seconds.
+
+    Returns:
+    - dict: The lists of "regressions" and "improvements", as (name, baseline
+      median, current median) tuples, and the names of the benchmarks "missing"
+      from the current results or "new" in them.
+    """
+    baseline_results = baseline["results"]
+    current_results = current["results"]
+    comparison = {"regressions": [], "improvements": [], "missing": [], "new": []}
+    for name, baseline_stats in baseline_results.items():
+        if name not in current_results:
+            comparison["missing"].append(name)
+            continue
+        before = baseline_stats["median"]
+        after = current_results[name]["median"]
+        if after > before * (1 + threshold) and after - before > min_delta:
+            comparison["regressions"].append((name, before, after))
+        elif after < before * (1 - threshold) and before - after > min_delta:
+            comparison["improvements"].append((name, before, after))
+    comparison["new"] = [name for name in current_results if name not in baseline_results]
+    return comparison
+
+
+def print_comparison(comparison: dict) -> None:
+    """Print the result of compare."""
+    for title, key in (("Regressions", "regressions"), ("Improvements", "improvements")):
+        print(f"{title}: {len(comparison[key])}")
+        for name, before, after in comparison[key]:
+            print(
+                f"  {name:<60} {before * 1000:10.3f} ms -> {after * 1000:10.3f} ms"
+                f" ({(after / before - 1) * 100:+.1f}%)"
+            )
+    for title, key in (("Missing benchmarks", "missing"), ("New benchmarks", "new")):
+        if comparison[key]:
+            print(f"{title}: {', '.join(comparison[key])}")
@@ -0,0 +1,258 @@
+"""In this file are implemented the benchmarks of the application.
+
+- data: load_df from the CSV, building the binary cache and from the cache, and
+  data_cleaning, on synthetic datasets of increasing size.
+- training: train_pipeline of the models on the synthetic datasets.
+- api: the endpoints called with the Flask test client, with the models trained
+  on the original dataset: /predict_price with one and many diamonds, with the
+  model already loaded (warm) and loaded at every request (cold),
+  /predict_price_batch, and /similar_diamonds, by carat and by all the
+  characteristics, for several k and dataset sizes.
+
+The modules of the application are imported by the functions, after the
+benchmark runner has moved the database, the models and the dataset cache to
+its working directory.
+"""
+
+import shutil
+import sqlite3
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+NUMERICAL_NOISE_COLUMNS = ["carat", "depth", "table", "x", "y", "z"]
+
+
+def make_synthetic_dataset(source: str, scale: int, path: str, seed: int = 42) -> str:
+    """
+    Write a dataset `scale` times bigger than the source one.
+
+    The source rows are repeated, and the numerical characteristics and the
+    price of the copies are perturbed by a random factor of about 1%, so the
+    rows are not exact duplicates.
+
+    Parameters:
+    - source (str): The file path of the source CSV.
+    - scale (int): How many copies of the source rows are written.
+    - path (str): The file path of the CSV to write.
+    - seed (int): The seed of the random perturbation.
+
+    Returns:
+    - str: The path of the written file.
+    """
+    data = pd.read_csv(source)
+    rng = np.random.default_rng(seed)
+    copies = [data]
+    for _ in range(scale - 1):
+        copy = data.copy()
+        factor = 1 + rng.normal(0, 0.01, len(copy))
+        for column in NUMERICAL_NOISE_COLUMNS:
+            copy[column] = (copy[column] * factor).round(2)
+        copy["price"] = (copy["price"] * factor).round().astype(int)
+        copies.append(copy)
+    pd.concat(copies, ignore_index=True).to_csv(path, index=False)
+    return path
+
+
+def bench_data(results, datasets: dict, repeat: int) -> None:
+    """
+    Benchmark the loading and the cleaning of the datasets.
+
+    Parameters:
+    - results (BenchmarkResults): Where the results are added.
+    - datasets (dict): The synthetic datasets, path by scale.
+    - repeat (int): The number of measured calls of the fast benchmarks.
+    """
+    from models.utils import load_df, data_cleaning
+    from setting import DATASET_CACHE_PATH
+
+    slow_repeat = max(1, repeat // 5)
+    for scale, path in datasets.items():
+        with open(path) as f:
+            rows = sum(1 for _ in f) - 1
+        results.run(
+            f"data/load_df/csv/x{scale}",
+            "data",
+            lambda: load_df(path, use_cache=False),
+            repeat=slow_repeat,
+            rows=rows,
+        )
+        results.run(
+            f"data/load_df/cache_build/x{scale}",
+            "data",
+            lambda: load_df(path, use_cache=True),
+            repeat=slow_repeat,
+            warmup=0,
+            setup=lambda: shutil.rmtree(DATASET_CACHE_PATH, ignore_errors=True),
+            rows=rows,
+        )
+        results.run(
+            f"data/load_df/cache/x{scale}",
+            "data",
+            lambda: load_df(path, use_cache=True),
+            repeat=repeat,
+            rows=rows,
+        )
+        data = load_df(path, use_cache=False)
+        results.run(
+            f"data/data_cleaning/x{scale}",
+            "data",
+            lambda: data_cleaning(data),
+            repeat=repeat,
+            rows=rows,
+        )
+
+
+def bench_training(results, datasets: dict, model_names: list, n_trials: int, repeat: int) -> None:
+    """
+    Benchmark the training of the models.
+
+    Parameters:
+    - results (BenchmarkResults): Where the results are added.
+    - datasets (dict): The synthetic datasets to train on, path by scale.
+    - model_names (list): The names of the models to train.
+    - n_trials (int): The number of trials of the hyperparameter searches.
+    - repeat (int): The number of trainings measured for every model and dataset.
+    """
+    from models.get_model import get_model
+    from models.utils import load_df, data_cleaning
+
+    for scale, path in datasets.items():
+        data = data_cleaning(load_df(path))
+        x = data.drop(columns=["price"])
+        y = data["price"]
+        for model_name in model_names:
+
+            def train():
+                model = get_model(model_name)
+                model.configure_hyperparameter_search(n_trials=n_trials, n_jobs=1)
+                # The preprocessing of some models modifies the input frame
+                model.train_pipeline(x.copy(), y)
+
+            results.run(
+                f"training/train_pipeline/{model_name}/x{scale}",
+                "training",
+                train,
+                repeat=repeat,
+                warmup=0,
+                rows=len(data),
+                n_trials=n_trials,
+            )
+
+
+def _train_api_models(dataset_path: str, model_names: list, n_trials: int) -> None:
+    """Create the database of the working directory and train the models served by the API."""
+    from models.get_model import get_model
+    from models.utils import load_df, data_cleaning
+    from setting import DB_PATH, SAVE_PATH_MODELS
+
+    Path(DB_PATH).parent.mkdir(parents=True, exist_ok=True)
+    Path(SAVE_PATH_MODELS).mkdir(parents=True, exist_ok=True)
+    schema = (Path(__file__).resolve().parents[1] / "app" / "schema.sql").read_text()
+    conn = sqlite3.connect(DB_PATH)
+    conn.executescript(schema)
+    conn.close()
+
+    data = data_cleaning(load_df(dataset_path))
+    for model_name in model_names:
+        model = get_model(model_name)
+        model.configure_hyperparameter_search(n_trials=n_trials, n_jobs=1)
+        model.train_pipeline(data.drop(columns=["price"]), data["price"])
+        model.save_model(training_dataset_name=Path(dataset_path).name)
+
+
+def bench_api(results, datasets: dict, model_names: list, n_trials: int, repeat: int) -> None:
+    """
+    Benchmark the endpoints of the API.
+
+    Parameters:
+    - results (BenchmarkResults): Where the results are added.
+    - datasets (dict): The synthetic datasets, path by scale. The models are
+        trained on the smallest one, the similar diamonds are searched in all.
+    - model_names (list): The names of the models to benchmark.
+    - n_trials (int): The number of trials of the hyperparameter searches.
+    - repeat (int): The number of measured requests of every benchmark.
+    """
+    training_path = datasets[min(datasets)]
+    _train_api_models(training_path, model_names, n_trials)
+
+    from app import create_app
+    from app.utils import model_cache, similar_diamonds_index
+    from models.utils import FEATURE_COLUMNS
+
+    client = create_app().test_client()
+    diamonds = pd.read_csv(training_path, nrows=1000)[FEATURE_COLUMNS].to_dict("records")
+
+    def post(path: str, payload: dict):
+        def request():
+            response = client.post(path, json=payload)
+            if response.status_code != 200:
+                raise RuntimeError(f"{path} returned {response.status_code}: {response.get_json()}")
+
+        return request
+
+    for model_name in model_names:
+        single = {"data": diamonds[:1], "model_name": model_name}
+        results.run(
+            f"api/predict_price/single/warm/{model_name}",
+            "api",
+            post("/predict_price", single),
+            repeat=repeat,
+            rows=1,
+        )
+        results.run(
+            f"api/predict_price/single/cold/{model_name}",
+            "api",
+            post("/predict_price", single),
+            repeat=max(1, repeat // 5),
+            setup=model_cache.clear,
+            rows=1,
+        )
+        for num_rows in (100, 1000):
+            results.run(
+                f"api/predict_price/batch/{num_rows}/warm/{model_name}",
+                "api",
+                post("/predict_price", {"data": diamonds[:num_rows], "model_name": model_name}),
+                repeat=repeat,
+                rows=num_rows,
+            )
+        columnar = {
+            column: [diamond[column] for diamond in diamonds] for column in FEATURE_COLUMNS
+        }
+        results.run(
+            f"api/predict_price_batch/{len(diamonds)}/warm/{model_name}",
+            "api",
+            post("/predict_price_batch", {"data": columnar, "model_name": model_name}),
+            repeat=repeat,
+            rows=len(diamonds),
+        )
+
+    for scale, path in datasets.items():
+        similar_diamonds_index.dataset_path = path
+        query = {"data": diamonds[:1], "num_similar_diamonds": 10}
+        results.run(
+            f"api/similar_diamonds/index_build/x{scale}",
+            "api",
+            post("/similar_diamonds", query),
+            repeat=max(1, repeat // 5),
+            warmup=0,
+            setup=similar_diamonds_index.clear,
+        )
+        for k in (1, 10, 100, 1000):
+            results.run(
+                f"api/similar_diamonds/k{k}/x{scale}",
+                "api",
+                post("/similar_diamonds", {"data": diamonds[:1], "num_similar_diamonds": k}),
+                repeat=repeat,
+                k=k,
+            )
+            results.run(
+                f"api/similar_diamonds/features/k{k}/x{scale}",
+                "api",
+                post(
+                    "/similar_diamonds",
+                    {"data": diamonds[:1], "num_similar_diamonds": k, "mode": "features"},
+                ),
+                repeat=repeat,
+                k=k,
+            )
@@ -1,2 +1,21 @@
-from .models_script.linear_regressor_diamond import LinearRegressorModelDiamond
-from .models_script.xgboost_diamond import XgBoostDiamond
\ No newline at end of file
+"""The models of the project.
+
+The model classes are imported on first access (for example
+`models.XgBoostDiamond`), so importing a module of the package doesn't import
+the libraries of all the models.
+"""
+
+import importlib
+
+_LAZY_CLASSES = {
+    "LinearRegressorModelDiamond": "models.models_script.linear_regressor_diamond",
+    "XgBoostDiamond": "models.models_script.xgboost_diamond",
+}
+
+__all__ = list(_LAZY_CLASSES)
+
+
+def __getattr__(name: str):
+    if name in _LAZY_CLASSES:
+        return getattr(importlib.import_module(_LAZY_CLASSES[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
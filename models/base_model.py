@@ -2,18 +2,60 @@
 as parent for all the models that will be implemented in the project."""
 
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import importlib
 import json
 from datetime import datetime, timezone
+import shutil
 import sqlite3
-from sklearn.model_selection import train_test_split
+import time
+import uuid
 import numpy as np
+import pandas as pd
 import cloudpickle
+from models.timing import stage
 from setting import DB_PATH, SAVE_PATH_MODELS
 import os
 
 
+ARTIFACT_MANIFEST = "manifest.json"
+
+
+def _take_rows(data, index):
+    """Select the rows at the given positions of a DataFrame, Series or array."""
+    return data.iloc[index] if hasattr(data, "iloc") else data[index]
+
+
 class BaseSupervisedModel(ABC):
 
+    # Hashes (models.utils.row_hashes) of all the rows of the datasets the model
+    # has been trained and evaluated on, used by the incremental training
+    training_row_hashes = None
+    # Hashes of the rows the model has been evaluated on and never fitted on,
+    # the holdout of the incremental training
+    holdout_row_hashes = None
+    # Positions of the rows the model has been fitted on by the last call of
+    # train_pipeline, the test rows excluded
+    trained_rows = None
+    # Hyperparameters chosen by the search, reused by the incremental training
+    hyperparameters = None
+    # Seed of the train/test split and of the cross validation folds
+    random_seed = 42
+    # CPUs used by the training, None for all of them
+    n_threads = None
+    # Cross validation: number of folds (None evaluates on a single split) and
+    # number of folds trained in parallel (None for one per CPU)
+    cv_folds = None
+    cv_jobs = None
+    # Fraction of the rows the models with a hyperparameter search are tuned
+    # on before the cross validation, left out of its folds
+    cv_tuning_fraction = 0.2
+    # Whether the model implements fit_incremental, used by the incremental
+    # training, and fit_fold, used by the cross validation
+    supports_incremental = False
+    supports_folds = False
+
     @property
     @abstractmethod
     def model_name(self) -> str:
@@ -70,6 +112,62 @@ class BaseSupervisedModel(ABC):
             self.model: the fitted model
         """
 
+    def fit_incremental(self, x, y):
+        """
+        Continues the training of the fitted model with new data only. Called
+        only if `supports_incremental` is True.
+
+        Parameters:
+            x: The preprocessed input data of the new rows.
+            y: The preprocessed target data of the new rows.
+        Returns:
+            self.model: the updated model
+        """
+
+    def tune(self, x, y) -> bool:
+        """
+        Chooses the hyperparameters used by fit_fold, for the models that have a
+        hyperparameter search. The cross validation tunes the model on rows that
+        are left out of its folds.
+
+        Parameters:
+            x: The preprocessed input data of the tuning rows.
+            y: The preprocessed target data of the tuning rows.
+        Returns:
+            True if the hyperparameters have been chosen, False if the model has
+            none to tune.
+        """
+        return False
+
+    def fit_fold(self, x, y, n_threads: int):
+        """
+        Trains a model on the training rows of a cross validation fold, with the
+        hyperparameters of the fitted model. Folds are trained in parallel
+        threads: the instance must not be modified. Called only if
+        `supports_folds` is True.
+
+        Parameters:
+            x: The preprocessed input data of the fold.
+            y: The preprocessed target data of the fold.
+            n_threads: The number of CPUs the training can use.
+        Returns:
+            The fitted model of the fold, that predict uses as self.model.
+        """
+
+    def fit_tuned(self, x, y):
+        """
+        Trains the final model of the cross validation on all the rows, with the
+        hyperparameters chosen by tune on a fraction of them. Models can choose
+        again the hyperparameters that depend on the number of rows.
+
+        Parameters:
+            x: The preprocessed input data.
+            y: The preprocessed target data.
+        Returns:
+            self.model: the fitted model
+        """
+        return self.fit_fold(x, y, self.n_threads)
+
     @abstractmethod
     def evaluate(self, y_predicted, y_real):
         """
@@ -107,7 +205,51 @@ class BaseSupervisedModel(ABC):
             The postprocessed data.
         """
 
-    def train_test_split(self, x, y, test_size, seed=np.random.randint(0, 2**16 - 1)):
+    def configure_hyperparameter_search(
+        self,
+        n_trials: int,
+        n_jobs: int,
+        storage: str = None,
+        study_name: str = None,
+        pruner: str = "median",
+        n_threads: int = None,
+    ) -> None:
+        """
+        Configures the hyperparameter search executed by fit. Models without
+        hyperparameter search ignore the configuration.
+
+        Parameters:
+            n_trials: The total number of trials of the search.
+            n_jobs: The number of trials executed in parallel.
+            storage: The URL of the database where the search is persisted,
+                if None the search is kept in memory.
+            study_name: The name of the search in the storage: a search with
+                the same name is resumed.
+            pruner: The algorithm that stops the unpromising trials, "median"
+                or "hyperband".
+            n_threads: The number of CPUs used by the search and the final
+                training, split between the parallel trials. If None all the
+                CPUs are used.
+        """
+
+    def configure_cross_validation(self, n_folds: int, n_jobs: int = None) -> None:
+        """
+        Configures the evaluation of train_pipeline with k-fold cross validation
+        instead of a single train/test split.
+
+        Parameters:
+            n_folds: The number of folds, None to evaluate on a single split.
+            n_jobs: The number of folds trained in parallel, if None one for
+                each CPU. The CPUs of the training are split between them.
+        """
+        if n_folds is not None and n_folds < 2:
+            raise ValueError("The cross validation needs at least 2 folds")
+        if n_folds is not None and not self.supports_folds:
+            raise ValueError(f"{self.model_name} doesn't support cross validation")
+        self.cv_folds = n_folds
+        self.cv_jobs = n_jobs
+
+    def train_test_split(self, x, y, test_size, seed=None):
         """
         Splits the data into training and testing sets.
 
@@ -115,18 +257,105 @@ class BaseSupervisedModel(ABC):
             x: The input data.
             y: The target data.
             test_size: The proportion of the dataset to include in the test split.
-            seed: The seed for the random number generator.
+            seed: The seed for the random number generator, random_seed if None.
 
         Returns:
             The split data: x_train, x_test, y_train, y_test.
         """
+        # Imported here to not load scikit-learn when only predicting
+        from sklearn.model_selection import train_test_split
+
+        if seed is None:
+            seed = self.random_seed
         return train_test_split(x, y, test_size=test_size, random_state=seed)
 
+    def cross_validate(self, x, y) -> dict:
+        """
+        Evaluates the model with k-fold cross validation on preprocessed data.
+
+        The folds are trained by `cv_jobs` threads with fit_fold, each one with
+        an equal share of the CPUs; the libraries of the models release the GIL
+        while training and predicting. The folds share the preprocessed data and
+        only the rows of the folds in progress are copied, so the memory grows
+        with `cv_jobs` and not with the number of folds.
+
+        Parameters:
+            x: The preprocessed input data.
+            y: The preprocessed target data.
+
+        Returns:
+            The mean and the standard deviation ("<metric>_std") over the folds
+            of every metric, and in "folds" the metrics and the seconds spent
+            fitting and predicting of every fold.
+        """
+        # Imported here to not load scikit-learn when only predicting
+        from sklearn.model_selection import KFold
+
+        n_jobs = max(1, min(self.cv_jobs or os.cpu_count() or 1, self.cv_folds))
+        n_threads = max(1, (self.n_threads or os.cpu_count() or 1) // n_jobs)
+        splits = KFold(
+            n_splits=self.cv_folds, shuffle=True, random_state=self.random_seed
+        ).split(np.empty((len(y), 0)))
+
+        def run_fold(split) -> dict:
+            train_index, test_index = split
+            # A shallow copy with its own model and metrics, so that the folds
+            # don't modify the instance or each other
+            fold = copy.copy(self)
+            fold.metrics = {}
+            started = time.perf_counter()
+            fold.model = fold.fit_fold(
+                _take_rows(x, train_index), _take_rows(y, train_index), n_threads
+            )
+            fitted = time.perf_counter()
+            y_pred = fold.postprocessing(fold.predict(_take_rows(x, test_index)))
+            predicted = time.perf_counter()
+            metrics = fold.evaluate(y_pred, fold.postprocessing(_take_rows(y, test_index)))
+            return {
+                **{metric: float(value) for metric, value in metrics.items()},
+                "fit_seconds": fitted - started,
+                "predict_seconds": predicted - fitted,
+            }
+
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            folds = list(executor.map(run_fold, splits))
+
+        results = {}
+        for metric in folds[0]:
+            if metric.endswith("_seconds"):
+                continue
+            values = np.array([fold[metric] for fold in folds])
+            results[metric] = float(values.mean())
+            results[f"{metric}_std"] = float(values.std())
+        results["folds"] = folds
+        return results
+
+    def _split(self, x, y, test_size: float = 0.2) -> tuple:
+        """Split the data with train_test_split, recording the positions of the
+        training rows in `trained_rows`."""
+        positions = np.arange(len(y))
+        train_rows, test_rows, _, _ = self.train_test_split(
+            positions, positions, test_size=test_size
+        )
+        self.trained_rows = train_rows
+        return (
+            _take_rows(x, train_rows),
+            _take_rows(x, test_rows),
+            _take_rows(y, train_rows),
+            _take_rows(y, test_rows),
+        )
+
     def train_pipeline(self, x, y, print_final_metrics=False):
         """
         Executes the complete training pipeline including preprocessing, splitting,
         training, predicting, postprocessing, and evaluating.
 
+        With `cv_folds` (see configure_cross_validation) the data is preprocessed
+        once and the metrics are the ones of the cross validation. The models with
+        a hyperparameter search are tuned on `cv_tuning_fraction` of the rows and
+        cross validated on the others, so no fold is evaluated on rows seen by the
+        search; the final model is trained on all the rows by fit_tuned.
+
         Parameters:
             x: The input data as a pandas DataFrame.
             y: The target data as a pandas DataFrame.
@@ -137,11 +366,69 @@ class BaseSupervisedModel(ABC):
         """
         x = self.input_preprocessing(x)
         y = self.target_preprocessing(y)
-        x_train, x_test, y_train, y_test = self.train_test_split(x, y, test_size=0.2)
+        if self.cv_folds:
+            x_tune, x_eval, y_tune, y_eval = self.train_test_split(
+                x, y, test_size=1 - self.cv_tuning_fraction
+            )
+            if self.tune(x_tune, y_tune):
+                self.metrics = self.cross_validate(x_eval, y_eval)
+                self.model = self.fit_tuned(x, y)
+            else:
+                self.metrics = self.cross_validate(x, y)
+                self.model = self.fit(x, y)
+            self.trained_rows = np.arange(len(y))
+            if print_final_metrics:
+                for metric, value in self.metrics.items():
+                    if metric != "folds" and not metric.endswith("_std"):
+                        print(
+                            f"{metric}: {value} (std {self.metrics[metric + '_std']}, "
+                            f"{self.cv_folds} folds)"
+                        )
+                for i, fold in enumerate(self.metrics["folds"]):
+                    print(
+                        f"fold {i}: fit {fold['fit_seconds']:.2f} s, "
+                        f"predict {fold['predict_seconds']:.2f} s"
+                    )
+            return
+        x_train, x_test, y_train, y_test = self._split(x, y)
         self.model = self.fit(x_train, y_train)
         y_pred = self.predict(x_test)
         y_pred = self.postprocessing(y_pred)
         y_test = self.postprocessing(y_test)
+        # Without the metrics of a previous training, for example the folds of a
+        # cross validated version
+        self.metrics = {}
+        self.metrics = self.evaluate(y_pred, y_test)
+        if print_final_metrics:
+            for metric in self.metrics:
+                print(f"{metric}: {self.metrics[metric]}")
+
+    def train_incremental_pipeline(
+        self, x, y, x_holdout, y_holdout, print_final_metrics=False
+    ):
+        """
+        Executes the training pipeline on the new rows of the dataset only,
+        continuing the training of the fitted model with fit_incremental. The
+        metrics are computed on the holdout rows, that the model is never
+        fitted on.
+
+        Parameters:
+            x: The input data of the new rows as a pandas DataFrame.
+            y: The target data of the new rows as a pandas DataFrame.
+            x_holdout: The input data of the holdout rows as a pandas DataFrame.
+            y_holdout: The target data of the holdout rows as a pandas DataFrame.
+            print_final_metrics: print the final metrics of the process
+        """
+        self.model = self.fit_incremental(
+            self.input_preprocessing(x), self.target_preprocessing(y)
+        )
+        y_pred = self.predict(self.input_preprocessing(x_holdout))
+        y_test = self.target_preprocessing(y_holdout)
+        y_pred = self.postprocessing(y_pred)
+        y_test = self.postprocessing(y_test)
+        # Without the metrics of a previous training, for example the folds of a
+        # cross validated version
+        self.metrics = {}
         self.metrics = self.evaluate(y_pred, y_test)
         if print_final_metrics:
             for metric in self.metrics:
@@ -158,54 +445,255 @@ class BaseSupervisedModel(ABC):
         Returns:
             The postprocessed predictions.
         """
-        x = self.input_preprocessing(x)
-        y_pred = self.predict(x)
-        y_pred = self.postprocessing(y_pred)
+        with stage("preprocessing"):
+            x = self.input_preprocessing(x)
+        with stage("predict"):
+            y_pred = self.predict(x)
+        with stage("postprocessing"):
+            y_pred = self.postprocessing(y_pred)
         return y_pred
 
+    def predict_row(self, row: dict):
+        """
+        Predicts a single validated sample given as a dictionary of features.
+
+        Models can override it with a faster path that doesn't build a
+        DataFrame; the result must be the same of execution_pipeline.
+
+        Parameters:
+            row: The features of the sample, by column name.
+
+        Returns:
+            The postprocessed prediction, as an array with one element.
+        """
+        return self.execution_pipeline(pd.DataFrame([row]))
+
     def save_model_pickle(self, path: str) -> None:
         """Save the model in a pickle file."""
         with open(path, "wb") as f:
             cloudpickle.dump(self, f)
             print("Model saved ")
 
-    def save_model(self, training_dataset_name: str) -> None:
-        """Save the model in the database and as pickle file."""
+    def save_artifact_parts(self, directory: str):
+        """
+        Saves the fitted model in the given directory in the native format of its
+        library (for example arrays or booster files), that can be loaded without
+        deserializing the whole object.
 
-        # Connect to the SQLite database
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        Parameters:
+            directory: The existing directory where the files are written.
 
-        # Calculate the new version number for this model
-        cursor.execute(
-            "SELECT MAX(model_version) FROM models_history WHERE model_name = ?",
-            (self.model_name,),
-        )
-        max_version = cursor.fetchone()[0]
-        new_version = 1 if max_version is None else max_version + 1
+        Returns:
+            A dictionary with the information needed by load_artifact_parts,
+            stored in the manifest of the artifact, or None if the model has no
+            native format and has to be saved as pickle.
+        """
+        return None
 
-        pickle_path = os.path.join(
-            SAVE_PATH_MODELS, self.model_name + str(new_version) + ".pkl"
-        )
-        # Insert the new model's details
-        cursor.execute(
+    @classmethod
+    def load_artifact_parts(cls, directory: str, parts: dict):
+        """
+        Loads a model saved by save_artifact_parts.
+
+        Parameters:
+            directory: The directory of the artifact.
+            parts: The dictionary returned by save_artifact_parts.
+
+        Returns:
+            The fitted model instance.
+        """
+        raise NotImplementedError
+
+    def save_artifact(self, directory: str) -> bool:
+        """
+        Save the model as artifact: a directory with the files written by
+        save_artifact_parts and a manifest that ties them together.
+
+        Returns:
+            True if the artifact has been saved, False if the model doesn't
+            support the artifact format.
+        """
+        os.makedirs(directory, exist_ok=True)
+        parts = self.save_artifact_parts(directory)
+        if parts is None:
+            os.rmdir(directory)
+            return False
+        manifest = {
+            "format_version": 1,
+            "module": type(self).__module__,
+            "class": type(self).__qualname__,
+            "model_name": self.model_name,
+            "metrics": self.metrics,
+            "hyperparameters": self.hyperparameters,
+            "parts": parts,
+        }
+        if self.training_row_hashes is not None:
+            np.save(os.path.join(directory, "row_hashes.npy"), self.training_row_hashes)
+            manifest["row_hashes"] = "row_hashes.npy"
+        if self.holdout_row_hashes is not None:
+            np.save(
+                os.path.join(directory, "holdout_row_hashes.npy"), self.holdout_row_hashes
+            )
+            manifest["holdout_row_hashes"] = "holdout_row_hashes.npy"
+        with open(os.path.join(directory, ARTIFACT_MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2)
+        print("Model saved ")
+        return True
+
+    @staticmethod
+    def load_artifact(directory: str):
+        """
+        Load a model saved with save_artifact. Only the module of the model class
+        written in the manifest is imported.
+        """
+        with open(os.path.join(directory, ARTIFACT_MANIFEST)) as f:
+            manifest = json.load(f)
+        module = importlib.import_module(manifest["module"])
+        model_class = getattr(module, manifest["class"])
+        model = model_class.load_artifact_parts(directory, manifest["parts"])
+        model.metrics = manifest["metrics"]
+        model.hyperparameters = manifest.get("hyperparameters")
+        if "row_hashes" in manifest:
+            model.training_row_hashes = np.load(
+                os.path.join(directory, manifest["row_hashes"]), mmap_mode="r"
+            )
+        if "holdout_row_hashes" in manifest:
+            model.holdout_row_hashes = np.load(
+                os.path.join(directory, manifest["holdout_row_hashes"]), mmap_mode="r"
+            )
+        return model
+
+    @staticmethod
+    def load_saved_model(path: str):
+        """Load a model saved by save_model: an artifact directory or a pickle file."""
+        if os.path.isdir(path):
+            return BaseSupervisedModel.load_artifact(path)
+        with open(path, "rb") as file:
+            return cloudpickle.load(file)
+
+    @staticmethod
+    def load_latest_model(model_name: str):
+        """
+        Load the latest registered version of a model.
+
+        Returns:
+            The version and the loaded model, or None if the model has never
+            been saved.
+        """
+        conn = sqlite3.connect(DB_PATH)
+        record = conn.execute(
             """
-            INSERT INTO models_history (model_name, model_version, training_dataset, metrics, 
-            created, model_description,model_pickle_path)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """,
-            (
-                self.model_name,
-                new_version,
-                training_dataset_name,
-                json.dumps(self.metrics),
-                datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
-                self.model_description,
-                pickle_path,
-            ),
-        )
-        self.save_model_pickle(path=pickle_path)
+            SELECT model_version, model_pickle_path
+            FROM models_history
+            WHERE model_name = ?
+            ORDER BY model_version DESC
+            LIMIT 1
+            """,
+            (model_name,),
+        ).fetchone()
+        conn.close()
+        if record is None:
+            return None
+        return record[0], BaseSupervisedModel.load_saved_model(record[1])
+
+    def save_model(self, training_dataset_name: str) -> int:
+        """Save the model in the database and as artifact, or as pickle file if
+        the model doesn't support the artifact format.
 
-        # Commit and close
-        conn.commit()
+        The model is first written under a temporary name, then the version is
+        allocated, the files renamed and the record inserted in one immediate
+        transaction: concurrent trainings of the same model get different
+        versions, and the database is locked only for the rename.
+
+        Returns:
+            The version of the saved model.
+        """
+        os.makedirs(SAVE_PATH_MODELS, exist_ok=True)
+        temporary_path = os.path.join(
+            SAVE_PATH_MODELS, f".{self.model_name}-{os.getpid()}-{uuid.uuid4().hex}"
+        )
+        extension = ""
+        if not self.save_artifact(temporary_path):
+            extension = ".pkl"
+            temporary_path += extension
+            self.save_model_pickle(path=temporary_path)
+
+        # Connect to the SQLite database, the transaction is handled explicitly
+        conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+        cursor = conn.cursor()
+        try:
+            # Take the write lock before reading the versions, so that no other
+            # training can allocate the same one
+            cursor.execute("BEGIN IMMEDIATE")
+
+            # Calculate the new version number for this model
+            cursor.execute(
+                "SELECT MAX(model_version) FROM models_history WHERE model_name = ?",
+                (self.model_name,),
+            )
+            max_version = cursor.fetchone()[0]
+            new_version = 1 if max_version is None else max_version + 1
+
+            model_path = (
+                os.path.join(SAVE_PATH_MODELS, self.model_name + str(new_version))
+                + extension
+            )
+            # Files of an unregistered version, left by an interrupted save
+            if os.path.isdir(model_path):
+                shutil.rmtree(model_path)
+            os.replace(temporary_path, model_path)
+
+            # Insert the new model's details
+            cursor.execute(
+                """
+                INSERT INTO models_history (model_name, model_version, training_dataset, metrics, 
+                created, model_description,model_pickle_path)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+                (
+                    self.model_name,
+                    new_version,
+                    training_dataset_name,
+                    json.dumps(self.metrics),
+                    datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+                    self.model_description,
+                    model_path,
+                ),
+            )
+            cursor.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                cursor.execute("ROLLBACK")
+            if os.path.isdir(temporary_path):
+                shutil.rmtree(temporary_path)
+            elif os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        finally:
+            conn.close()
+        return new_version
+
+    @staticmethod
+    def promote(model_name: str, version: int, metrics: dict) -> None:
+        """Make a saved version of a model the promoted one, used by the requests
+        that don't give a model name."""
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        with conn:
+            conn.execute(
+                """
+                INSERT INTO promoted_model (id, model_name, model_version, metrics, promoted)
+                VALUES (1, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    model_name = excluded.model_name,
+                    model_version = excluded.model_version,
+                    metrics = excluded.metrics,
+                    promoted = excluded.promoted
+                """,
+                (
+                    model_name,
+                    version,
+                    json.dumps(metrics),
+                    datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+                ),
+            )
         conn.close()
@@ -0,0 +1,154 @@
+"""In this file is implemented the binary cache of the CSV datasets.
+
+The first time a CSV file is loaded it is converted to a typed columnar format:
+one `.npy` file per column, with the categorical columns stored as integer codes
+and the numerical ones as float32 (integers as int32 when they fit). The
+following loads memory map the `.npy` files, so the DataFrame is built without
+parsing and without copying the data.
+
+The cache of a file is valid as long as the file has the same modification time
+and size; if they change the content hash is computed again and the cache is
+rebuilt only if the content has really changed.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from models.utils import CUT_CATEGORIES, COLOR_CATEGORIES, CLARITY_CATEGORIES
+from setting import DATASET_CACHE_PATH
+
+# Categories of the known categorical columns, in the order used by the models
+KNOWN_CATEGORIES = {
+    "cut": CUT_CATEGORIES,
+    "color": COLOR_CATEGORIES,
+    "clarity": CLARITY_CATEGORIES,
+}
+MANIFEST_NAME = "manifest.json"
+
+
+def _cache_dir(path: Path) -> Path:
+    key = hashlib.sha1(str(Path(path).resolve()).encode("utf8")).hexdigest()[:16]
+    return Path(DATASET_CACHE_PATH) / key
+
+
+def _content_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_manifest(cache_dir: Path):
+    try:
+        with open(cache_dir / MANIFEST_NAME) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(cache_dir: Path, manifest: dict) -> None:
+    # The manifest is replaced atomically, a concurrent reader sees either the
+    # old or the new one
+    tmp_path = cache_dir / (MANIFEST_NAME + f".{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, cache_dir / MANIFEST_NAME)
+
+
+def _encode_column(values: pd.Series):
+    """Return the array to store and, for categorical columns, the categories."""
+    if pd.api.types.is_bool_dtype(values):
+        return values.to_numpy(), None
+    if pd.api.types.is_integer_dtype(values):
+        info = np.iinfo(np.int32)
+        if values.min() >= info.min and values.max() <= info.max:
+            return values.to_numpy(dtype=np.int32), None
+        return values.to_numpy(dtype=np.int64), None
+    if pd.api.types.is_numeric_dtype(values):
+        return values.to_numpy(dtype=np.float32), None
+
+    categories = list(KNOWN_CATEGORIES.get(values.name, []))
+    known = set(categories)
+    categories += sorted(
+        str(value) for value in values.dropna().unique() if value not in known
+    )
+    # The codes have the smallest integer type for the number of categories
+    return pd.Categorical(values, categories=categories).codes, categories
+
+
+def _build(path: Path, cache_dir: Path, signature: dict) -> dict:
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    df = pd.read_csv(path)
+    columns = []
+    for i, name in enumerate(df.columns):
+        values, categories = _encode_column(df[name])
+        file_name = f"{signature['content_hash'][:16]}_{i}.npy"
+        np.save(cache_dir / file_name, values)
+        columns.append({"name": name, "file": file_name, "categories": categories})
+
+    manifest = dict(signature, columns=columns)
+    previous = _read_manifest(cache_dir)
+    _write_manifest(cache_dir, manifest)
+
+    # Remove the columns of the previous version of the file
+    if previous is not None:
+        current_files = {column["file"] for column in columns}
+        for column in previous.get("columns", []):
+            if column["file"] not in current_files:
+                try:
+                    os.unlink(cache_dir / column["file"])
+                except OSError:
+                    pass
+    return manifest
+
+
+def _load(cache_dir: Path, manifest: dict) -> pd.DataFrame:
+    data = {}
+    for column in manifest["columns"]:
+        values = np.load(cache_dir / column["file"], mmap_mode="r")
+        if column["categories"] is not None:
+            values = pd.Categorical.from_codes(values, categories=column["categories"])
+        data[column["name"]] = values
+    return pd.DataFrame(data, copy=False)
+
+
+def load_cached_df(path: str) -> pd.DataFrame:
+    """
+    Load a CSV file through the binary cache, building the cache if needed.
+
+    Parameters:
+    - path (str): The file path to the CSV file.
+
+    Returns:
+    - pd.DataFrame: The loaded DataFrame, with categorical columns for the text
+      columns and float32 numerical columns, backed by memory mapped arrays.
+    """
+    path = Path(path)
+    stat = os.stat(path)
+    cache_dir = _cache_dir(path)
+    manifest = _read_manifest(cache_dir)
+
+    if (
+        manifest is not None
+        and manifest["mtime_ns"] == stat.st_mtime_ns
+        and manifest["size"] == stat.st_size
+    ):
+        return _load(cache_dir, manifest)
+
+    signature = {
+        "path": str(path.resolve()),
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "content_hash": _content_hash(path),
+    }
+    if manifest is not None and manifest["content_hash"] == signature["content_hash"]:
+        # The file has been touched but not changed
+        manifest.update(signature)
+        _write_manifest(cache_dir, manifest)
+        return _load(cache_dir, manifest)
+
+    return _load(cache_dir, _build(path, cache_dir, signature))
@@ -1,10 +1,42 @@
 """This module provides functionality to retrieve specific model instances.
 
-It defines a function `get_model` that returns an instance of a model based on 
-the provided model name.
+It defines the registry of the available models, that maps the name of every
+model to the module and the class that implements it, and a function `get_model`
+that returns an instance of a model based on the provided model name. The module
+of a model is imported only when the model is first requested, so the libraries
+of the other models are not loaded.
 """
 
-import models
+import importlib
+
+# Name of the model -> "module:class" of its implementation
+MODEL_REGISTRY = {
+    "Linear Regressor": "models.models_script.linear_regressor_diamond:LinearRegressorModelDiamond",
+    "XgBoost": "models.models_script.xgboost_diamond:XgBoostDiamond",
+}
+
+
+def available_models() -> list:
+    """Return the names of the supported models."""
+    return list(MODEL_REGISTRY)
+
+
+def get_model_class(model_name: str):
+    """Retrieve the class of a model based on the model name, importing its module.
+
+    Args:
+    model_name (str): The name of the model to retrieve.
+
+    Returns:
+    type: The class of the requested model, a subclass of models.BaseModel.
+
+    Raises:
+    ValueError: If the specified model name does not match any supported models.
+    """
+    if model_name not in MODEL_REGISTRY:
+        raise ValueError("Model not supported")
+    module_name, class_name = MODEL_REGISTRY[model_name].split(":")
+    return getattr(importlib.import_module(module_name), class_name)
 
 
 def get_model(model_name: str):
@@ -19,9 +51,4 @@ def get_model(model_name: str):
     Raises:
     ValueError: If the specified model name does not match any supported models.
     """
-    if model_name == models.LinearRegressorModelDiamond().model_name:
-        return models.LinearRegressorModelDiamond()
-    elif model_name == models.XgBoostDiamond().model_name:
-        return models.XgBoostDiamond()
-    else:
-        raise ValueError("Model not supported")
+    return get_model_class(model_name)()
@@ -1,8 +1,11 @@
+import os
 import pandas as pd
 import numpy as np
 from sklearn.linear_model import LinearRegression
 from sklearn.metrics import r2_score, mean_absolute_error
 from models.base_model import BaseSupervisedModel
+from models.timing import stage
+from models.utils import FEATURE_COLUMNS
 from sklearn.preprocessing import OneHotEncoder
 
 
@@ -15,12 +18,11 @@ class LinearRegressorModelDiamond(BaseSupervisedModel):
     metrics = {"r2": [], "mae": []}
 
     ohe = OneHotEncoder(drop="first")
+    dropped_columns = ["cut", "color", "clarity", "depth", "table", "y", "z"]
 
     def input_preprocessing(self, x: pd.DataFrame) -> np.array:
         # Dropping unnecessary columns
-        x_numeric = x.drop(
-            columns=["cut", "color", "clarity", "depth", "table", "y", "z"]
-        )
+        x_numeric = x.drop(columns=self.dropped_columns)
 
         # Selecting only the categorical columns for one-hot encoding
         x_categorical = x[["cut", "color", "clarity"]]
@@ -40,10 +42,46 @@ class LinearRegressorModelDiamond(BaseSupervisedModel):
     def target_preprocessing(y: np.array) -> np.array:
         return np.log(y)
 
+    # Sums of the products of the features, with a leading column of ones for
+    # the intercept, (X^T X, X^T y): the fit can be updated with new rows
+    sufficient_statistics = None
+
+    supports_folds = True
+
+    @property
+    def supports_incremental(self) -> bool:
+        # The models saved without the sufficient statistics are trained from scratch
+        return self.sufficient_statistics is not None
+
+    @staticmethod
+    def _normal_equations(x, y) -> tuple:
+        design = np.hstack((np.ones((len(x), 1)), np.asarray(x, dtype=np.float64)))
+        return design.T @ design, design.T @ np.asarray(y, dtype=np.float64)
+
     def fit(self, x, y):
         self.model.fit(x, y)
+        self.sufficient_statistics = self._normal_equations(x, y)
         return self.model
 
+    def fit_fold(self, x, y, n_threads: int):
+        return LinearRegression().fit(x, y)
+
+    def fit_incremental(self, x, y):
+        """Add the new rows to the sufficient statistics and solve again the
+        least squares problem, that has the same solution of a fit on all the rows
+        the model has been trained on."""
+        xtx, xty = self._normal_equations(x, y)
+        xtx = self.sufficient_statistics[0] + xtx
+        xty = self.sufficient_statistics[1] + xty
+        solution = np.linalg.lstsq(xtx, xty, rcond=None)[0]
+
+        model = LinearRegression()
+        model.coef_ = solution[1:]
+        model.intercept_ = solution[0]
+        model.n_features_in_ = len(model.coef_)
+        self.sufficient_statistics = (xtx, xty)
+        return model
+
     def evaluate(self, y_predicted, y_real):
         r2 = r2_score(y_real, y_predicted)
         mae = mean_absolute_error(y_real, y_predicted)
@@ -57,3 +95,111 @@ class LinearRegressorModelDiamond(BaseSupervisedModel):
     @staticmethod
     def postprocessing(y: np.array) -> np.array:
         return np.exp(y)
+
+    def _row_tables(self) -> tuple:
+        """
+        Return the positions of the features in the preprocessed vector: the
+        numerical columns and, for every categorical column, a dictionary from
+        category to position (None for the dropped category). The tables are
+        rebuilt when the model is fitted again.
+        """
+        tables = self.__dict__.get("_row_tables_cache")
+        if tables is not None and tables[0] is self.model.coef_:
+            return tables[1:]
+
+        numeric_columns = [
+            column for column in FEATURE_COLUMNS if column not in self.dropped_columns
+        ]
+        position = len(numeric_columns)
+        categorical_positions = []
+        for feature, categories, drop_index in zip(
+            self.ohe.feature_names_in_, self.ohe.categories_, self.ohe.drop_idx_
+        ):
+            positions = {}
+            for i, category in enumerate(categories):
+                if drop_index is not None and i == drop_index:
+                    positions[category] = None
+                else:
+                    positions[category] = position
+                    position += 1
+            categorical_positions.append((feature, positions))
+
+        self._row_tables_cache = (
+            self.model.coef_,
+            numeric_columns,
+            categorical_positions,
+            position,
+        )
+        return self._row_tables_cache[1:]
+
+    def predict_row(self, row: dict) -> np.array:
+        with stage("preprocessing"):
+            numeric_columns, categorical_positions, num_features = self._row_tables()
+            x = np.zeros((1, num_features))
+            for i, column in enumerate(numeric_columns):
+                x[0, i] = row[column]
+            for feature, positions in categorical_positions:
+                position = positions[row[feature]]
+                if position is not None:
+                    x[0, position] = 1.0
+
+        # Same operations of LinearRegression.predict and postprocessing
+        with stage("predict"):
+            y_pred = x @ self.model.coef_.T + self.model.intercept_
+        with stage("postprocessing"):
+            return self.postprocessing(y_pred)
+
+    def save_artifact_parts(self, directory: str) -> dict:
+        np.save(os.path.join(directory, "coef.npy"), self.model.coef_)
+        np.save(os.path.join(directory, "intercept.npy"), np.asarray(self.model.intercept_))
+        encoder_features = list(self.ohe.feature_names_in_)
+        for feature, categories in zip(encoder_features, self.ohe.categories_):
+            np.save(
+                os.path.join(directory, f"categories_{feature}.npy"),
+                categories.astype(str),
+            )
+        parts = {
+            "coef": "coef.npy",
+            "intercept": "intercept.npy",
+            "encoder_features": encoder_features,
+        }
+        if self.sufficient_statistics is not None:
+            np.save(os.path.join(directory, "xtx.npy"), self.sufficient_statistics[0])
+            np.save(os.path.join(directory, "xty.npy"), self.sufficient_statistics[1])
+            parts["sufficient_statistics"] = ["xtx.npy", "xty.npy"]
+        return parts
+
+    @classmethod
+    def load_artifact_parts(cls, directory: str, parts: dict):
+        instance = cls()
+        instance.model = LinearRegression()
+        instance.model.coef_ = np.load(os.path.join(directory, parts["coef"]), mmap_mode="r")
+        instance.model.intercept_ = np.load(os.path.join(directory, parts["intercept"]))[()]
+        instance.model.n_features_in_ = instance.model.coef_.shape[0]
+        if "sufficient_statistics" in parts:
+            instance.sufficient_statistics = tuple(
+                np.load(os.path.join(directory, file)) for file in parts["sufficient_statistics"]
+            )
+
+        # The encoder is rebuilt by fitting it with the saved categories on a
+        # frame that contains each of them
+        categories = [
+            np.load(os.path.join(directory, f"categories_{feature}.npy")).tolist()
+            for feature in parts["encoder_features"]
+        ]
+        num_rows = max(len(feature_categories) for feature_categories in categories)
+        encoder_data = pd.DataFrame(
+            {
+                feature: [
+                    feature_categories[i % len(feature_categories)]
+                    for i in range(num_rows)
+                ]
+                for feature, feature_categories in zip(
+                    parts["encoder_features"], categories
+                )
+            }
+        )
+        instance.ohe = OneHotEncoder(categories=categories, drop="first").fit(
+            encoder_data
+        )
+        return instance
@@ -1,9 +1,37 @@
+import os
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING
+import numpy as np
 import pandas as pd
 import xgboost
-import optuna
-from sklearn.metrics import r2_score, mean_absolute_error
-from sklearn.model_selection import train_test_split
 from models.base_model import BaseSupervisedModel
+from models.timing import stage
+from models.tree_ensemble import TreeEnsemble
+from models.utils import CUT_CATEGORIES, COLOR_CATEGORIES, CLARITY_CATEGORIES
+from setting import TREE_ENSEMBLE_MAX_ROWS
+
+# optuna is imported only by the hyperparameter search
+if TYPE_CHECKING:
+    import optuna
+
+
+class _OptunaPruningCallback(xgboost.callback.TrainingCallback):
+    """Reports the validation MAE of the boosting rounds to an optuna trial and
+    stops the training when the pruner decides the trial is not promising."""
+
+    def __init__(self, trial: "optuna.trial.Trial", report_interval: int):
+        self.trial = trial
+        self.report_interval = report_interval
+
+    def after_iteration(self, model, epoch: int, evals_log: dict) -> bool:
+        if (epoch + 1) % self.report_interval:
+            return False
+        self.trial.report(evals_log["validation_0"]["mae"][-1], step=epoch + 1)
+        if self.trial.should_prune():
+            import optuna
+
+            raise optuna.TrialPruned()
+        return False
 
 
 class XgBoostDiamond(BaseSupervisedModel):
@@ -16,20 +44,53 @@ class XgBoostDiamond(BaseSupervisedModel):
     )
     metrics = {"r2": [], "mae": []}
 
+    # Hyperparameter search
+    n_trials = 100
+    n_jobs = 1
+    study_storage = None
+    study_name = None
+    pruner = "median"
+    # Boosting rounds without improvement of the validation MAE that stop a trial
+    early_stopping_rounds = 50
+    # Largest number of boosting rounds of a trial
+    max_n_estimators = 1000
+    # Boosting rounds between two reports of the validation MAE to the pruner
+    pruning_report_interval = 10
+
+    # Boosting rounds added by the incremental training
+    incremental_rounds = 100
+
+    supports_incremental = True
+    supports_folds = True
+
+    # Batches up to this number of rows are predicted with the NumPy evaluator
+    # of models/tree_ensemble.py instead of the booster
+    tree_ensemble_max_rows = TREE_ENSEMBLE_MAX_ROWS
+
+    def configure_hyperparameter_search(
+        self,
+        n_trials: int,
+        n_jobs: int,
+        storage: str = None,
+        study_name: str = None,
+        pruner: str = "median",
+        n_threads: int = None,
+    ) -> None:
+        self.n_trials = n_trials
+        self.n_jobs = n_jobs
+        self.study_storage = storage
+        self.study_name = study_name
+        self.pruner = pruner
+        self.n_threads = n_threads
+
     @staticmethod
     def input_preprocessing(x: pd.DataFrame) -> pd.DataFrame:
-        x["cut"] = pd.Categorical(
-            x["cut"],
-            categories=["Fair", "Good", "Very Good", "Ideal", "Premium"],
-            ordered=True,
-        )
+        x["cut"] = pd.Categorical(x["cut"], categories=CUT_CATEGORIES, ordered=True)
         x["color"] = pd.Categorical(
-            x["color"], categories=["D", "E", "F", "G", "H", "I", "J"], ordered=True
+            x["color"], categories=COLOR_CATEGORIES, ordered=True
         )
         x["clarity"] = pd.Categorical(
-            x["clarity"],
-            categories=["IF", "VVS1", "VVS2", "VS1", "VS2", "SI1", "SI2", "I1"],
-            ordered=True,
+            x["clarity"], categories=CLARITY_CATEGORIES, ordered=True
         )
         return x
 
@@ -38,14 +99,63 @@ class XgBoostDiamond(BaseSupervisedModel):
         return y
 
     def fit(self, x: pd.DataFrame, y: pd.DataFrame):
-        best_params = self.optimize_hyperparam(x, y)
-        self.model = xgboost.XGBRegressor(
-            **best_params, enable_categorical=True, random_state=42
-        )
-        self.model.fit(x, y)
+        self.tune(x, y)
+        self.model = self.fit_fold(x, y, self.n_threads)
         return self.model
 
+    def tune(self, x: pd.DataFrame, y: pd.DataFrame) -> bool:
+        self.hyperparameters = self.optimize_hyperparam(x, y)
+        return True
+
+    def fit_fold(self, x: pd.DataFrame, y: pd.DataFrame, n_threads: int):
+        """Train a booster with the hyperparameters found by tune."""
+        model = xgboost.XGBRegressor(
+            **(self.hyperparameters or {}),
+            enable_categorical=True,
+            random_state=42,
+            n_jobs=n_threads,
+        )
+        model.fit(x, y)
+        return model
+
+    def fit_tuned(self, x: pd.DataFrame, y: pd.DataFrame):
+        """Choose again the number of trees by early stopping on a validation split
+        of all the rows, the search has chosen it on the tuning rows only, then
+        train a booster on all the rows."""
+        from sklearn.model_selection import train_test_split
+
+        x_train, x_val, y_train, y_val = train_test_split(
+            x, y, test_size=0.2, random_state=42
+        )
+        params = dict(self.hyperparameters or {})
+        params["n_estimators"] = self.max_n_estimators
+        model = xgboost.XGBRegressor(
+            **params,
+            enable_categorical=True,
+            random_state=42,
+            n_jobs=self.n_threads,
+            eval_metric="mae",
+            early_stopping_rounds=self.early_stopping_rounds,
+        )
+        model.fit(x_train, y_train, eval_set=[(x_val, y_val)], verbose=False)
+        self.hyperparameters = {**params, "n_estimators": model.best_iteration + 1}
+        return self.fit_fold(x, y, self.n_threads)
+
+    def fit_incremental(self, x: pd.DataFrame, y: pd.DataFrame):
+        """Add `incremental_rounds` trees, fitted on the new rows, to the booster,
+        with the hyperparameters of the previous search."""
+        params = dict(self.hyperparameters or {})
+        params["n_estimators"] = self.incremental_rounds
+        previous = self.model.get_booster()
+        model = xgboost.XGBRegressor(
+            **params, enable_categorical=True, random_state=42, n_jobs=self.n_threads
+        )
+        model.fit(x, y, xgb_model=previous)
+        return model
+
     def evaluate(self, y_predicted: pd.DataFrame, y_real: pd.DataFrame):
+        from sklearn.metrics import r2_score, mean_absolute_error
+
         r2 = r2_score(y_real, y_predicted)
         mae = mean_absolute_error(y_real, y_predicted)
         self.metrics["r2"] = r2
@@ -53,16 +163,185 @@ class XgBoostDiamond(BaseSupervisedModel):
         return self.metrics
 
     def predict(self, x: pd.DataFrame):
+        if len(x) <= self.tree_ensemble_max_rows:
+            return self._tree_ensemble().predict(self._frame_matrix(x))
         return self.model.predict(x)
 
     @staticmethod
     def postprocessing(y: pd.DataFrame):
         return y
 
-    @staticmethod
-    def optimize_hyperparam(x: pd.DataFrame, y: pd.DataFrame) -> None:
+    def _row_tables(self) -> tuple:
+        """
+        Return the booster, the columns in the order of its features with the
+        category to code dictionary of the categorical ones, and the range of
+        trees used by predict. The tables are rebuilt when the model is fitted
+        again.
+        """
+        booster = self.model.get_booster()
+        tables = self.__dict__.get("_row_tables_cache")
+        if tables is not None and tables[0] is booster:
+            return tables
+
+        categories = {
+            "cut": CUT_CATEGORIES,
+            "color": COLOR_CATEGORIES,
+            "clarity": CLARITY_CATEGORIES,
+        }
+        columns = [
+            (
+                feature,
+                {category: code for code, category in enumerate(categories[feature])}
+                if feature in categories
+                else None,
+            )
+            for feature in booster.feature_names
+        ]
+        try:
+            iteration_range = (0, self.model.best_iteration + 1)
+        except AttributeError:
+            iteration_range = (0, 0)
 
-        def objective(trial: optuna.trial.Trial) -> float:
+        self._row_tables_cache = (booster, columns, iteration_range)
+        return self._row_tables_cache
+
+    def predict_row(self, row: dict) -> np.array:
+        with stage("preprocessing"):
+            booster, columns, iteration_range = self._row_tables()
+            x = np.empty((1, len(columns)), dtype=np.float32)
+            for i, (column, codes) in enumerate(columns):
+                x[0, i] = codes[row[column]] if codes is not None else row[column]
+        with stage("predict"):
+            if self.tree_ensemble_max_rows >= 1:
+                y_pred = self._tree_ensemble().predict(x)
+            else:
+                y_pred = booster.inplace_predict(x, iteration_range=iteration_range)
+        with stage("postprocessing"):
+            return self.postprocessing(y_pred)
+
+    def _tree_ensemble(self) -> TreeEnsemble:
+        """
+        Return the trees used by predict exported as NumPy arrays, loaded from
+        the artifact or exported from the booster at the first call.
+        """
+        booster = self.model.get_booster()
+        cached = self.__dict__.get("_tree_ensemble_cache")
+        if cached is not None and cached[0] is booster:
+            return cached[1]
+        _, _, iteration_range = self._row_tables()
+        ensemble = TreeEnsemble.from_booster(booster, iteration_range[1] or None)
+        self._tree_ensemble_cache = (booster, ensemble)
+        return ensemble
+
+    def _frame_matrix(self, x: pd.DataFrame) -> np.array:
+        """Return the preprocessed DataFrame as float32 matrix, with the codes
+        of the categorical columns and NaN for the missing values."""
+        feature_names = self.model.get_booster().feature_names
+        matrix = np.empty((len(x), len(feature_names)), dtype=np.float32)
+        for i, column in enumerate(feature_names):
+            values = x[column]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                codes = values.cat.codes.to_numpy()
+                matrix[:, i] = np.where(codes == -1, np.nan, codes)
+            else:
+                matrix[:, i] = values.to_numpy(dtype=np.float32, na_value=np.nan)
+        return matrix
+
+    def save_artifact_parts(self, directory: str) -> dict:
+        self.model.save_model(os.path.join(directory, "booster.ubj"))
+        parts = {"booster": "booster.ubj"}
+        # The exported trees are saved only when the NumPy evaluator is used,
+        # otherwise they are built from the booster if it is enabled later
+        if self.tree_ensemble_max_rows >= 1:
+            self._tree_ensemble().save(os.path.join(directory, "trees.npz"))
+            parts["trees"] = "trees.npz"
+        return parts
+
+    @classmethod
+    def load_artifact_parts(cls, directory: str, parts: dict):
+        instance = cls()
+        instance.model = xgboost.XGBRegressor()
+        instance.model.load_model(os.path.join(directory, parts["booster"]))
+        if "trees" in parts:
+            instance._tree_ensemble_cache = (
+                instance.model.get_booster(),
+                TreeEnsemble.load(os.path.join(directory, parts["trees"])),
+            )
+        return instance
+
+    def _create_study(self) -> "optuna.study.Study":
+        """
+        Create the study of the hyperparameter search, or load it if a study with
+        the same name is already in the storage.
+
+        A new study in a persistent storage is warm-started with the best
+        parameters of the most recent study of the storage, queued as first trial.
+        """
+        import optuna
+
+        study_name = self.study_name or "Diamonds XGBoost " + datetime.now(
+            timezone.utc
+        ).strftime("%Y-%m-%d %H:%M:%S")
+        if self.pruner == "hyperband":
+            pruner = optuna.pruners.HyperbandPruner(
+                min_resource=self.pruning_report_interval, max_resource=1000
+            )
+        elif self.pruner == "median":
+            pruner = optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=50)
+        else:
+            raise ValueError("Pruner must be 'median' or 'hyperband'")
+        if self.study_storage is None:
+            return optuna.create_study(
+                direction="minimize", study_name=study_name, pruner=pruner
+            )
+
+        previous_studies = [
+            summary
+            for summary in optuna.get_all_study_summaries(self.study_storage)
+            if summary.best_trial is not None
+        ]
+        study = optuna.create_study(
+            direction="minimize",
+            study_name=study_name,
+            storage=self.study_storage,
+            pruner=pruner,
+            load_if_exists=True,
+        )
+        if not study.trials and previous_studies:
+            latest = max(
+                (summary for summary in previous_studies if summary.study_name != study_name),
+                key=lambda summary: summary.datetime_start,
+                default=None,
+            )
+            if latest is not None:
+                study.enqueue_trial(latest.best_trial.params)
+        return study
+
+    def optimize_hyperparam(self, x: pd.DataFrame, y: pd.DataFrame) -> dict:
+        """
+        Search the hyperparameters of the model minimizing the MAE on a validation set.
+
+        `n_jobs` trials are executed in parallel threads, each one training with
+        an equal share of the `n_threads` CPUs (all of them if None). The search
+        stops when the study has `n_trials` finished trials, including the ones of
+        previous runs of a resumed study.
+
+        Every trial stops adding trees when the validation MAE doesn't improve for
+        `early_stopping_rounds` rounds, and is pruned if its intermediate MAE is
+        worse than the one of the previous trials at the same round. The returned
+        `n_estimators` is the number of trees of the best trial at its best round.
+        """
+        from sklearn.metrics import mean_absolute_error
+        from sklearn.model_selection import train_test_split
+
+        threads_per_trial = max(1, (self.n_threads or os.cpu_count() or 1) // self.n_jobs)
+
+        # Split the training data into training and validation sets
+        x_train, x_val, y_train, y_val = train_test_split(
+            x, y, test_size=0.2, random_state=42
+        )
+
+        def objective(trial: "optuna.trial.Trial") -> float:
             # Define hyperparameters to tune
             param = {
                 "lambda": trial.suggest_float("lambda", 1e-8, 1.0, log=True),
@@ -76,23 +355,27 @@ class XgBoostDiamond(BaseSupervisedModel):
                 "learning_rate": trial.suggest_float(
                     "learning_rate", 1e-8, 1.0, log=True
                 ),
-                "n_estimators": trial.suggest_int("n_estimators", 100, 1000),
+                "n_estimators": trial.suggest_int(
+                    "n_estimators", 100, self.max_n_estimators
+                ),
                 "max_depth": trial.suggest_int("max_depth", 3, 9),
                 "random_state": 42,
                 "min_child_weight": trial.suggest_int("min_child_weight", 1, 10),
                 "enable_categorical": True,
+                "n_jobs": threads_per_trial,
+                "eval_metric": "mae",
+                "early_stopping_rounds": self.early_stopping_rounds,
+                "callbacks": [
+                    _OptunaPruningCallback(trial, self.pruning_report_interval)
+                ],
             }
 
-            # Split the training data into training and validation sets
-            x_train, x_val, y_train, y_val = train_test_split(
-                x, y, test_size=0.2, random_state=42
-            )
-
             # Train the model
             model = xgboost.XGBRegressor(**param)
-            model.fit(x_train, y_train)
+            model.fit(x_train, y_train, eval_set=[(x_val, y_val)], verbose=False)
+            trial.set_user_attr("best_iteration", model.best_iteration)
 
-            # Make predictions
+            # Make predictions, with the trees up to the best iteration
             preds = model.predict(x_val)
 
             # Calculate MAE
@@ -100,6 +383,16 @@ class XgBoostDiamond(BaseSupervisedModel):
 
             return mae
 
-        study = optuna.create_study(direction="minimize", study_name="Diamonds XGBoost")
-        study.optimize(objective, n_trials=100)
-        return study.best_params
+        study = self._create_study()
+        finished_trials = len(
+            [trial for trial in study.trials if trial.state.is_finished()]
+        )
+        remaining_trials = max(0, self.n_trials - finished_trials)
+        if remaining_trials:
+            study.optimize(objective, n_trials=remaining_trials, n_jobs=self.n_jobs)
+
+        best_params = dict(study.best_params)
+        best_iteration = study.best_trial.user_attrs.get("best_iteration")
+        if best_iteration is not None:
+            best_params["n_estimators"] = best_iteration + 1
+        return best_params
@@ -0,0 +1,45 @@
+"""In this file is implemented the timing of the stages of a request.
+
+The code to measure is wrapped in `stage(name)`: when a recording has been
+started in the current context (for the API, by the request hooks) the elapsed
+time is added to the stage, otherwise the block runs without being timed. The
+recording is kept in a context variable, so concurrent requests served by
+different threads don't mix their stages.
+"""
+
+import contextvars
+import time
+from contextlib import contextmanager
+
+_current_stages = contextvars.ContextVar("current_stages", default=None)
+
+
+def start_recording():
+    """
+    Start recording the stages executed in the current context.
+
+    Returns:
+    - (dict, token): The dictionary filled with the seconds spent in every stage
+      and the token to give to stop_recording.
+    """
+    stages = {}
+    return stages, _current_stages.set(stages)
+
+
+def stop_recording(token) -> None:
+    """Stop the recording started with start_recording."""
+    _current_stages.reset(token)
+
+
+@contextmanager
+def stage(name: str):
+    """Add the time spent in the block to the stage `name` of the current recording."""
+    stages = _current_stages.get()
+    if stages is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] = stages.get(name, 0.0) + time.perf_counter() - started
@@ -0,0 +1,264 @@
+"""In this file is implemented the NumPy evaluator of the XGBoost tree ensembles.
+
+The trees of a trained booster are exported from its JSON model into contiguous
+arrays, one entry per node of all the trees: the feature and the threshold of
+the split, the left and right children, the direction of the missing values,
+the categories that go to the right child for the categorical splits and the
+value of the leaves. The leaves point to themselves, so all the rows can walk
+all the trees together, one level per step, without checking where each walk
+has stopped.
+
+The exported ensemble only needs NumPy to be loaded and evaluated, and for small
+batches it is faster than calling the booster.
+"""
+
+import json
+import numpy as np
+
+# Objectives whose prediction is the sum of the leaves plus the base score
+IDENTITY_OBJECTIVES = {
+    "reg:squarederror",
+    "reg:squaredlogerror",
+    "reg:absoluteerror",
+    "reg:pseudohubererror",
+    "reg:quantileerror",
+}
+# Number of rows evaluated at a time, to bound the memory of the walk
+ROWS_PER_BLOCK = 1024
+
+
+class TreeEnsemble:
+    """Tree ensemble of a booster stored as flat NumPy arrays."""
+
+    def __init__(
+        self,
+        feature_names: list,
+        base_score: float,
+        roots,
+        features,
+        thresholds,
+        left_children,
+        right_children,
+        default_left,
+        categorical,
+        categories,
+        leaf_values,
+        max_depth: int,
+    ):
+        self.feature_names = list(feature_names)
+        self.base_score = np.float32(base_score)
+        self.roots = np.asarray(roots, dtype=np.int32)
+        self.features = np.asarray(features, dtype=np.int32)
+        self.thresholds = np.asarray(thresholds, dtype=np.float32)
+        self.left_children = np.asarray(left_children, dtype=np.int32)
+        self.right_children = np.asarray(right_children, dtype=np.int32)
+        self.default_left = np.asarray(default_left, dtype=bool)
+        self.categorical = np.asarray(categorical, dtype=bool)
+        self.categories = np.asarray(categories, dtype=bool)
+        self.leaf_values = np.asarray(leaf_values, dtype=np.float32)
+        self.max_depth = int(max_depth)
+
+    @property
+    def num_trees(self) -> int:
+        return len(self.roots)
+
+    @classmethod
+    def from_booster(cls, booster, num_trees: int = None):
+        """
+        Export the trees of an xgboost Booster.
+
+        Parameters:
+        - booster (xgboost.Booster): The trained booster, with a single target and
+            an objective without link function.
+        - num_trees (int, optional): Export only the first trees, for example up
+            to the best iteration of the early stopping. Defaults to all the trees.
+
+        Returns:
+        - TreeEnsemble: The exported ensemble.
+        """
+        return cls.from_json(booster.save_raw(raw_format="json"), num_trees)
+
+    @classmethod
+    def from_json(cls, model_json, num_trees: int = None):
+        """Export the trees of a booster saved in the xgboost JSON format."""
+        learner = json.loads(model_json)["learner"]
+        objective = learner["objective"]["name"]
+        if objective not in IDENTITY_OBJECTIVES:
+            raise ValueError(f"Objective {objective} is not supported")
+        model_param = learner["learner_model_param"]
+        if int(model_param.get("num_target", 1)) > 1 or int(model_param["num_class"]) > 1:
+            raise ValueError("Only boosters with a single target are supported")
+        if learner["gradient_booster"]["name"] != "gbtree":
+            raise ValueError("Only tree boosters are supported")
+        base_score = float(model_param["base_score"].strip("[]"))
+        num_features = int(model_param["num_feature"])
+
+        trees = learner["gradient_booster"]["model"]["trees"]
+        if num_trees is not None:
+            trees = trees[:num_trees]
+        max_category = max(
+            (max(tree["categories"], default=-1) for tree in trees), default=-1
+        )
+
+        roots = []
+        features, thresholds, left_children, right_children = [], [], [], []
+        default_left, categorical, leaf_values, categories = [], [], [], []
+        max_depth = 0
+        offset = 0
+        for tree in trees:
+            num_nodes = len(tree["left_children"])
+            roots.append(offset)
+            left = np.asarray(tree["left_children"], dtype=np.int64)
+            right = np.asarray(tree["right_children"], dtype=np.int64)
+            is_leaf = left == -1
+            node_ids = np.arange(num_nodes)
+            conditions = np.asarray(tree["split_conditions"], dtype=np.float32)
+
+            features.append(np.where(is_leaf, 0, tree["split_indices"]))
+            thresholds.append(np.where(is_leaf, 0, conditions))
+            left_children.append(np.where(is_leaf, node_ids, left) + offset)
+            right_children.append(np.where(is_leaf, node_ids, right) + offset)
+            default_left.append(np.asarray(tree["default_left"], dtype=bool))
+            categorical.append(np.asarray(tree["split_type"]) == 1)
+            leaf_values.append(np.where(is_leaf, conditions, 0))
+
+            tree_categories = np.zeros((num_nodes, max_category + 1), dtype=bool)
+            for node, start, size in zip(
+                tree["categories_nodes"],
+                tree["categories_segments"],
+                tree["categories_sizes"],
+            ):
+                tree_categories[node, tree["categories"][start : start + size]] = True
+            categories.append(tree_categories)
+
+            # Depth of the tree, computed from the parents of the nodes
+            depths = np.zeros(num_nodes, dtype=np.int64)
+            for node in range(1, num_nodes):
+                depths[node] = depths[tree["parents"][node]] + 1
+            max_depth = max(max_depth, int(depths.max()))
+            offset += num_nodes
+
+        feature_names = learner.get("feature_names") or [
+            f"f{i}" for i in range(num_features)
+        ]
+
+        def concatenate(arrays, dtype):
+            return np.concatenate(arrays).astype(dtype) if arrays else np.zeros(0, dtype)
+
+        return cls(
+            feature_names=feature_names,
+            base_score=base_score,
+            roots=roots,
+            features=concatenate(features, np.int32),
+            thresholds=concatenate(thresholds, np.float32),
+            left_children=concatenate(left_children, np.int32),
+            right_children=concatenate(right_children, np.int32),
+            default_left=concatenate(default_left, bool),
+            categorical=concatenate(categorical, bool),
+            categories=(
+                np.concatenate(categories)
+                if categories
+                else np.zeros((0, max_category + 1), dtype=bool)
+            ),
+            leaf_values=concatenate(leaf_values, np.float32),
+            max_depth=max_depth,
+        )
+
+    def save(self, path: str) -> None:
+        """Save the ensemble in a .npz file."""
+        np.savez(
+            path,
+            feature_names=np.asarray(self.feature_names, dtype=str),
+            base_score=self.base_score,
+            roots=self.roots,
+            features=self.features,
+            thresholds=self.thresholds,
+            left_children=self.left_children,
+            right_children=self.right_children,
+            default_left=self.default_left,
+            categorical=self.categorical,
+            categories=self.categories,
+            leaf_values=self.leaf_values,
+            max_depth=np.int64(self.max_depth),
+        )
+
+    @classmethod
+    def load(cls, path: str):
+        """Load an ensemble saved with save."""
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files}
+        arrays["feature_names"] = arrays["feature_names"].tolist()
+        arrays["base_score"] = float(arrays["base_score"])
+        arrays["max_depth"] = int(arrays["max_depth"])
+        return cls(**arrays)
+
+    def _predict_block(self, x: np.ndarray) -> np.ndarray:
+        rows = np.arange(len(x))[:, None]
+        nodes = np.broadcast_to(self.roots, (len(x), self.num_trees))
+        num_categories = self.categories.shape[1]
+        for _ in range(self.max_depth):
+            values = x[rows, self.features[nodes]]
+            missing = np.isnan(values)
+            go_left = values < self.thresholds[nodes]
+
+            # The categories in the set of the split go to the right child, the
+            # unknown ones to the left
+            categorical = self.categorical[nodes]
+            if categorical.any():
+                codes = np.where(missing | ~categorical, -1, values).astype(np.int64)
+                known = (codes >= 0) & (codes < num_categories)
+                in_set = np.zeros_like(known)
+                in_set[known] = self.categories[nodes[known], codes[known]]
+                go_left = np.where(categorical, ~in_set, go_left)
+
+            go_left = np.where(missing, self.default_left[nodes], go_left)
+            nodes = np.where(go_left, self.left_children[nodes], self.right_children[nodes])
+
+        # The leaves are added one tree at a time in float32 starting from the
+        # base score, like the booster: the cumulative sum keeps the same order
+        leaves = np.empty((len(x), self.num_trees + 1), dtype=np.float32)
+        leaves[:, 0] = self.base_score
+        leaves[:, 1:] = self.leaf_values[nodes]
+        return np.cumsum(leaves, axis=1, dtype=np.float32)[:, -1]
+
+    def predict(self, x) -> np.ndarray:
+        """
+        Predict the rows of a matrix.
+
+        Parameters:
+        - x (array-like): The features, one column for each of feature_names in
+            the same order, with the categorical features given as codes and the
+            missing values as NaN.
+
+        Returns:
+        - np.ndarray: The float32 predictions.
+        """
+        x = np.asarray(x, dtype=np.float32)
+        if x.ndim != 2 or x.shape[1] != len(self.feature_names):
+            raise ValueError(f"Expected a matrix with {len(self.feature_names)} columns")
+        if len(x) <= ROWS_PER_BLOCK:
+            return self._predict_block(x)
+        return np.concatenate(
+            [
+                self._predict_block(x[start : start + ROWS_PER_BLOCK])
+                for start in range(0, len(x), ROWS_PER_BLOCK)
+            ]
+        )
+
+
+def check_parity(booster, x, num_trees: int = None) -> float:
+    """
+    Compare the predictions of the exported ensemble with the ones of the booster.
+
+    Parameters:
+    - booster (xgboost.Booster): The booster to export.
+    - x (array-like): The rows to predict, as accepted by TreeEnsemble.predict.
+    - num_trees (int, optional): The number of trees to use.
+
+    Returns:
+    - float: The maximum absolute difference between the two predictions.
+    """
+    x = np.asarray(x, dtype=np.float32)
+    ensemble = TreeEnsemble.from_booster(booster, num_trees)
+    expected = booster.inplace_predict(x, iteration_range=(0, num_trees or 0))
+    return float(np.max(np.abs(ensemble.predict(x) - expected), initial=0.0))
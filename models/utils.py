@@ -1,18 +1,36 @@
 """In this file are implemented the loading and processing of the diamond dataset"""
 
+import numpy as np
 import pandas as pd
 
+# Features of a diamond, in the order of the dataset columns
+FEATURE_COLUMNS = ["carat", "cut", "color", "clarity", "depth", "table", "x", "y", "z"]
+NUMERICAL_COLUMNS = ["carat", "depth", "table", "x", "y", "z"]
 
-def load_df(path: str) -> pd.DataFrame:
+# Allowed values of the categorical features
+CUT_CATEGORIES = ["Fair", "Good", "Very Good", "Ideal", "Premium"]
+COLOR_CATEGORIES = ["D", "E", "F", "G", "H", "I", "J"]
+CLARITY_CATEGORIES = ["IF", "VVS1", "VVS2", "VS1", "VS2", "SI1", "SI2", "I1"]
+
+
+def load_df(path: str, use_cache: bool = False) -> pd.DataFrame:
     """
     Load a DataFrame from a CSV file.
 
     Parameters:
     - path (str): The file path to the CSV file.
+    - use_cache (bool): Load the file through the binary cache of `models.dataset_cache`:
+        text columns are returned as categorical and numerical columns as float32
+        (int32 for integers). By default the exact values of the CSV are read.
 
     Returns:
     - pd.DataFrame: The loaded DataFrame.
     """
+    if use_cache:
+        # Imported here because the cache module depends on the constants of this module
+        from models.dataset_cache import load_cached_df
+
+        return load_cached_df(path)
     df = pd.read_csv(path)
     return df
 
@@ -34,3 +52,47 @@ def data_cleaning(df: pd.DataFrame, target_present: bool = True) -> pd.DataFrame
     if target_present:
         df = df[df.price > 0]
     return df
+
+
+def row_hashes(df: pd.DataFrame) -> np.ndarray:
+    """
+    Compute a 64 bit hash of every diamond of the DataFrame, with its price.
+
+    The values are hashed in a canonical form (numbers as float32, grades as
+    strings), so the same row gets the same hash whether the dataset has been
+    loaded through the binary cache or not.
+
+    Parameters:
+    - df (pd.DataFrame): The diamonds, with the FEATURE_COLUMNS and the price.
+
+    Returns:
+    - np.ndarray: The uint64 hashes, in the order of the rows.
+    """
+    canonical = pd.DataFrame(
+        {
+            column: (
+                df[column].astype(str).to_numpy()
+                if column in ("cut", "color", "clarity")
+                else df[column].to_numpy(dtype=np.float32)
+            )
+            for column in FEATURE_COLUMNS + ["price"]
+        }
+    )
+    return pd.util.hash_pandas_object(canonical, index=False).to_numpy()
+
+
+def holdout_rows(hashes: np.ndarray, fraction: float = 0.2) -> np.ndarray:
+    """
+    Select a fixed fraction of the diamonds by their row hashes.
+
+    The selection depends only on the hash of each row, so a diamond is held out
+    in every dataset it appears in, whatever the other rows are.
+
+    Parameters:
+    - hashes (np.ndarray): The hashes of the rows, see row_hashes.
+    - fraction (float): The expected fraction of the rows selected.
+
+    Returns:
+    - np.ndarray: A boolean mask of the selected rows.
+    """
+    return hashes % 10000 < round(fraction * 10000)
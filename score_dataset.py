@@ -0,0 +1,155 @@
+"""In the following code, will be implemented the pipeline for pricing a whole dataset of diamonds offline"""
+
+import argparse
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import pandas as pd
+from app.utils import get_model_record, load_model
+from app.validation import validate_frame
+from models.utils import data_cleaning, FEATURE_COLUMNS
+from setting import DEFAULT_ALGORITHM
+
+# Model used by the worker processes, loaded once by the pool initializer
+_worker_model = None
+
+
+def _init_worker(model_path: str) -> None:
+    global _worker_model
+    _worker_model = load_model(model_path)
+
+
+def _score_chunk(chunk: pd.DataFrame) -> tuple:
+    """Clean, validate and predict a chunk of the dataset.
+
+    Returns:
+        tuple: The scored rows, with the prediction in the "predicted_price"
+            column, and the number of rows discarded.
+    """
+    num_rows = len(chunk)
+    chunk = data_cleaning(chunk, target_present=False)
+    valid, _ = validate_frame(chunk)
+    chunk = chunk[valid]
+    predictions = []
+    if len(chunk):
+        predictions = _worker_model.execution_pipeline(chunk[FEATURE_COLUMNS].copy())
+    return chunk.assign(predicted_price=predictions), num_rows - len(chunk)
+
+
+def score_dataset(
+    dataset_path: str,
+    output_path: str,
+    model_name: str = DEFAULT_ALGORITHM,
+    model_version: int = None,
+    chunk_size: int = 100_000,
+    workers: int = None,
+) -> None:
+    """Predicts the price of all the diamonds of a CSV file.
+
+    The dataset is read in chunks of `chunk_size` rows, every chunk is cleaned
+    with `data_cleaning` and predicted by a pool of worker processes, each one
+    loading the model once at start. The scored chunks are appended to the output
+    file in the same order as the input, and at most two chunks per worker are in
+    memory at the same time, so the memory used doesn't depend on the size of the
+    dataset. Rows removed by the cleaning or with invalid values are not written.
+
+    Args:
+        dataset_path (str): The file path of the CSV with the diamonds to price.
+        output_path (str): The file path of the CSV to write, with the columns of
+            the dataset plus "predicted_price".
+        model_name (str, optional): The name of the model used for the predictions.
+            Defaults to DEFAULT_ALGORITHM.
+        model_version (int, optional): The version of the model. Defaults to the
+            latest version.
+        chunk_size (int, optional): The number of rows of each chunk.
+        workers (int, optional): The number of worker processes. Defaults to the
+            number of CPUs.
+    """
+    record = get_model_record(model_name, model_version)
+    if record is None:
+        raise ValueError("Model not found, check model name and version")
+    version, model_path = record
+    workers = workers or os.cpu_count()
+
+    num_scored = 0
+    num_discarded = 0
+    header = True
+    with open(output_path, "w", newline="") as output, ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(model_path,)
+    ) as executor:
+
+        def write_next():
+            nonlocal num_scored, num_discarded, header
+            scored, discarded = pending.popleft().result()
+            scored.to_csv(output, header=header, index=False)
+            header = False
+            num_scored += len(scored)
+            num_discarded += discarded
+
+        pending = deque()
+        for chunk in pd.read_csv(dataset_path, chunksize=chunk_size):
+            pending.append(executor.submit(_score_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                write_next()
+        while pending:
+            write_next()
+
+    print(f"Model: {model_name} version {version}")
+    print(f"Scored rows: {num_scored}")
+    print(f"Discarded rows: {num_discarded}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Predict the price of all the diamonds of a CSV file."
+    )
+    parser.add_argument(
+        "--dataset",
+        type=Path,
+        required=True,
+        help="The file path of the CSV with the diamonds to price.",
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        required=True,
+        help="The file path of the CSV to write with the predicted prices.",
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        default=DEFAULT_ALGORITHM,
+        help="""The name of the model to use for the predictions. Available options:
+        'Linear Regressor', 'XgBoost'
+        """,
+    )
+    parser.add_argument(
+        "--model-version",
+        type=int,
+        default=None,
+        help="The version of the model. Defaults to the latest version.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=100_000,
+        help="The number of rows read and predicted at a time.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="The number of worker processes. Defaults to the number of CPUs.",
+    )
+
+    args = parser.parse_args()
+
+    score_dataset(
+        args.dataset,
+        args.output,
+        model_name=args.model,
+        model_version=args.model_version,
+        chunk_size=args.chunk_size,
+        workers=args.workers,
+    )
@@ -0,0 +1,131 @@
+"""In the following code, is implemented the launcher that serves the API with several worker processes"""
+
+import argparse
+import gc
+import os
+import signal
+import socket
+from werkzeug.serving import make_server
+from app import create_app
+from app.utils import history_writer
+
+
+def _run_worker(app, sock: socket.socket, host: str, port: int) -> None:
+    """Serve the requests accepted on the shared socket until SIGTERM or SIGINT."""
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+    try:
+        server.serve_forever()
+    except SystemExit:
+        pass
+    finally:
+        server.server_close()
+        # Store the queued api history records of this worker
+        history_writer.close()
+
+
+def serve(host: str, port: int, workers: int, preload: bool = True) -> None:
+    """Serves the API with a pool of forked worker processes.
+
+    The application is created in the parent process, that with `preload` loads
+    the latest version of every model and the similar diamonds index and runs a
+    warm-up prediction. The listening socket is opened, the objects created so
+    far are moved out of the garbage collector (so the collections of the workers
+    don't write to their memory pages) and `workers` processes are forked: they
+    share the loaded models copy-on-write and accept the connections of the same
+    socket. A worker that exits unexpectedly is replaced; SIGTERM or SIGINT stop
+    all the workers.
+
+    Args:
+        host (str): The address to listen on.
+        port (int): The port to listen on.
+        workers (int): The number of worker processes.
+        preload (bool, optional): Load the models before forking the workers.
+            Defaults to True.
+    """
+    app = create_app(preload=preload)
+    sock = socket.create_server((host, port), backlog=128)
+
+    if not hasattr(os, "fork") or workers <= 1:
+        print(f"Serving on http://{host}:{port} with 1 process")
+        _run_worker(app, sock, host, port)
+        return
+
+    gc.collect()
+    gc.freeze()
+
+    children = set()
+    stopping = False
+
+    def spawn() -> None:
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _run_worker(app, sock, host, port)
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for _ in range(workers):
+        spawn()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"Serving on http://{host}:{port} with {workers} worker processes")
+
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} exited, starting a new one")
+            spawn()
+    sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve the API with several worker processes sharing the preloaded models."
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="The address to listen on.",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=5000,
+        help="The port to listen on.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="The number of worker processes. Defaults to the number of CPUs.",
+    )
+    parser.add_argument(
+        "--no-preload",
+        action="store_true",
+        help="Don't load the models before forking, every worker loads them at its first request.",
+    )
+
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.workers, preload=not args.no_preload)
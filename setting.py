@@ -1,7 +1,88 @@
+import os
 from pathlib import Path
 ROOT_PATH = Path(__file__).resolve().parents[0]
 DEFAULT_DATASET = ROOT_PATH / "data" / "diamonds.csv"
-SAVE_PATH_MODELS = ROOT_PATH / "models" / "saved_model"
-DB_PATH = ROOT_PATH / "instance" / "app_db.sqlite"
+# The paths where models, database and dataset cache are stored can be moved with
+# environment variables, for example to run the benchmarks in a separate directory
+SAVE_PATH_MODELS = Path(os.environ.get("DIAMONDS_MODELS_PATH", ROOT_PATH / "models" / "saved_model"))
+DB_PATH = Path(os.environ.get("DIAMONDS_DB_PATH", ROOT_PATH / "instance" / "app_db.sqlite"))
+# Binary columnar copies of the datasets, see models/dataset_cache.py
+DATASET_CACHE_PATH = Path(os.environ.get("DIAMONDS_DATASET_CACHE_PATH", ROOT_PATH / "data" / ".cache"))
+# Train on the cached float32 copies instead of the exact values of the CSV
+DATASET_CACHE_ENABLED = False
 
 DEFAULT_ALGORITHM = "XgBoost"
+
+# Incremental training: a new version is saved only with at least this number of
+# new rows, and this fraction of the new rows, selected by their hashes, is held
+# out to evaluate the model, see train_new_model.train_incremental
+INCREMENTAL_MIN_NEW_ROWS = 100
+INCREMENTAL_HOLDOUT_FRACTION = 0.2
+
+# Nearest neighbour search of /similar_diamonds, see app/similarity_index.py
+# "carat" ranks the diamonds with the same cut, color and clarity by carat,
+# "features" by the distance over all the standardized characteristics
+SIMILARITY_DEFAULT_MODE = "carat"
+SIMILARITY_DEFAULT_METRIC = "euclidean"
+# "kd_tree" or "ball_tree"
+SIMILARITY_TREE_TYPE = "kd_tree"
+SIMILARITY_LEAF_SIZE = 40
+
+# Database where the hyperparameter searches are persisted
+OPTUNA_STORAGE = os.environ.get(
+    "DIAMONDS_OPTUNA_STORAGE",
+    "sqlite:///" + (ROOT_PATH / "instance" / "optuna.sqlite3").as_posix(),
+)
+
+# In-process cache of the loaded models used by the API
+MODEL_CACHE_MAX_ITEMS = 8
+MODEL_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Seconds between two checks for new models registered in the database
+MODEL_REGISTRY_POLL_INTERVAL = 1.0
+
+# Background loading of the new model versions, see app/model_watcher.py
+MODEL_HOT_RELOAD_ENABLED = True
+MODEL_HOT_RELOAD_INTERVAL = 2.0
+# What happens to the versions replaced by a newer one: "keep_last" keeps only
+# the MODEL_RETIRE_KEEP_VERSIONS most recent cached versions of the model,
+# "lru" leaves them to the limits of the model cache
+MODEL_RETIRE_POLICY = "keep_last"
+MODEL_RETIRE_KEEP_VERSIONS = 2
+
+# Cache of the prices predicted by /predict_price, see app/prediction_cache.py
+PREDICTION_CACHE_ENABLED = False
+PREDICTION_CACHE_MAX_ITEMS = 100000
+PREDICTION_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Seconds a cached price is kept
+PREDICTION_CACHE_TTL = 300.0
+
+# Asynchronous storage of the api_history records
+API_HISTORY_QUEUE_SIZE = 10000
+API_HISTORY_BATCH_SIZE = 500
+API_HISTORY_FLUSH_INTERVAL = 0.5
+# What to do when the queue is full: "drop", "block" or "sample"
+API_HISTORY_OVERFLOW_POLICY = "drop"
+API_HISTORY_SAMPLE_RATE = 10
+API_HISTORY_BLOCK_TIMEOUT = 1.0
+# Store the seconds spent in every stage of the request in the stages column
+API_HISTORY_RECORD_STAGES = False
+# Requests and responses of at least this many bytes are stored compressed,
+# None stores them as text
+API_HISTORY_COMPRESS_MIN_BYTES = 512
+# Records older than this number of days are rolled up into hourly aggregates
+# and deleted, see app/history_store.py; None keeps them forever
+API_HISTORY_RETENTION_DAYS = None
+# Seconds between two retention runs of the history writer
+API_HISTORY_RETENTION_INTERVAL = 3600.0
+API_HISTORY_RETENTION_CHUNK_ROWS = 5000
+API_HISTORY_VACUUM_CHUNK_PAGES = 1000
+
+# Micro-batching of the concurrent /predict_price requests for the same model
+MICRO_BATCHING_ENABLED = False
+MICRO_BATCH_MAX_ROWS = 64
+MICRO_BATCH_MAX_WAIT_MS = 5
+
+# Batches of diamonds up to this size are predicted by the XgBoost models with
+# the NumPy evaluator of the trees instead of the xgboost booster, 0 disables it
+TREE_ENSEMBLE_MAX_ROWS = 0
@@ -0,0 +1,37 @@
+"""Fixtures shared by the tests.
+
+The tests run with a database, a models directory and a dataset cache of their
+own: the environment variables read by setting.py are set before it is imported.
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+from pathlib import Path
+
+import pytest
+
+WORKDIR = Path(tempfile.mkdtemp(prefix="diamonds-tests-"))
+os.environ["DIAMONDS_DB_PATH"] = str(WORKDIR / "app_db.sqlite")
+os.environ["DIAMONDS_MODELS_PATH"] = str(WORKDIR / "saved_model")
+os.environ["DIAMONDS_DATASET_CACHE_PATH"] = str(WORKDIR / "dataset_cache")
+
+SCHEMA_PATH = Path(__file__).resolve().parents[1] / "app" / "schema.sql"
+
+
+@pytest.fixture
+def database() -> Path:
+    """The database of the tests, initialized empty, and an empty models directory."""
+    from setting import DB_PATH, SAVE_PATH_MODELS
+
+    conn = sqlite3.connect(DB_PATH)
+    conn.executescript(SCHEMA_PATH.read_text())
+    conn.close()
+    shutil.rmtree(SAVE_PATH_MODELS, ignore_errors=True)
+    os.makedirs(SAVE_PATH_MODELS)
+    return Path(DB_PATH)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(WORKDIR, ignore_errors=True)
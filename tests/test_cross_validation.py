@@ -0,0 +1,48 @@
+"""Cross validation of BaseSupervisedModel.train_pipeline."""
+
+import numpy as np
+import pytest
+from models.get_model import get_model
+from models.utils import load_df, data_cleaning
+from setting import DEFAULT_DATASET
+
+
+@pytest.fixture(scope="module")
+def diamonds():
+    data = data_cleaning(load_df(DEFAULT_DATASET)).iloc[:1500]
+    return data.drop(columns=["price"]), data["price"]
+
+
+def test_metrics_of_the_folds(diamonds):
+    x, y = diamonds
+    model = get_model("Linear Regressor")
+    model.configure_cross_validation(4, n_jobs=2)
+    model.train_pipeline(x.copy(), y.copy())
+
+    folds = model.metrics["folds"]
+    assert len(folds) == 4
+    for fold in folds:
+        assert set(fold) == {"r2", "mae", "fit_seconds", "predict_seconds"}
+        assert fold["fit_seconds"] >= 0 and fold["predict_seconds"] >= 0
+    for metric in ("r2", "mae"):
+        values = [fold[metric] for fold in folds]
+        assert model.metrics[metric] == pytest.approx(np.mean(values))
+        assert model.metrics[f"{metric}_std"] == pytest.approx(np.std(values))
+    # The final model is trained on all the rows
+    np.testing.assert_array_equal(model.trained_rows, np.arange(len(y)))
+
+
+def test_xgboost_rounds_chosen_on_all_the_rows(diamonds, monkeypatch):
+    x, y = diamonds
+    model = get_model("XgBoost")
+    tuned = {"n_estimators": 3, "max_depth": 3, "learning_rate": 0.3}
+    monkeypatch.setattr(model, "optimize_hyperparam", lambda x, y: dict(tuned))
+    model.configure_hyperparameter_search(n_trials=1, n_jobs=1, n_threads=2)
+    model.configure_cross_validation(3, n_jobs=1)
+    model.train_pipeline(x.copy(), y.copy())
+
+    # The folds use the number of trees of the search, the final model the one
+    # of the early stopping on all the rows
+    assert model.hyperparameters["n_estimators"] != tuned["n_estimators"]
+    assert model.model.n_estimators == model.hyperparameters["n_estimators"]
+    assert model.model.get_booster().num_boosted_rounds() == model.model.n_estimators
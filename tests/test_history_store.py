@@ -0,0 +1,192 @@
+"""Encoding, pagination and retention of the api_history table, see
+app/history_store.py and the `history` commands of app/db.py."""
+
+import json
+import random
+import sqlite3
+from collections import defaultdict
+
+import pytest
+from app.history_store import (
+    decode_payload,
+    encode_payload,
+    enable_incremental_vacuum,
+    query_history,
+    query_hourly,
+    rollup_and_prune,
+)
+
+# Old enough to be pruned with any retention of a few days
+OLD_HOURS = ["2020-01-01 10", "2020-01-01 11", "2020-01-02 00"]
+
+
+@pytest.fixture
+def conn(database):
+    conn = sqlite3.connect(database, isolation_level=None)
+    enable_incremental_vacuum(conn)
+    yield conn
+    conn.close()
+
+
+def _insert(conn, records: list) -> None:
+    conn.executemany(
+        """
+        INSERT INTO api_history (
+            created, api, request, response, model_name, model_version, status, duration
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        records,
+    )
+
+
+def _old_records(num_records: int) -> list:
+    rng = random.Random(0)
+    records = []
+    for i in range(num_records):
+        hour = rng.choice(OLD_HOURS)
+        api = rng.choice(["/predict_price", "/similar_diamonds"])
+        model = ("XgBoost", rng.choice([1, 2])) if api == "/predict_price" else (None, None)
+        # Records stored before the status and the duration were recorded
+        status = rng.choice([200, 200, 400, 404, None])
+        duration = rng.choice([None, rng.uniform(0.001, 0.5)])
+        request = encode_payload(json.dumps({"i": i, "padding": "x" * 2000}), 512)
+        records.append(
+            (f"{hour}:{i % 60:02d}:00", api, request, "{}", *model, status, duration)
+        )
+    return records
+
+
+def test_payloads_round_trip():
+    small = json.dumps({"carat": 0.5})
+    large = json.dumps([{"carat": 0.5, "cut": "Ideal"}] * 100)
+    assert encode_payload(small, 512) == small
+    assert encode_payload(large, None) == large
+    encoded = encode_payload(large, 512)
+    assert isinstance(encoded, bytes) and len(encoded) < len(large)
+    assert decode_payload(encoded) == large
+    assert decode_payload(small) == small
+    assert encode_payload(None, 512) is None
+
+
+def test_compressed_payloads_are_decoded_by_the_queries(conn):
+    request = [{"carat": 0.5, "cut": "Ideal"}] * 100
+    _insert(
+        conn,
+        [
+            ("2024-01-01 00:00:00", "/predict_price", encode_payload(json.dumps(request), 512),
+             json.dumps({"price": 1.0}), None, None, 200, 0.1),
+            ("2024-01-01 00:00:01", "/predict_price", json.dumps({"carat": 0.5}),
+             "not json", None, None, 200, 0.1),
+        ],
+    )
+    stored = conn.execute("SELECT typeof(request) FROM api_history ORDER BY id").fetchall()
+    assert stored == [("blob",), ("text",)]
+
+    records = query_history(conn)["records"]
+    assert records[1]["request"] == request
+    assert records[1]["response"] == {"price": 1.0}
+    assert records[0]["request"] == {"carat": 0.5}
+    assert records[0]["response"] == "not json"
+
+
+def test_pagination_returns_every_record_once(conn):
+    _insert(
+        conn,
+        [
+            (f"2024-01-01 00:{i // 60:02d}:{i % 60:02d}", f"/api{i % 3}", "{}", "{}",
+             None, None, 200, None)
+            for i in range(103)
+        ],
+    )
+    all_ids = [row[0] for row in conn.execute("SELECT id FROM api_history ORDER BY id DESC")]
+
+    for api, expected in ((None, all_ids), ("/api1", None)):
+        if expected is None:
+            expected = [
+                row[0]
+                for row in conn.execute(
+                    "SELECT id FROM api_history WHERE api = ? ORDER BY id DESC", (api,)
+                )
+            ]
+        seen = []
+        before_id = None
+        while True:
+            page = query_history(conn, api=api, before_id=before_id, limit=10)
+            assert len(page["records"]) <= 10
+            seen += [record["id"] for record in page["records"]]
+            before_id = page["next_before_id"]
+            if before_id is None:
+                break
+        assert seen == expected
+
+    # A page that ends exactly at the last record has no next page
+    page = query_history(conn, limit=len(all_ids))
+    assert len(page["records"]) == len(all_ids) and page["next_before_id"] is None
+
+
+def test_rollup_equals_the_pruned_records(conn):
+    old = _old_records(157)
+    recent = [("2999-01-01 00:00:00", "/predict_price", "{}", "{}", None, None, 200, 0.1)]
+    _insert(conn, old + recent)
+
+    expected = defaultdict(lambda: {"requests": 0, "errors": 0, "durations": []})
+    for created, api, _, _, model_name, model_version, status, duration in old:
+        group = expected[(created[:13] + ":00:00", api, model_name, model_version)]
+        group["requests"] += 1
+        group["errors"] += (status or 200) >= 400
+        if duration is not None:
+            group["durations"].append(duration)
+
+    # Chunks smaller than an hour: the hours are rolled up over several chunks
+    result = rollup_and_prune(conn, 30, chunk_rows=7, vacuum_pages=3)
+    assert result["pruned"] == len(old)
+    assert result["vacuumed"] > 0
+    assert conn.execute("PRAGMA freelist_count").fetchone()[0] == 0
+    assert [row[0] for row in conn.execute("SELECT created FROM api_history")] == [
+        recent[0][0]
+    ]
+
+    hourly = query_hourly(conn)
+    assert len(hourly) == len(expected)
+    for row in hourly:
+        group = expected[(row["hour"], row["api"], row["model_name"], row["model_version"])]
+        assert row["requests"] == group["requests"]
+        assert row["errors"] == group["errors"]
+        if group["durations"]:
+            assert row["mean_duration"] == pytest.approx(
+                sum(group["durations"]) / len(group["durations"])
+            )
+            assert row["max_duration"] == pytest.approx(max(group["durations"]))
+        else:
+            assert row["mean_duration"] is None and row["max_duration"] is None
+
+    # Nothing left to prune, the rollups are unchanged
+    assert rollup_and_prune(conn, 30, chunk_rows=7, vacuum_pages=3)["pruned"] == 0
+    assert query_hourly(conn) == hourly
+
+
+def test_history_commands(conn):
+    from app import create_app
+
+    _insert(conn, _old_records(20))
+    app = create_app()
+    runner = app.test_cli_runner()
+
+    # The flask command pushes the application context of its commands
+    with app.app_context():
+        result = runner.invoke(args=["history", "list", "--limit", "5"])
+        assert result.exit_code == 0
+        lines = [line for line in result.stdout.splitlines() if line.strip()]
+        assert [json.loads(line)["id"] for line in lines] == [20, 19, 18, 17, 16]
+        assert json.loads(lines[0])["request"]["i"] == 19
+        assert "--before-id 16" in result.stderr
+
+        result = runner.invoke(
+            args=["history", "prune", "--days", "30", "--chunk-rows", "6"]
+        )
+        assert result.exit_code == 0
+        assert "Pruned 20 records" in result.output
+
+    assert conn.execute("SELECT COUNT(*) FROM api_history").fetchone()[0] == 0
+    assert sum(row["requests"] for row in query_hourly(conn)) == 20
@@ -0,0 +1,140 @@
+"""Incremental training of train_new_model.train_incremental, with the linear
+regression on the rows of the default dataset."""
+
+import sqlite3
+
+import numpy as np
+import pytest
+from models.base_model import BaseSupervisedModel
+from models.models_script.linear_regressor_diamond import LinearRegressorModelDiamond
+from models.utils import load_df, data_cleaning, row_hashes, holdout_rows
+from setting import DEFAULT_DATASET, INCREMENTAL_HOLDOUT_FRACTION
+from train_new_model import _train_on_data
+
+MODEL_NAME = "Linear Regressor"
+
+
+@pytest.fixture(scope="module")
+def diamonds():
+    data = data_cleaning(load_df(DEFAULT_DATASET))
+    # Without duplicated rows, that share their hash
+    return data[~data.duplicated()].reset_index(drop=True)
+
+
+def _train(data, **options):
+    return _train_on_data(
+        data,
+        row_hashes(data),
+        MODEL_NAME,
+        "diamonds",
+        n_trials=1,
+        n_jobs=1,
+        study_storage=None,
+        study_name=None,
+        pruner="median",
+        incremental=True,
+        n_threads=1,
+        **options,
+    )
+
+
+def _versions(database) -> list:
+    conn = sqlite3.connect(database)
+    versions = [
+        row[0]
+        for row in conn.execute(
+            "SELECT model_version FROM models_history WHERE model_name = ?", (MODEL_NAME,)
+        )
+    ]
+    conn.close()
+    return versions
+
+
+@pytest.fixture
+def fitted_rows(monkeypatch):
+    """The number of rows of every call of fit_incremental, and fails the test if
+    the model is trained from scratch."""
+    calls = []
+    fit_incremental = LinearRegressorModelDiamond.fit_incremental
+
+    def record(self, x, y):
+        calls.append(len(x))
+        return fit_incremental(self, x, y)
+
+    def train_pipeline(self, x, y, print_final_metrics=False):
+        raise AssertionError("The model has been trained from scratch")
+
+    monkeypatch.setattr(LinearRegressorModelDiamond, "fit_incremental", record)
+    return calls, train_pipeline
+
+
+def test_unchanged_dataset_has_no_new_rows(database, diamonds, fitted_rows, monkeypatch):
+    data = diamonds.iloc[:1000]
+    version, _ = _train(data)
+    assert version == 1
+
+    calls, train_pipeline = fitted_rows
+    monkeypatch.setattr(BaseSupervisedModel, "train_pipeline", train_pipeline)
+    assert _train(data) == (None, None)
+    assert calls == []
+    assert _versions(database) == [1]
+
+
+def test_only_appended_rows_are_fitted(database, diamonds, fitted_rows, monkeypatch):
+    _train(diamonds.iloc[:1000])
+    _, first = BaseSupervisedModel.load_latest_model(MODEL_NAME)
+
+    calls, train_pipeline = fitted_rows
+    monkeypatch.setattr(BaseSupervisedModel, "train_pipeline", train_pipeline)
+    data = diamonds.iloc[:1300]
+    hashes = row_hashes(data)
+    version, metrics = _train(data)
+    assert version == 2
+    assert np.isfinite(metrics["r2"]) and np.isfinite(metrics["mae"])
+
+    new_rows = np.arange(len(data)) >= 1000
+    held_out = holdout_rows(hashes, INCREMENTAL_HOLDOUT_FRACTION)
+    assert calls == [int((new_rows & ~held_out).sum())]
+
+    _, second = BaseSupervisedModel.load_latest_model(MODEL_NAME)
+    np.testing.assert_array_equal(second.training_row_hashes, np.unique(hashes))
+    np.testing.assert_array_equal(
+        second.holdout_row_hashes,
+        np.union1d(first.holdout_row_hashes, hashes[new_rows & held_out]),
+    )
+
+    # Nothing left for a second run on the same dataset
+    assert _train(data) == (None, None)
+    assert calls == [int((new_rows & ~held_out).sum())]
+
+
+def test_single_new_row(database, diamonds, fitted_rows, monkeypatch):
+    _train(diamonds.iloc[:1000])
+
+    calls, train_pipeline = fitted_rows
+    monkeypatch.setattr(BaseSupervisedModel, "train_pipeline", train_pipeline)
+    held_out = holdout_rows(row_hashes(diamonds), INCREMENTAL_HOLDOUT_FRACTION)
+    new_row = 1000 + int(np.flatnonzero(~held_out[1000:])[0])
+    data = diamonds.iloc[list(range(1000)) + [new_row]]
+
+    # Below the minimum number of new rows no version is saved
+    assert _train(data) == (None, None)
+    assert calls == []
+    assert _versions(database) == [1]
+
+    version, metrics = _train(data, min_new_rows=1)
+    assert version == 2
+    assert calls == [1]
+    assert np.isfinite(metrics["r2"])
+
+
+def test_model_without_incremental_support(database, diamonds, monkeypatch):
+    _train(diamonds.iloc[:1000])
+    monkeypatch.setattr(
+        LinearRegressorModelDiamond, "supports_incremental", property(lambda self: False)
+    )
+    version, _ = _train(diamonds.iloc[:1300])
+    assert version == 2
+    # Trained from scratch: the holdout is the test split of the new training
+    _, model = BaseSupervisedModel.load_latest_model(MODEL_NAME)
+    assert len(model.holdout_row_hashes) == pytest.approx(0.2 * 1300, abs=1)
@@ -0,0 +1,45 @@
+"""In-process cache of the loaded models, see app/model_cache.py."""
+
+import pytest
+from app.model_cache import ModelCache
+
+
+@pytest.fixture
+def paths(tmp_path):
+    paths = {}
+    for version in (1, 2, 3):
+        path = tmp_path / f"XgBoost{version}"
+        path.write_bytes(b"0" * 10)
+        paths[version] = str(path)
+    return paths
+
+
+def _load(path):
+    return {"path": path}
+
+
+def test_pinned_models_are_not_evicted(paths):
+    cache = ModelCache(max_items=1, max_bytes=1000)
+    cache.get("XgBoost", 1, paths[1], _load)
+    cache.pin("XgBoost", 1)
+    cache.get("XgBoost", 2, paths[2], _load)
+    cache.get("XgBoost", 3, paths[3], _load)
+    assert cache.versions("XgBoost") == [1, 3]
+
+    cache.unpin("XgBoost", 1)
+    cache.get("XgBoost", 2, paths[2], _load)
+    assert cache.versions("XgBoost") == [2]
+
+
+def test_clear_removes_the_pins(paths):
+    cache = ModelCache(max_items=1, max_bytes=1000)
+    cache.get("XgBoost", 1, paths[1], _load)
+    cache.pin("XgBoost", 1)
+    cache.clear()
+    assert cache.stats()["size"] == 0 and cache.stats()["hits"] == 0
+
+    # The version loaded again after the clear is not pinned anymore
+    cache.get("XgBoost", 1, paths[1], _load)
+    cache.get("XgBoost", 2, paths[2], _load)
+    assert cache.versions("XgBoost") == [2]
+    assert cache.stats()["pinned"] == []
@@ -0,0 +1,92 @@
+"""In-memory registry of the trained models, see app/model_registry.py."""
+
+import sqlite3
+
+import pytest
+from app.model_registry import ModelRegistry
+from models.base_model import BaseSupervisedModel
+
+
+def _register(database, model_name: str, model_version: int) -> None:
+    """Register a model version from another connection, as a training does."""
+    conn = sqlite3.connect(database)
+    with conn:
+        conn.execute(
+            """
+            INSERT INTO models_history (model_name, model_description, metrics,
+                model_pickle_path, model_version, training_dataset)
+            VALUES (?, '', '{}', ?, ?, 'diamonds')
+            """,
+            (model_name, f"/models/{model_name}{model_version}", model_version),
+        )
+    conn.close()
+
+
+class _CountingConnection:
+    """Connection that counts the executed statements."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.statements = 0
+
+    def execute(self, *args):
+        self.statements += 1
+        return self.conn.execute(*args)
+
+
+@pytest.fixture
+def registry(database):
+    return ModelRegistry(database, poll_interval=0)
+
+
+def test_new_versions_written_by_another_connection(database, registry):
+    assert registry.resolve("XgBoost") is None
+    _register(database, "XgBoost", 1)
+    assert registry.resolve("XgBoost") == (1, "/models/XgBoost1")
+
+    _register(database, "XgBoost", 2)
+    assert registry.resolve("XgBoost") == (2, "/models/XgBoost2")
+    assert registry.resolve("XgBoost", 1) == (1, "/models/XgBoost1")
+    assert registry.resolve("XgBoost", "1") == (1, "/models/XgBoost1")
+    assert registry.resolve("XgBoost", "one") is None
+    assert registry.latest_versions() == {"XgBoost": 2}
+
+
+def test_promoted_model(database, registry):
+    _register(database, "XgBoost", 1)
+    _register(database, "Linear Regressor", 1)
+    assert registry.promoted() is None
+
+    BaseSupervisedModel.promote("XgBoost", 1, {"mae": 1.0})
+    assert registry.promoted() == ("XgBoost", 1)
+    BaseSupervisedModel.promote("Linear Regressor", 1, {"mae": 0.5})
+    assert registry.promoted() == ("Linear Regressor", 1)
+
+
+def test_unknown_models_are_looked_up_once_per_database_change(database):
+    registry = ModelRegistry(database, poll_interval=3600)
+    _register(database, "XgBoost", 1)
+    conn = _CountingConnection(sqlite3.connect(database, check_same_thread=False))
+    registry._connection = lambda: conn
+
+    assert registry.resolve("XgBoost") == (1, "/models/XgBoost1")
+    statements = conn.statements
+    for _ in range(10):
+        assert registry.resolve("Unknown") is None
+        assert registry.resolve("XgBoost", 5) is None
+    # One forced check of each unknown model, no reload of the unchanged database
+    assert conn.statements == statements + 2
+
+    # A new version is found by the next check of the database
+    _register(database, "XgBoost", 5)
+    assert registry.resolve("XgBoost", 5) is None
+    registry.refresh(force=True)
+    assert registry.resolve("XgBoost", 5) == (5, "/models/XgBoost5")
+    conn.conn.close()
+
+
+def test_database_not_available(tmp_path):
+    registry = ModelRegistry(tmp_path / "missing" / "app_db.sqlite", poll_interval=0)
+    assert registry.resolve("XgBoost") is None
+    assert registry.promoted() is None
+    assert registry.latest_versions() == {}
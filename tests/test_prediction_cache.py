@@ -0,0 +1,132 @@
+"""Prediction cache of /predict_price: the cached prices of a model are not
+returned once the model is replaced, and invalid requests are never answered
+from the cache."""
+
+import sqlite3
+
+import pytest
+from app import api, utils
+from app.utils import model_cache, model_registry, prediction_cache
+from models.base_model import BaseSupervisedModel
+from models.get_model import get_model
+from models.utils import load_df, data_cleaning
+from setting import DEFAULT_DATASET
+from tests.conftest import SCHEMA_PATH
+
+MODEL_NAME = "Linear Regressor"
+DIAMOND = {
+    "carat": 0.7,
+    "cut": "Ideal",
+    "color": "G",
+    "clarity": "VS2",
+    "depth": 61.5,
+    "table": 56.0,
+    "x": 5.7,
+    "y": 5.72,
+    "z": 3.51,
+}
+
+
+@pytest.fixture(scope="module")
+def diamonds():
+    return data_cleaning(load_df(DEFAULT_DATASET))
+
+
+@pytest.fixture
+def client(database, monkeypatch):
+    from app import create_app
+
+    monkeypatch.setattr(api, "PREDICTION_CACHE_ENABLED", True)
+    # The requests resolve the latest version from the registry, without the
+    # background watcher, and see every new version at once
+    monkeypatch.setattr(utils, "MODEL_HOT_RELOAD_ENABLED", False)
+    monkeypatch.setattr(model_registry, "poll_interval", 0)
+    model_cache.clear()
+    prediction_cache.clear()
+    return create_app().test_client()
+
+
+def _train(rows) -> tuple:
+    """Train and save the linear regression, returning its version and the price
+    it predicts for DIAMOND."""
+    model = get_model(MODEL_NAME)
+    model.train_pipeline(rows.drop(columns=["price"]), rows["price"])
+    version = model.save_model(training_dataset_name="diamonds")
+    return version, float(model.predict_row(DIAMOND)[0])
+
+
+def _predict(client, data, **options):
+    return client.post("/predict_price", json={"data": data, **options})
+
+
+def test_new_version_invalidates_the_cached_prices(client, diamonds):
+    version, price = _train(diamonds.iloc[:1000])
+    assert _predict(client, [DIAMOND], model_name=MODEL_NAME).json["result"] == [
+        pytest.approx(price)
+    ]
+    assert _predict(client, [DIAMOND], model_name=MODEL_NAME).json["result"] == [
+        pytest.approx(price)
+    ]
+    assert prediction_cache.stats()["hits"] == 1
+
+    new_version, new_price = _train(diamonds.iloc[1000:1500])
+    assert new_version == version + 1 and new_price != pytest.approx(price)
+    response = _predict(client, [DIAMOND], model_name=MODEL_NAME)
+    assert response.json["result"] == [pytest.approx(new_price)]
+    assert prediction_cache.stats()["invalidations"] == 1
+    # The previous version is still served on request, and predicted again
+    response = _predict(client, [DIAMOND], model_name=MODEL_NAME, model_version=version)
+    assert response.json["result"] == [pytest.approx(price)]
+
+
+def test_version_saved_again_invalidates_the_cached_prices(client, diamonds):
+    version, price = _train(diamonds.iloc[:1000])
+    assert _predict(client, [DIAMOND], model_name=MODEL_NAME).json["result"] == [
+        pytest.approx(price)
+    ]
+
+    # As after init-db: the versions restart from 1, with a new model file
+    conn = sqlite3.connect(model_registry.db_path)
+    conn.executescript(SCHEMA_PATH.read_text())
+    conn.close()
+    same_version, new_price = _train(diamonds.iloc[1000:1500])
+    assert same_version == version and new_price != pytest.approx(price)
+
+    response = _predict(client, [DIAMOND], model_name=MODEL_NAME)
+    assert response.json["result"] == [pytest.approx(new_price)]
+
+
+def test_promoted_version_is_used_for_the_cached_prices(client, diamonds):
+    version, price = _train(diamonds.iloc[:1000])
+    BaseSupervisedModel.promote(MODEL_NAME, version, {})
+    assert _predict(client, [DIAMOND]).json["result"] == [pytest.approx(price)]
+    assert _predict(client, [DIAMOND]).json["result"] == [pytest.approx(price)]
+
+    new_version, new_price = _train(diamonds.iloc[1000:1500])
+    # The latest version is not served until it is promoted
+    assert _predict(client, [DIAMOND]).json["result"] == [pytest.approx(price)]
+    BaseSupervisedModel.promote(MODEL_NAME, new_version, {})
+    assert _predict(client, [DIAMOND]).json["result"] == [pytest.approx(new_price)]
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        [DIAMOND, {**DIAMOND, "carat": -1}],
+        [{**DIAMOND, "cut": "Perfect"}],
+        [{**DIAMOND, "x": "large"}],
+        [{key: value for key, value in DIAMOND.items() if key != "z"}],
+        DIAMOND,
+        [],
+    ],
+)
+def test_invalid_requests_are_not_answered_from_the_cache(client, diamonds, data):
+    _train(diamonds.iloc[:1000])
+    assert _predict(client, [DIAMOND], model_name=MODEL_NAME).status_code == 200
+    assert _predict(client, [DIAMOND], model_name=MODEL_NAME).status_code == 200
+    hits = prediction_cache.stats()["hits"]
+
+    response = _predict(client, data, model_name=MODEL_NAME)
+    assert response.status_code == 400
+    assert "error" in response.json
+    assert prediction_cache.stats()["hits"] == hits
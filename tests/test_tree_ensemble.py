@@ -0,0 +1,155 @@
+"""Parity of the NumPy evaluator of models/tree_ensemble.py with the xgboost booster."""
+
+import numpy as np
+import pandas as pd
+import pytest
+import xgboost
+from models.tree_ensemble import TreeEnsemble, check_parity
+
+CATEGORIES = ["a", "b", "c", "d", "e", "f"]
+# Categories of the dtype never seen in the training rows
+UNSEEN_CATEGORIES = ["e", "f"]
+
+
+def _frame(rng, num_rows: int, missing: float) -> pd.DataFrame:
+    frame = pd.DataFrame(
+        {
+            "x0": rng.normal(size=num_rows),
+            "x1": rng.uniform(0, 10, size=num_rows),
+            "grade": pd.Categorical(
+                rng.choice(CATEGORIES[:4], size=num_rows), categories=CATEGORIES
+            ),
+        }
+    )
+    frame.loc[rng.random(num_rows) < missing, "x0"] = np.nan
+    frame.loc[rng.random(num_rows) < missing, "grade"] = np.nan
+    return frame
+
+
+def _target(frame: pd.DataFrame) -> np.ndarray:
+    grade = frame["grade"].cat.codes.to_numpy()
+    return (
+        np.nan_to_num(frame["x0"].to_numpy()) * 3
+        + np.sin(frame["x1"].to_numpy())
+        + np.where(grade == 1, 5.0, 0.0)
+        + np.where(grade == 3, -2.0, 0.0)
+    )
+
+
+def _matrix(frame: pd.DataFrame) -> np.ndarray:
+    """The rows as float32 matrix, with the categories as codes and NaN for the missing values."""
+    codes = frame["grade"].cat.codes.to_numpy().astype(np.float32)
+    codes[codes < 0] = np.nan
+    return np.column_stack(
+        [frame["x0"].to_numpy(), frame["x1"].to_numpy(), codes]
+    ).astype(np.float32)
+
+
+@pytest.fixture(scope="module")
+def model():
+    rng = np.random.default_rng(0)
+    train = _frame(rng, 2000, missing=0.1)
+    validation = _frame(rng, 500, missing=0.1)
+    model = xgboost.XGBRegressor(
+        n_estimators=200,
+        max_depth=5,
+        learning_rate=0.3,
+        enable_categorical=True,
+        max_cat_to_onehot=1,
+        early_stopping_rounds=5,
+        random_state=42,
+    )
+    model.fit(
+        train,
+        _target(train),
+        eval_set=[(validation, _target(validation))],
+        verbose=False,
+    )
+    return model
+
+
+@pytest.fixture(scope="module")
+def rows():
+    rng = np.random.default_rng(1)
+    x = _matrix(_frame(rng, 3000, missing=0.2))
+    # Categories of the dtype not seen in training and codes outside the dtype
+    grade = x[:, 2]
+    unseen = rng.random(len(x)) < 0.1
+    grade[unseen] = rng.choice(
+        [CATEGORIES.index(category) for category in UNSEEN_CATEGORIES], size=unseen.sum()
+    )
+    grade[rng.random(len(x)) < 0.05] = len(CATEGORIES) + 3
+    return x
+
+
+def _assert_parity(ensemble: TreeEnsemble, booster, x, num_trees: int = 0) -> None:
+    expected = booster.inplace_predict(x, iteration_range=(0, num_trees))
+    np.testing.assert_array_equal(ensemble.predict(x), expected)
+
+
+def test_all_trees(model, rows):
+    booster = model.get_booster()
+    ensemble = TreeEnsemble.from_booster(booster)
+    assert ensemble.num_trees == booster.num_boosted_rounds()
+    assert np.isnan(rows).any()
+    _assert_parity(ensemble, booster, rows)
+
+
+def test_categorical_splits(model):
+    ensemble = TreeEnsemble.from_booster(model.get_booster())
+    assert ensemble.categorical.any()
+
+
+def test_missing_values(model, rows):
+    booster = model.get_booster()
+    missing = rows.copy()
+    missing[:, :] = np.nan
+    _assert_parity(TreeEnsemble.from_booster(booster), booster, missing)
+
+
+def test_unseen_categories(model, rows):
+    booster = model.get_booster()
+    unseen = rows[rows[:, 2] >= CATEGORIES.index(UNSEEN_CATEGORIES[0])]
+    assert len(unseen)
+    _assert_parity(TreeEnsemble.from_booster(booster), booster, unseen)
+
+
+@pytest.mark.parametrize("num_trees", [1, 7])
+def test_num_trees(model, rows, num_trees):
+    booster = model.get_booster()
+    _assert_parity(TreeEnsemble.from_booster(booster, num_trees), booster, rows, num_trees)
+
+
+def test_best_iteration(model, rows):
+    booster = model.get_booster()
+    num_trees = model.best_iteration + 1
+    assert num_trees < booster.num_boosted_rounds()
+    _assert_parity(TreeEnsemble.from_booster(booster, num_trees), booster, rows, num_trees)
+
+
+def test_save_load(model, rows, tmp_path):
+    booster = model.get_booster()
+    ensemble = TreeEnsemble.from_booster(booster, model.best_iteration + 1)
+    path = tmp_path / "trees.npz"
+    ensemble.save(path)
+    loaded = TreeEnsemble.load(path)
+
+    assert loaded.feature_names == ensemble.feature_names
+    assert loaded.max_depth == ensemble.max_depth
+    for name in (
+        "roots",
+        "features",
+        "thresholds",
+        "left_children",
+        "right_children",
+        "default_left",
+        "categorical",
+        "categories",
+        "leaf_values",
+    ):
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(ensemble, name))
+    _assert_parity(loaded, booster, rows, model.best_iteration + 1)
+
+
+def test_check_parity(model, rows):
+    assert check_parity(model.get_booster(), rows) == 0.0
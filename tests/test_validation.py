@@ -0,0 +1,79 @@
+"""The diamond by diamond and the vectorized validators of app/validation.py
+must return the same error for the same diamond."""
+
+import pandas as pd
+import pytest
+from app.utils import ROW_VALIDATION_MAX_ROWS, check_data_correctness
+from app.validation import validate_diamond, validate_frame
+
+VALID = {
+    "carat": 0.7,
+    "cut": "Ideal",
+    "color": "G",
+    "clarity": "VS2",
+    "depth": 61.5,
+    "table": 56.0,
+    "x": 5.7,
+    "y": 5.72,
+    "z": 3.51,
+}
+
+
+def _diamond(**changes) -> dict:
+    diamond = dict(VALID)
+    for column, value in changes.items():
+        if value is KeyError:
+            del diamond[column]
+        else:
+            diamond[column] = value
+    return diamond
+
+
+DIAMONDS = {
+    "valid": VALID,
+    "missing key": _diamond(carat=KeyError),
+    "null": _diamond(x=None),
+    "nan": _diamond(y=float("nan")),
+    "wrong category": _diamond(cut="Perfect"),
+    "lowercase category": _diamond(color="g"),
+    "category as number": _diamond(clarity=3),
+    "category as boolean": _diamond(cut=True),
+    "boolean true": _diamond(carat=True),
+    "boolean false": _diamond(depth=False),
+    "numeric string": _diamond(carat="0.5"),
+    "zero string": _diamond(x="0"),
+    "padded numeric string": _diamond(table=" 56 "),
+    "non-numeric string": _diamond(table="large"),
+    "empty string": _diamond(z=""),
+    "nan string": _diamond(x="nan"),
+    "list": _diamond(y=[1.0]),
+    "negative": _diamond(z=-1),
+    "zero": _diamond(carat=0),
+    "integer": _diamond(table=56),
+    "extra key": _diamond(price=100),
+    "two errors": _diamond(cut="Perfect", x=-1),
+    "null and negative": _diamond(cut=None, x=-1),
+}
+
+
+@pytest.mark.parametrize("name", list(DIAMONDS))
+def test_same_error_in_a_batch(name):
+    diamond = DIAMONDS[name]
+    valid, errors = validate_frame(pd.DataFrame([VALID] * 20 + [diamond]))
+    assert errors[-1] == validate_diamond(diamond)
+    assert valid[-1] == (errors[-1] is None)
+    assert valid[:-1].all()
+
+
+def test_same_errors_in_a_batch_of_invalid_diamonds():
+    diamonds = list(DIAMONDS.values())
+    _, errors = validate_frame(pd.DataFrame(diamonds))
+    assert list(errors) == [validate_diamond(diamond) for diamond in diamonds]
+
+
+@pytest.mark.parametrize("name", list(DIAMONDS) + ["not a dictionary"])
+def test_same_result_below_and_above_the_row_validation_limit(name):
+    diamond = DIAMONDS.get(name, 5)
+    small = [VALID] * (ROW_VALIDATION_MAX_ROWS - 1) + [diamond]
+    large = [VALID] * ROW_VALIDATION_MAX_ROWS + [diamond]
+    assert check_data_correctness(small) == check_data_correctness(large)
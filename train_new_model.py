@@ -1,15 +1,45 @@
 """In the following code, will be implemented the pipeline for training the model with new data """
 
 import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+from pathlib import Path
+import numpy as np
+from models.base_model import BaseSupervisedModel
 from models.utils import (
     load_df,
     data_cleaning,
+    row_hashes,
+    holdout_rows,
+)
+from models.get_model import get_model, available_models
+from setting import (
+    DEFAULT_DATASET,
+    DEFAULT_ALGORITHM,
+    OPTUNA_STORAGE,
+    DATASET_CACHE_ENABLED,
+    INCREMENTAL_MIN_NEW_ROWS,
+    INCREMENTAL_HOLDOUT_FRACTION,
 )
-from models.get_model import get_model
-from setting import DEFAULT_DATASET, DEFAULT_ALGORITHM
 
 
-def train_new_model(dataset_path: str, model_name: str = DEFAULT_ALGORITHM) -> None:
+def train_new_model(
+    dataset_path: str,
+    model_name: str = DEFAULT_ALGORITHM,
+    n_trials: int = 100,
+    n_jobs: int = 1,
+    study_storage: str = OPTUNA_STORAGE,
+    study_name: str = None,
+    pruner: str = "median",
+    incremental: bool = False,
+    n_threads: int = None,
+    cv_folds: int = None,
+    cv_jobs: int = None,
+    min_new_rows: int = INCREMENTAL_MIN_NEW_ROWS,
+):
     """Trains a new model using the specified dataset.
 
     This function orchestrates the process of training a model by first loading and
@@ -21,20 +51,367 @@ def train_new_model(dataset_path: str, model_name: str = DEFAULT_ALGORITHM) -> N
         dataset_path (str): The file path to the dataset used for training.
         model_name (str, optional): The name of the algorithm to use for training.
             Defaults to DEFAULT_ALGORITHM.
+        n_trials (int, optional): The number of trials of the hyperparameter search,
+            for the algorithms that have one.
+        n_jobs (int, optional): The number of trials executed in parallel.
+        study_storage (str, optional): The URL of the database where the
+            hyperparameter search is persisted. If None it is kept in memory.
+        study_name (str, optional): The name of the hyperparameter search, give
+            the name of an interrupted search to resume it.
+        pruner (str, optional): The algorithm that stops the unpromising trials
+            of the hyperparameter search, "median" or "hyperband".
+        incremental (bool, optional): Continue the training of the latest saved
+            version of the model with the rows of the dataset it has not seen,
+            see train_incremental. Defaults to False.
+        n_threads (int, optional): The number of CPUs used by the training. If
+            None all the CPUs are used.
+        cv_folds (int, optional): Evaluate the model with k-fold cross validation
+            on this number of folds, instead of a single train/test split. The
+            saved metrics are the mean and the standard deviation over the folds.
+        cv_jobs (int, optional): The number of folds evaluated in parallel.
+            Defaults to one for each CPU.
+        min_new_rows (int, optional): The incremental training saves a new
+            version only with at least this number of new rows.
+
+    Returns:
+        tuple: The version and the metrics of the saved model, (None, None) if
+        the incremental training found too few new rows.
     """
 
     # Load the data
-    data = load_df(dataset_path)
+    data = load_df(dataset_path, use_cache=DATASET_CACHE_ENABLED)
     # Clean the data
     data = data_cleaning(data)
+
+    return _train_on_data(
+        data,
+        row_hashes(data),
+        model_name,
+        Path(dataset_path).stem,
+        n_trials=n_trials,
+        n_jobs=n_jobs,
+        study_storage=study_storage,
+        study_name=study_name,
+        pruner=pruner,
+        incremental=incremental,
+        n_threads=n_threads,
+        cv_folds=cv_folds,
+        cv_jobs=cv_jobs,
+        min_new_rows=min_new_rows,
+    )
+
+
+def _train_on_data(
+    data,
+    hashes,
+    model_name: str,
+    training_dataset_name: str,
+    n_trials: int,
+    n_jobs: int,
+    study_storage: str,
+    study_name: str,
+    pruner: str,
+    incremental: bool,
+    n_threads: int,
+    cv_folds: int = None,
+    cv_jobs: int = None,
+    min_new_rows: int = INCREMENTAL_MIN_NEW_ROWS,
+):
+    """Trains and saves a model on an already cleaned dataset, see train_new_model."""
+    if incremental:
+        result = train_incremental(
+            data,
+            hashes,
+            model_name,
+            training_dataset_name=training_dataset_name,
+            min_new_rows=min_new_rows,
+        )
+        if result is not None:
+            return result
+
     # Select input and target data
     x = data.drop(columns=["price"])
     y = data["price"]
 
     # Get the model
     model = get_model(model_name)
+    model.configure_hyperparameter_search(
+        n_trials=n_trials,
+        n_jobs=n_jobs,
+        storage=study_storage,
+        study_name=study_name,
+        pruner=pruner,
+        n_threads=n_threads,
+    )
+    model.configure_cross_validation(cv_folds, cv_jobs)
     model.train_pipeline(x, y, print_final_metrics=True)
-    model.save_model(training_dataset_name=dataset_path.stem)
+    fitted = np.zeros(len(hashes), dtype=bool)
+    fitted[model.trained_rows] = True
+    model.training_row_hashes = np.unique(hashes)
+    # The test rows stay in the holdout of the incremental trainings, the
+    # duplicates of fitted rows excluded
+    model.holdout_row_hashes = np.setdiff1d(hashes[~fitted], hashes[fitted])
+    version = model.save_model(training_dataset_name=training_dataset_name)
+    return version, _metrics(model)
+
+
+def _metrics(model) -> dict:
+    # The cross validation adds the list of the metrics of the folds
+    return {
+        name: float(value) if np.isscalar(value) else value
+        for name, value in model.metrics.items()
+    }
+
+
+def train_incremental(
+    data,
+    hashes,
+    model_name: str,
+    training_dataset_name: str,
+    min_new_rows: int = INCREMENTAL_MIN_NEW_ROWS,
+):
+    """Continues the training of the latest saved version of a model with the new
+    rows of the dataset.
+
+    The rows are identified by their hashes: the ones not recorded in the latest
+    version are new. The hashes of all the rows a version has seen are recorded,
+    the ones of its holdout included, so an unchanged dataset has no new rows.
+
+    A fixed fraction of the new rows, selected by their hashes
+    (INCREMENTAL_HOLDOUT_FRACTION), joins the holdout of the previous versions;
+    the model is updated with the others only (the xgboost booster gets new trees
+    with the hyperparameters of the previous search, the linear model updates its
+    sufficient statistics), evaluated on all the holdout rows of the dataset and
+    saved as a new version.
+
+    Args:
+        data (pd.DataFrame): The cleaned dataset, with the price.
+        hashes (np.ndarray): The hashes of the rows of the dataset.
+        model_name (str): The name of the algorithm.
+        training_dataset_name (str): The name of the dataset, saved with the model.
+        min_new_rows (int, optional): The minimum number of new rows to save a
+            new version.
+
+    Returns:
+        tuple: The version and the metrics of the saved model, (None, None) if
+        there are too few new rows, or None if the model has to be trained from
+        scratch.
+    """
+    latest = BaseSupervisedModel.load_latest_model(model_name)
+    if latest is None or latest[1].training_row_hashes is None:
+        print("No saved version with the hashes of its training rows, training from scratch")
+        return None
+    version, model = latest
+    if not model.supports_incremental:
+        print(
+            f"Version {version} of {model_name} can't be trained incrementally, "
+            "training from scratch"
+        )
+        return None
+
+    new_rows = ~np.isin(hashes, model.training_row_hashes)
+    num_new_rows = int(new_rows.sum())
+    if num_new_rows < max(min_new_rows, 1):
+        print(
+            f"{num_new_rows} new rows for version {version} of {model_name}, "
+            f"at least {max(min_new_rows, 1)} needed, no model saved"
+        )
+        return None, None
+
+    holdout = new_rows & holdout_rows(hashes, INCREMENTAL_HOLDOUT_FRACTION)
+    if model.holdout_row_hashes is not None:
+        holdout |= np.isin(hashes, model.holdout_row_hashes)
+    fitted = new_rows & ~holdout
+    if not fitted.any() or holdout.sum() < 2:
+        print(
+            f"{int(fitted.sum())} new rows to fit and {int(holdout.sum())} holdout "
+            f"rows for version {version} of {model_name}, no model saved"
+        )
+        return None, None
+
+    model.train_incremental_pipeline(
+        data[fitted].drop(columns=["price"]),
+        data[fitted]["price"],
+        data[holdout].drop(columns=["price"]),
+        data[holdout]["price"],
+        print_final_metrics=True,
+    )
+    print(
+        f"Updated version {version} of {model_name} with {int(fitted.sum())} new rows, "
+        f"evaluated on {int(holdout.sum())} holdout rows"
+    )
+    model.training_row_hashes = np.union1d(model.training_row_hashes, hashes[new_rows])
+    previous_holdout = model.holdout_row_hashes
+    if previous_holdout is None:
+        previous_holdout = np.empty(0, dtype=hashes.dtype)
+    model.holdout_row_hashes = np.union1d(previous_holdout, hashes[new_rows & holdout])
+    new_version = model.save_model(training_dataset_name=training_dataset_name)
+    return new_version, _metrics(model)
+
+
+# Cleaned datasets and row hashes of the parallel training, set in every worker
+# process by _init_worker
+_shared_datasets = {}
+
+
+def _init_worker(datasets: dict, n_threads: int) -> None:
+    global _shared_datasets
+    # With the fork start method the datasets are inherited from the parent
+    # process without being copied or pickled
+    _shared_datasets = datasets
+    # Limit the threads of the numerical libraries (BLAS, OpenMP) to the CPU
+    # budget of the worker
+    from threadpoolctl import threadpool_limits
+
+    threadpool_limits(limits=n_threads)
+
+
+def _train_job(model_name: str, dataset_path: str, options: dict) -> tuple:
+    data, hashes = _shared_datasets[dataset_path]
+    started = time.perf_counter()
+    version, metrics = _train_on_data(
+        data, hashes, model_name, Path(dataset_path).stem, **options
+    )
+    return version, metrics, time.perf_counter() - started
+
+
+def train_parallel(
+    dataset_paths: list,
+    model_names: list,
+    workers: int = None,
+    promote: bool = False,
+    promote_metric: str = "mae",
+    n_trials: int = 100,
+    n_jobs: int = 1,
+    study_storage: str = OPTUNA_STORAGE,
+    study_name: str = None,
+    pruner: str = "median",
+    incremental: bool = False,
+    cv_folds: int = None,
+    cv_jobs: int = None,
+    min_new_rows: int = INCREMENTAL_MIN_NEW_ROWS,
+) -> list:
+    """Trains every algorithm on every dataset in parallel worker processes.
+
+    Every dataset is loaded and cleaned once, in the parent process, and shared
+    with the workers. The jobs (one for each algorithm and dataset) are executed
+    by `workers` processes, each one training with an equal share of the CPUs,
+    and save their model with its own version. With `promote`, the saved model
+    with the best `promote_metric` becomes the promoted model, used by the
+    requests that don't give a model name.
+
+    Args:
+        dataset_paths (list): The file paths of the datasets used for training.
+        model_names (list): The names of the algorithms to train.
+        workers (int, optional): The number of worker processes. Defaults to the
+            number of jobs, at most the number of CPUs.
+        promote (bool, optional): Promote the best saved model. Defaults to False.
+        promote_metric (str, optional): The metric that chooses the best model,
+            "mae" (lowest) or "r2" (highest). Defaults to "mae".
+        n_trials, n_jobs, study_storage, study_name, pruner, incremental,
+        cv_folds, cv_jobs, min_new_rows: The configuration of every training, see
+            train_new_model. With several
+            datasets the name of the dataset is appended to the study name.
+
+    Returns:
+        list: One dict for every job with the "model_name", the "dataset", the
+        saved "version" (None if the job failed or saved no model), the "metrics"
+        and the "duration" in seconds.
+    """
+    cpu_count = os.cpu_count() or 1
+    jobs = [
+        (model_name, dataset_path)
+        for dataset_path in dict.fromkeys(dataset_paths)
+        for model_name in dict.fromkeys(model_names)
+    ]
+    workers = max(1, min(workers or cpu_count, len(jobs)))
+    n_threads = max(1, cpu_count // workers)
+
+    datasets = {}
+    for dataset_path in dict.fromkeys(dataset_paths):
+        data = data_cleaning(load_df(dataset_path, use_cache=DATASET_CACHE_ENABLED))
+        datasets[dataset_path] = (data, row_hashes(data))
+
+    if study_name is None and len(datasets) > 1:
+        study_name = "Diamonds XGBoost " + datetime.now(timezone.utc).strftime(
+            "%Y-%m-%d %H:%M:%S"
+        )
+
+    def options(dataset_path: str) -> dict:
+        return {
+            "n_trials": n_trials,
+            "n_jobs": n_jobs,
+            "study_storage": study_storage,
+            # Every dataset has its own hyperparameter search
+            "study_name": f"{study_name} [{Path(dataset_path).stem}]"
+            if len(datasets) > 1
+            else study_name,
+            "pruner": pruner,
+            "incremental": incremental,
+            "n_threads": n_threads,
+            "cv_folds": cv_folds,
+            "cv_jobs": cv_jobs,
+            "min_new_rows": min_new_rows,
+        }
+
+    print(f"Training {len(jobs)} models with {workers} workers of {n_threads} CPUs")
+    results = []
+    # fork shares the cleaned datasets with the workers copy-on-write
+    context = multiprocessing.get_context(
+        "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+    )
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(datasets, n_threads),
+    ) as executor:
+        futures = {
+            executor.submit(_train_job, model_name, dataset_path, options(dataset_path)): (
+                model_name,
+                dataset_path,
+            )
+            for model_name, dataset_path in jobs
+        }
+        for future in as_completed(futures):
+            model_name, dataset_path = futures[future]
+            result = {
+                "model_name": model_name,
+                "dataset": Path(dataset_path).stem,
+                "version": None,
+                "metrics": None,
+                "duration": None,
+            }
+            try:
+                result["version"], result["metrics"], result["duration"] = future.result()
+            except Exception as e:
+                print(f"Training of {model_name} on {dataset_path} failed. Reason: {e}")
+            results.append(result)
+
+    for result in results:
+        metrics = {
+            name: value
+            for name, value in (result["metrics"] or {}).items()
+            if name != "folds"
+        }
+        print(
+            f"{result['model_name']} on {result['dataset']}: version {result['version']}, "
+            f"metrics {metrics}, {result['duration'] or 0:.1f} s"
+        )
+
+    if promote:
+        saved = [result for result in results if result["version"] is not None]
+        if not saved:
+            print("No model saved, nothing to promote")
+            return results
+        sign = 1 if promote_metric == "mae" else -1
+        best = min(saved, key=lambda result: sign * result["metrics"][promote_metric])
+        BaseSupervisedModel.promote(best["model_name"], best["version"], best["metrics"])
+        print(
+            f"Promoted version {best['version']} of {best['model_name']}, "
+            f"{promote_metric} {best['metrics'][promote_metric]:.4f}"
+        )
+    return results
 
 
 if __name__ == "__main__":
@@ -44,18 +421,126 @@ if __name__ == "__main__":
     parser.add_argument(
         "--dataset",
         type=str,
-        default=DEFAULT_DATASET,
-        help="The file path to the dataset used for training.",
+        nargs="+",
+        default=[DEFAULT_DATASET],
+        help="""The file path to the dataset used for training. Give several
+        datasets to train a model on each of them in parallel.""",
     )
     parser.add_argument(
         "--model",
         type=str,
-        default=DEFAULT_ALGORITHM,
+        nargs="+",
+        default=[DEFAULT_ALGORITHM],
+        choices=available_models() + ["all"],
         help="""The name of the algorithm to use for training. Available options:
-        'Linear Regressor', 'XgBoost'
+        'Linear Regressor', 'XgBoost'. Give several algorithms, or 'all', to train
+        them in parallel.
         """,
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="""The number of worker processes training in parallel, the CPUs are
+        split equally between them. Defaults to one for each model to train, at
+        most the number of CPUs.""",
+    )
+    parser.add_argument(
+        "--promote",
+        action="store_true",
+        help="""Promote the best of the trained models: the requests that don't give
+        a model name use it.""",
+    )
+    parser.add_argument(
+        "--promote-metric",
+        type=str,
+        choices=["mae", "r2"],
+        default="mae",
+        help="The metric that chooses the promoted model.",
+    )
+
+    parser.add_argument(
+        "--n-trials",
+        type=int,
+        default=100,
+        help="The number of trials of the hyperparameter search.",
+    )
+    parser.add_argument(
+        "--n-jobs",
+        type=int,
+        default=1,
+        help="""The number of hyperparameter search trials executed in parallel,
+        the CPUs are split equally between them.""",
+    )
+    parser.add_argument(
+        "--study-name",
+        type=str,
+        default=None,
+        help="""The name of the hyperparameter search. Give the name of an
+        interrupted search to resume it.""",
+    )
+    parser.add_argument(
+        "--pruner",
+        type=str,
+        choices=["median", "hyperband"],
+        default="median",
+        help="The algorithm that stops the unpromising trials of the hyperparameter search.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="""Continue the training of the latest saved version of the model with
+        the rows of the dataset it has not been trained on.""",
+    )
+    parser.add_argument(
+        "--min-new-rows",
+        type=int,
+        default=INCREMENTAL_MIN_NEW_ROWS,
+        help="""The incremental training saves a new version only with at least this
+        number of new rows.""",
+    )
+    parser.add_argument(
+        "--cv-folds",
+        type=int,
+        default=None,
+        help="""Evaluate the model with k-fold cross validation on this number of
+        folds instead of a single train/test split.""",
+    )
+    parser.add_argument(
+        "--cv-jobs",
+        type=int,
+        default=None,
+        help="""The number of cross validation folds evaluated in parallel, the CPUs
+        are split equally between them. Defaults to one for each CPU.""",
+    )
+    parser.add_argument(
+        "--in-memory-study",
+        action="store_true",
+        help="Don't persist the hyperparameter search in the optuna database.",
+    )
 
     args = parser.parse_args()
+    model_names = available_models() if "all" in args.model else args.model
+    options = {
+        "n_trials": args.n_trials,
+        "n_jobs": args.n_jobs,
+        "study_storage": None if args.in_memory_study else OPTUNA_STORAGE,
+        "study_name": args.study_name,
+        "pruner": args.pruner,
+        "incremental": args.incremental,
+        "cv_folds": args.cv_folds,
+        "cv_jobs": args.cv_jobs,
+        "min_new_rows": args.min_new_rows,
+    }
 
-    train_new_model(args.dataset, model_name=args.model)
+    if len(args.dataset) == 1 and len(model_names) == 1 and not args.promote:
+        train_new_model(args.dataset[0], model_name=model_names[0], **options)
+    else:
+        train_parallel(
+            args.dataset,
+            model_names,
+            workers=args.workers,
+            promote=args.promote,
+            promote_metric=args.promote_metric,
+            **options,
+        )